@@ -0,0 +1,248 @@
+"""Cell level checkpoints of the notebook namespace (the with_checkpoints option).
+
+After each code cell has executed, the module namespace is pickled into a snapshot file.  Snapshots are
+keyed by a chain of hashes -- the key after a cell covers the key after the previous cell, the cell's
+(transformed) source and the values of the parameters the cell received via receive_parameter.  The
+names of those parameters are only known once the cell has run, so they are recorded in a small
+manifest file keyed by the chain up to (and including) the cell's source.
+
+A later run walks the chain as far as manifests exist and the current parameter values allow, loads the
+snapshot of the last cell along that path and only executes the cells after it.  External inputs (files
+read by a cell, the state of imported modules, ...) are not part of the keys -- remove the checkpoint
+directory to force a full run.
+
+Snapshots are pickled with cloudpickle when it is installed (so that functions and classes defined by the
+notebook can be checkpointed -- pip install NotebookScripter[checkpoints]) and with pickle otherwise --
+imported modules are pickled by reference.  Namespaces which can't be pickled (with pickle: any namespace
+holding a function or class defined by the notebook) aren't checkpointed.  The directory is kept within a disk budget by
+removing the least recently used snapshots and manifests -- snapshots whose manifests were removed can't
+be reached anymore and are removed in turn as they age.
+"""
+
+import hashlib
+import importlib
+import io
+import os
+import pickle
+import sys
+import tempfile
+import types
+
+from .NotebookCodeCache import cache_path_for
+from .NotebookResultCache import stable_hash, _Unhashable
+from ._main import _lookup_parameter, _recording_parameters
+
+# bump when the layout of checkpoint files or the derivation of keys changes
+CHECKPOINT_FORMAT_VERSION = 2
+
+SNAPSHOT_SUFFIX = ".snapshot"
+MANIFEST_SUFFIX = ".manifest"
+
+# names run_notebook adds to every notebook namespace -- not part of snapshots
+_UNSAVED_NAMES = ("__builtins__", "get_ipython")
+
+
+class _Uncheckpointable(Exception):
+    pass
+
+
+def checkpoint_directory_for(path_to_notebook):
+    """Return the default checkpoint directory of a notebook -- next to its code cache entry"""
+    return cache_path_for(path_to_notebook) + ".checkpoints"
+
+
+def _chain(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode("utf-8")
+        digest.update(len(part).to_bytes(8, "little"))
+        digest.update(part)
+    return digest.hexdigest()
+
+
+def _root_key(path_to_notebook):
+    return _chain(str(CHECKPOINT_FORMAT_VERSION), sys.version, os.path.abspath(path_to_notebook))
+
+
+def _parameters_key(names):
+    """Hash the values the named parameters currently resolve to -- the same in every process"""
+    parts = []
+    for name in names:
+        found, value = _lookup_parameter(name)
+        try:
+            value_hash = stable_hash(value) if found else ""
+        except _Unhashable:
+            raise _Uncheckpointable(name)
+        parts.extend((name, value_hash))
+    return _chain(*parts)
+
+
+class _NamespacePickler(pickle.Pickler):
+    def reducer_override(self, obj):
+        # pickle imported modules by reference
+        if isinstance(obj, types.ModuleType) and sys.modules.get(obj.__name__) is obj:
+            return (importlib.import_module, (obj.__name__,))
+        return NotImplemented
+
+
+def _dumps_namespace(namespace):
+    saved = {k: v for k, v in namespace.items() if k not in _UNSAVED_NAMES}
+    try:
+        import cloudpickle
+    except ImportError:
+        buffer = io.BytesIO()
+        _NamespacePickler(buffer, protocol=5).dump(saved)
+        return buffer.getvalue()
+    return cloudpickle.dumps(saved, protocol=5)
+
+
+def _restore_namespace(namespace, saved):
+    namespace.update(saved)
+
+    # functions defined by the notebook and pickled by value come back with their own globals -- rebind them to the module namespace
+    for name, value in saved.items():
+        if isinstance(value, types.FunctionType) and value.__module__ == namespace.get("__name__") and value.__globals__ is not namespace:
+            rebound = types.FunctionType(value.__code__, namespace, value.__name__, value.__defaults__, value.__closure__)
+            rebound.__kwdefaults__ = value.__kwdefaults__
+            rebound.__dict__.update(value.__dict__)
+            rebound.__qualname__ = value.__qualname__
+            rebound.__doc__ = value.__doc__
+            namespace[name] = rebound
+
+
+def _write_atomic(path, data):
+    directory = os.path.dirname(path)
+    try:
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        try:
+            with io.open(fd, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+    except OSError:
+        # checkpoints are best effort only
+        pass
+
+
+def _read_manifest(directory, key):
+    path = os.path.join(directory, key + MANIFEST_SUFFIX)
+    try:
+        with io.open(path, "rb") as f:
+            names = pickle.loads(f.read())
+        # reading counts as use for the least recently used eviction
+        os.utime(path)
+        return names
+    except Exception:
+        return None
+
+
+def _read_snapshot(directory, key):
+    path = os.path.join(directory, key + SNAPSHOT_SUFFIX)
+    try:
+        with io.open(path, "rb") as f:
+            saved = pickle.loads(f.read())
+        # reading counts as use for the least recently used eviction
+        os.utime(path)
+        return saved
+    except Exception:
+        return None
+
+
+def _write_snapshot(directory, key, namespace, budget):
+    try:
+        data = _dumps_namespace(namespace)
+    except Exception:
+        # namespaces holding unpicklable values (open files, locks, ...) aren't checkpointed
+        return
+    if len(data) <= budget:
+        _write_atomic(os.path.join(directory, key + SNAPSHOT_SUFFIX), data)
+
+
+def enforce_checkpoint_budget(directory, budget):
+    """Remove the least recently used snapshots and manifests in directory until they use at most budget bytes"""
+    try:
+        entries = []
+        for entry in os.scandir(directory):
+            if entry.name.endswith((SNAPSHOT_SUFFIX, MANIFEST_SUFFIX)):
+                stat = entry.stat()
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+    except OSError:
+        return
+
+    used = 0
+    for _, size, path in sorted(entries, reverse=True):
+        used += size
+        if used > budget:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+
+def _resume_point(directory, path_to_notebook, cells):
+    """Find the last cell whose checkpoint matches the current sources and parameters -- returns (position in cells, key, saved namespace)"""
+    key = _root_key(path_to_notebook)
+    resumable = []
+    for position, (_, source, _) in enumerate(cells):
+        source_key = _chain(key, source)
+        names = _read_manifest(directory, source_key)
+        if names is None:
+            break
+        try:
+            key = _chain(source_key, _parameters_key(names))
+        except _Uncheckpointable:
+            break
+        if os.path.exists(os.path.join(directory, key + SNAPSHOT_SUFFIX)):
+            resumable.append((position, key))
+
+    # fall back to earlier snapshots if the latest can't be read
+    for position, key in reversed(resumable):
+        saved = _read_snapshot(directory, key)
+        if saved is not None:
+            return position, key, saved
+
+    return -1, _root_key(path_to_notebook), None
+
+
+def execute_with_checkpoints(dynamic_module, path_to_notebook, cells, directory, budget, run_cell):
+    """Execute cells in the namespace of dynamic_module -- resuming from and recording checkpoints in directory
+
+    Args:
+        dynamic_module: Module in whose namespace the notebook code is executed
+        path_to_notebook: Path of the notebook -- part of the checkpoint keys
+        cells: Sequence of (index, transformed_source, code_object) tuples
+        directory: Directory holding the checkpoint files
+        budget: Maximum number of bytes used by snapshots and manifests in directory
+        run_cell: Function called with (index, transformed_source, code_object) to execute a cell
+    """
+    namespace = dynamic_module.__dict__
+
+    resume_position, key, saved = _resume_point(directory, path_to_notebook, cells)
+    if saved is not None:
+        _restore_namespace(namespace, saved)
+
+    checkpointing = True
+    for index, source, code_block in cells[resume_position + 1:]:
+        with _recording_parameters() as requested_parameters:
+            run_cell(index, source, code_block)
+
+        if not checkpointing:
+            continue
+
+        names = sorted(set(requested_parameters))
+        source_key = _chain(key, source)
+        try:
+            key = _chain(source_key, _parameters_key(names))
+        except _Uncheckpointable:
+            # later cells can't be keyed without the parameter's value
+            checkpointing = False
+            continue
+
+        _write_atomic(os.path.join(directory, source_key + MANIFEST_SUFFIX), pickle.dumps(names))
+        _write_snapshot(directory, key, namespace, budget)
+
+    enforce_checkpoint_budget(directory, budget)
@@ -0,0 +1,218 @@
+"""The notebookscripter command line -- batch runs of a notebook over a pool of warm workers.
+
+    notebookscripter Report.ipynb -p region='"emea"' -p year=2024 --return summary
+    notebookscripter Report.ipynb --parameters-file runs.jsonl --workers 8 --return summary --output results.jsonl
+    notebookscripter Report.ipynb --parameters-file runs.csv --mode jupyter --workers 4 --output-notebooks rendered/
+
+Parameter values given with -p (and the values of CSV files) are parsed as JSON when they are valid JSON
+and passed as strings otherwise.  Each run is reported as a record holding its index, parameters, the
+requested return values and its error (if any) -- written as JSON lines or as a stream of pickles.
+"""
+
+import argparse
+import contextlib
+import csv
+import functools
+import io
+import json
+import os
+import pickle
+import sys
+import threading
+import traceback
+
+MODES = ("process", "inprocess", "jupyter")
+FORMATS = ("jsonl", "pickle")
+
+
+def _parse_value(text):
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+
+def _parse_assignment(text):
+    name, separator, value = text.partition("=")
+    if not separator or not name:
+        raise argparse.ArgumentTypeError("expected NAME=VALUE: {0!r}".format(text))
+    return name, _parse_value(value)
+
+
+def _read_parameter_sets(path):
+    """Yield the parameter sets of a .jsonl file (one JSON object per line) or of a .csv file (one run per row)"""
+    with io.open(path, newline="", encoding="utf-8") as f:
+        if path.endswith(".csv"):
+            for row in csv.DictReader(f):
+                yield {name: _parse_value(value) for name, value in row.items()}
+        else:
+            for line_number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                parameters = json.loads(line)
+                if not isinstance(parameters, dict):
+                    raise ValueError("{0}:{1}: expected a JSON object of parameters".format(path, line_number))
+                yield parameters
+
+
+def _build_parser():
+    parser = argparse.ArgumentParser(prog="notebookscripter", description="Run a jupyter notebook (or .py notebook) with parameters -- once or for each parameter set of a file.")
+    parser.add_argument("notebook", help="Path to the .ipynb or .py notebook")
+    parser.add_argument("-p", "--parameter", action="append", type=_parse_assignment, default=[], metavar="NAME=VALUE",
+                        help="Parameter passed to every run -- the value is parsed as JSON when possible")
+    parser.add_argument("--parameters-file", metavar="FILE", help="A .jsonl or .csv file with one set of parameters per run")
+    parser.add_argument("-m", "--mode", choices=MODES, default="process",
+                        help="Run in worker subprocesses (the default), on threads of this process or on jupyter kernels")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="Number of runs executed concurrently")
+    parser.add_argument("--chunksize", type=int, default=1, help="Number of consecutive parameter sets handed to a worker at a time")
+    parser.add_argument("--ordered", action="store_true", help="Write results in the order of the parameter sets rather than as runs finish")
+    parser.add_argument("-r", "--return", dest="return_values", action="append", default=[], metavar="NAME",
+                        help="Name of a value to retrieve from each run")
+    parser.add_argument("-o", "--output", default="-", help="File the results are written to -- defaults to stdout")
+    parser.add_argument("-f", "--format", choices=FORMATS, default="jsonl", help="Format of the results -- JSON lines or a stream of pickled records")
+    parser.add_argument("--output-notebooks", metavar="DIRECTORY", help="Save the executed notebook of each run in DIRECTORY (jupyter mode)")
+    parser.add_argument("--option", action="append", type=_parse_assignment, default=[], metavar="NAME=VALUE",
+                        help="Notebook option passed to set_notebook_option -- for example with_timeout=600")
+    return parser
+
+
+def _run_chunk_in_kernels(pool, path_to_notebook, return_values, notebook_path_for, context, stopped, chunk):
+    from .NotebookProcessPool import NotebookMapResult
+
+    results = []
+    for index, parameters in chunk:
+        if stopped.is_set():
+            break
+        run = pool.run_notebook_in_jupyter(path_to_notebook, **parameters)
+        try:
+            module = context.copy().run(run, *return_values, save_output_notebook=notebook_path_for(index))
+            results.append(NotebookMapResult(index, parameters, module, None))
+        except Exception as e:
+            results.append(NotebookMapResult(index, parameters, None, e))
+    return results
+
+
+def _run_in_kernels(path_to_notebook, parameter_sets, return_values, workers, chunksize, ordered, notebook_path_for):
+    """Run the parameter sets on a NotebookKernelPool -- yields NotebookMapResults like run_notebook_map"""
+    import contextvars
+    from concurrent.futures import ThreadPoolExecutor
+    from .NotebookKernelPool import NotebookKernelPool
+    from .NotebookProcessPool import _map_chunks
+
+    stopped = threading.Event()
+    with NotebookKernelPool(kernels=workers) as pool:
+        executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="NotebookScripterKernelRun")
+        try:
+            run_chunk = functools.partial(_run_chunk_in_kernels, pool, path_to_notebook, return_values, notebook_path_for, contextvars.copy_context(), stopped)
+            yield from _map_chunks(executor, run_chunk, parameter_sets, chunksize, 2 * workers, ordered)
+        finally:
+            stopped.set()
+            executor.shutdown(wait=True)
+
+
+def _run(arguments, parameter_sets, notebook_path_for):
+    """Yield a NotebookMapResult for each parameter set"""
+    if arguments.mode == "process":
+        from .NotebookProcessPool import NotebookProcessPool, run_notebook_map
+
+        with NotebookProcessPool(processes=arguments.workers) as pool:
+            yield from run_notebook_map(arguments.notebook, parameter_sets, arguments.return_values, max_workers=arguments.workers,
+                                        chunksize=arguments.chunksize, ordered=arguments.ordered, pool=pool)
+    elif arguments.mode == "inprocess":
+        from .NotebookThreads import run_notebooks_threaded
+
+        yield from run_notebooks_threaded(arguments.notebook, parameter_sets, max_workers=arguments.workers, chunksize=arguments.chunksize, ordered=arguments.ordered)
+    else:
+        yield from _run_in_kernels(arguments.notebook, parameter_sets, arguments.return_values, arguments.workers, arguments.chunksize,
+                                   arguments.ordered, notebook_path_for)
+
+
+def _record(result, return_values):
+    values = {}
+    if result.module is not None:
+        values = {name: result.module.__dict__[name] for name in return_values if name in result.module.__dict__}
+    error = None
+    if result.exception is not None:
+        error = "".join(traceback.format_exception_only(type(result.exception), result.exception)).strip()
+    return {"index": result.index, "parameters": result.parameters, "values": values, "error": error}
+
+
+def _write_record(output, record, output_format):
+    if output_format == "jsonl":
+        # values which aren't JSON serializable are written as their repr
+        output.write(json.dumps(record, default=repr).encode("utf-8") + b"\n")
+    else:
+        pickle.dump(record, output, protocol=pickle.HIGHEST_PROTOCOL)
+    output.flush()
+
+
+@contextlib.contextmanager
+def _open_output(path):
+    """Open the file results are written to -- for stdout, output of the notebooks (and worker processes) is sent to stderr instead"""
+    if path != "-":
+        with io.open(path, "wb") as output:
+            yield output
+        return
+
+    try:
+        stdout_fd = sys.stdout.fileno()
+    except (AttributeError, ValueError, io.UnsupportedOperation):
+        # not backed by a file descriptor (for example captured output)
+        yield sys.stdout.buffer
+        return
+
+    sys.stdout.flush()
+    output = io.open(os.dup(stdout_fd), "wb")
+    saved_stdout_fd = os.dup(stdout_fd)
+    # worker processes inherit the redirected descriptor
+    os.dup2(sys.stderr.fileno(), stdout_fd)
+    try:
+        yield output
+    finally:
+        sys.stdout.flush()
+        os.dup2(saved_stdout_fd, stdout_fd)
+        os.close(saved_stdout_fd)
+        output.close()
+
+
+def main(argv=None):
+    """Entry point of the notebookscripter command -- returns the exit status (1 when any run failed)"""
+    from ._main import set_notebook_option
+
+    parser = _build_parser()
+    arguments = parser.parse_args(argv)
+    if arguments.workers < 1:
+        parser.error("--workers must be at least 1")
+    if arguments.chunksize < 1:
+        parser.error("--chunksize must be at least 1")
+    if arguments.output_notebooks and arguments.mode != "jupyter":
+        parser.error("--output-notebooks requires --mode jupyter")
+
+    common_parameters = dict(arguments.parameter)
+    if arguments.parameters_file:
+        # values of the file take precedence over -p values
+        parameter_sets = (dict(common_parameters, **parameters) for parameters in _read_parameter_sets(arguments.parameters_file))
+    else:
+        parameter_sets = [common_parameters]
+
+    if arguments.output_notebooks:
+        os.makedirs(arguments.output_notebooks, exist_ok=True)
+    stem = os.path.splitext(os.path.basename(arguments.notebook))[0]
+
+    def notebook_path_for(index):
+        if not arguments.output_notebooks:
+            return None
+        return os.path.join(arguments.output_notebooks, "{0}-{1}.ipynb".format(stem, index))
+
+    set_notebook_option(**dict(arguments.option))
+
+    runs = failures = 0
+    with _open_output(arguments.output) as output:
+        for result in _run(arguments, parameter_sets, notebook_path_for):
+            runs += 1
+            if result.exception is not None:
+                failures += 1
+            _write_record(output, _record(result, arguments.return_values), arguments.format)
+
+    print("{0} runs, {1} failed".format(runs, failures), file=sys.stderr)
+    return 1 if failures else 0
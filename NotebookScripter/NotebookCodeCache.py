@@ -0,0 +1,149 @@
+"""On-disk cache of transformed and compiled notebook code.
+
+Loading a notebook means reading the file, parsing the .ipynb json, running each code cell through
+ipython's input transformers and compiling the result.  The outcome of that work only depends on the
+file contents and on the python/ipython versions doing the work, so it is cached next to the notebook
+in a __pycache__ directory (similar to how python caches .pyc files for modules).
+
+A cache entry is reused without reading the notebook when the file's mtime and size match the values
+recorded in the entry.  When they don't match the notebook is read and hashed -- if the content hash
+still matches the entry is reused (and its recorded mtime/size are refreshed).
+"""
+
+import hashlib
+import io
+import marshal
+import os
+import sys
+import tempfile
+
+# bump when the layout of cache entries changes
+CACHE_FORMAT_VERSION = 3
+
+CACHE_DIRECTORY_NAME = "__pycache__"
+
+
+def cache_path_for(path_to_notebook):
+    """Return the path of the cache entry used for the given notebook file"""
+    directory, filename = os.path.split(os.path.abspath(path_to_notebook))
+    if getattr(sys, "pycache_prefix", None):
+        directory = os.path.join(sys.pycache_prefix, os.path.splitdrive(directory)[1].lstrip(os.sep))
+    else:
+        directory = os.path.join(directory, CACHE_DIRECTORY_NAME)
+    return os.path.join(directory, "{0}.{1}.notebookscripter".format(filename, sys.implementation.cache_tag))
+
+
+def _ipython_version():
+    from IPython import __version__
+    return __version__
+
+
+def _is_ipynb(path_to_notebook):
+    _, extension = os.path.splitext(path_to_notebook)
+    return extension == ".ipynb"
+
+
+def compile_notebook_source(path_to_notebook, raw_source, transform_cell, validate=False):
+    """Transform and compile notebook source text.
+
+    Returns a tuple of (transformed_source, code_object) pairs -- one per code cell.  The cells of .py files
+    are delimited by "# %%" or "# <codecell>" markers (a file without markers is a single cell).  raw_source can be any
+    bytes-like object (a memory mapped file).  .ipynb files are only validated against the notebook schema
+    when validate is True.
+    """
+    if _is_ipynb(path_to_notebook):
+        from .NotebookIpynbReader import reads_lean_notebook
+        notebook = reads_lean_notebook(raw_source, validate)
+
+        cells = []
+        for cell in notebook.cells:
+            if cell.cell_type == 'code':
+                # transform the input to executable Python
+                code = transform_cell(cell.source)
+                cells.append((code, compile(code, "<string>", "exec")))
+        return tuple(cells)
+    else:
+        # execute .py files as notebooks -- compile with the real path (and each cell's line offset) to provide source mapping support
+        from .NotebookPyFileReader import split_pyfile_cells
+
+        cells = []
+        for cell in split_pyfile_cells(bytes(raw_source).decode("utf-8")):
+            if cell.cell_type == "code":
+                code = transform_cell(cell.source)
+                cells.append((code, compile("\n" * cell.first_line + code, path_to_notebook, "exec")))
+        return tuple(cells)
+
+
+def _read_cache_entry(cache_path):
+    try:
+        with io.open(cache_path, "rb") as f:
+            entry = marshal.loads(f.read())
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+
+    if not isinstance(entry, tuple) or len(entry) != 6 or entry[0] != CACHE_FORMAT_VERSION:
+        return None
+    return entry
+
+
+def _write_cache_entry(cache_path, entry):
+    if sys.dont_write_bytecode:
+        return
+
+    directory = os.path.dirname(cache_path)
+    try:
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-", suffix=".notebookscripter")
+        try:
+            with io.open(fd, "wb") as f:
+                f.write(marshal.dumps(entry))
+            # atomic on posix and windows -- concurrent readers never see a partial entry
+            os.replace(temp_path, cache_path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+    except OSError:
+        # the cache is best effort only -- read-only locations just don't get cached
+        pass
+
+
+def load_notebook_cells(path_to_notebook, transform_cell, use_cache=True, validate=False):
+    """Load the transformed and compiled code cells of a notebook, going through the on-disk cache.
+
+    Args:
+        path_to_notebook: Path to .ipynb or .py file containing notebook code
+        transform_cell: Function used to turn cell source into executable python (ipython's input transformer)
+        use_cache: When False the cache is neither read nor written
+        validate: Validate .ipynb files against the notebook schema when they are parsed (cache entries are reused without validation)
+    Returns:
+        Tuple of (transformed_source, code_object) pairs in execution order
+    """
+    from .NotebookIpynbReader import mapped_file
+
+    if not use_cache:
+        with mapped_file(path_to_notebook) as raw_source:
+            return compile_notebook_source(path_to_notebook, raw_source, transform_cell, validate)
+
+    stat = os.stat(path_to_notebook)
+    cache_path = cache_path_for(path_to_notebook)
+    ipython_version = _ipython_version()
+
+    entry = _read_cache_entry(cache_path)
+    if entry is not None and entry[1] != ipython_version:
+        entry = None
+
+    if entry is not None and entry[2] == stat.st_mtime_ns and entry[3] == stat.st_size:
+        return entry[5]
+
+    # the file is memory mapped -- stored outputs of large notebooks are hashed but never copied or decoded
+    with mapped_file(path_to_notebook) as raw_source:
+        content_hash = hashlib.sha256(raw_source).hexdigest()
+
+        if entry is not None and entry[4] == content_hash:
+            # file was touched but not changed -- refresh the stat information only
+            cells = entry[5]
+        else:
+            cells = compile_notebook_source(path_to_notebook, raw_source, transform_cell, validate)
+
+    _write_cache_entry(cache_path, (CACHE_FORMAT_VERSION, ipython_version, stat.st_mtime_ns, stat.st_size, content_hash, cells))
+    return cells
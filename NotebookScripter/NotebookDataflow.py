@@ -0,0 +1,431 @@
+"""Static dataflow analysis of notebook cells (the with_dead_cell_elimination option).
+
+Each code cell is parsed (after ipython's input transformations) and summarized by the module level
+names it may write and the names it reads.  Starting from the requested names, cells are walked
+backwards -- a cell runs when it may write a name that is needed by the requested values or by a cell
+which runs after it, and the names it reads become needed in turn.  All other cells are skipped.
+
+The analysis errs on the side of running cells:
+
+- a name counts as written by assignments, imports, def/class statements and del, by attribute or item
+  assignment on it (x.a = ..., x[i] = ...), by method calls on it (x.append(...), np.random.shuffle(...))
+  and by passing it to any call other than the builtins in PURE_CALLS (random.shuffle(x), setattr(x, ...),
+  f(x.a) -- for attributes and items passed, the name they belong to counts as written)
+- mutations of process state -- sys, os, site and importlib (and names imported from them) mutated as
+  above, like sys.path.append(...), os.chdir(...) or os.environ[...] = ... -- count as writing
+  PROCESS_STATE, which is read by every cell which imports, uses those modules or opens files
+- calling a function defined by the notebook counts as the writes that function may perform on module
+  level names (via global statements, attribute/item assignment, method calls or calls) and as the
+  module level names it reads -- including the writes and reads of the notebook functions it calls
+- cells which use exec/eval/globals/locals/vars/__import__, star imports, ipython magics or shell escapes
+  (get_ipython), or which can't be parsed, always run
+
+Side effects outside of the module namespace (files written, plots rendered, ...) only happen when the
+cell producing them runs for other reasons.  Writes performed by lambdas and by methods of notebook
+defined classes are attributed to the cell defining them rather than to the cells calling them.
+"""
+
+import ast
+import collections
+
+# result of the analysis of one code cell
+CellPlan = collections.namedtuple("CellPlan", ["index", "run", "writes", "reads", "opaque", "source"])
+
+# calls whose effects on the module namespace can't be determined statically
+OPAQUE_CALLS = frozenset(["exec", "eval", "globals", "locals", "vars", "__import__", "get_ipython"])
+
+_FUNCTION_SCOPES = (ast.FunctionDef, ast.AsyncFunctionDef, ast.Lambda)
+_COMPREHENSION_SCOPES = (ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp)
+
+# builtins which don't mutate their arguments (apart from consuming iterators passed to them)
+PURE_CALLS = frozenset([
+    "abs", "all", "any", "ascii", "bin", "bool", "bytes", "callable", "chr", "complex", "dict", "divmod", "enumerate",
+    "filter", "float", "format", "frozenset", "getattr", "hasattr", "hash", "hex", "id", "int", "isinstance",
+    "issubclass", "iter", "len", "list", "map", "max", "min", "oct", "open", "ord", "pow", "print", "range", "repr",
+    "reversed", "round", "set", "slice", "sorted", "str", "sum", "tuple", "type", "zip",
+])
+
+# modules whose mutation changes the state of the process (import path, working directory, environment)
+PROCESS_STATE_MODULES = frozenset(["sys", "os", "site", "importlib"])
+
+# pseudo name written by cells which mutate process state and read by cells which may depend on it
+PROCESS_STATE = "<process state>"
+
+# module level names a notebook defined function may write and read when called
+_FunctionEffects = collections.namedtuple("_FunctionEffects", ["writes", "reads"])
+
+# marks a function whose effects on the module namespace are unknown
+_UNKNOWN_EFFECTS = None
+
+
+def _base_name(node):
+    """Return the name at the root of an attribute/subscript chain (x in x.a[0].b) -- or None"""
+    while isinstance(node, (ast.Attribute, ast.Subscript, ast.Starred)):
+        node = node.value
+    if isinstance(node, ast.Name):
+        return node.id
+    return None
+
+
+def _argument_names(arguments):
+    args = arguments.posonlyargs + arguments.args + arguments.kwonlyargs
+    names = [arg.arg for arg in args]
+    if arguments.vararg:
+        names.append(arguments.vararg.arg)
+    if arguments.kwarg:
+        names.append(arguments.kwarg.arg)
+    return names
+
+
+def _scope_children(node):
+    """Child nodes evaluated within the scope opened by node (function body, comprehension, ...)"""
+    if isinstance(node, ast.Lambda):
+        return [node.body]
+    if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+        return node.body
+    if isinstance(node, ast.DictComp):
+        return [node.key, node.value] + node.generators
+    return [node.elt] + node.generators
+
+
+def _local_names(node):
+    """Names bound within the scope opened by node -- without descending into nested scopes"""
+    names = set()
+    declared_global = set()
+
+    if isinstance(node, _FUNCTION_SCOPES):
+        names.update(_argument_names(node.args))
+
+    pending = list(_scope_children(node))
+    while pending:
+        child = pending.pop()
+        if isinstance(child, ast.Name) and isinstance(child.ctx, (ast.Store, ast.Del)):
+            names.add(child.id)
+        elif isinstance(child, (ast.Global, ast.Nonlocal)):
+            declared_global.update(child.names)
+        elif isinstance(child, (ast.Import, ast.ImportFrom)):
+            names.update((alias.asname or alias.name).split(".")[0] for alias in child.names)
+        elif isinstance(child, ast.ExceptHandler) and child.name:
+            names.add(child.name)
+        elif isinstance(child, (ast.MatchAs, ast.MatchStar)) and child.name:
+            names.add(child.name)
+        elif isinstance(child, ast.MatchMapping) and child.rest:
+            names.add(child.rest)
+
+        if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            names.add(child.name)
+            # decorators, defaults and bases are evaluated in this scope -- the body isn't
+            pending.extend(child.decorator_list)
+            if isinstance(child, ast.ClassDef):
+                pending.extend(child.bases + child.keywords)
+            else:
+                pending.extend(child.args.defaults + [d for d in child.args.kw_defaults if d is not None])
+        elif isinstance(child, ast.Lambda):
+            pending.extend(child.args.defaults + [d for d in child.args.kw_defaults if d is not None])
+        elif isinstance(child, _COMPREHENSION_SCOPES):
+            # the outermost iterable is evaluated in this scope
+            pending.append(child.generators[0].iter)
+        else:
+            pending.extend(ast.iter_child_nodes(child))
+
+    if isinstance(node, _COMPREHENSION_SCOPES):
+        for generator in node.generators:
+            for target in ast.walk(generator.target):
+                if isinstance(target, ast.Name):
+                    names.add(target.id)
+
+    return names - declared_global
+
+
+class _CellVisitor(ast.NodeVisitor):
+    """Collect the module level names a cell may write and the names it reads"""
+
+    def __init__(self, function_effects, process_names):
+        self.function_effects = function_effects
+        # module level names bound to process state modules (or objects imported from them) -- shared by the cells
+        self.process_names = process_names
+        self.writes = set()
+        self.reads = set()
+        self.opaque = False
+        # module level functions defined by the cell -> _FunctionEffects of calling them
+        self.defined_effects = {}
+        # (kind, local names) of the enclosing function/comprehension/class scopes
+        self.scopes = []
+        # writes and reads of the module level function currently being visited
+        self.current_effects = None
+        self.current_reads = None
+
+    def _is_global(self, name, writing=False):
+        if any(kind != "class" and name in names for kind, names in self.scopes):
+            return False
+        # names bound in a class body are class attributes -- class scopes don't shadow reads though
+        return not (writing and self.scopes and self.scopes[-1][0] == "class")
+
+    def _write(self, name):
+        if name is None or not self._is_global(name, writing=True):
+            return
+        if self.scopes and self.current_effects is not None:
+            # inside a module level function the write happens whenever the function is called
+            self.current_effects.add(name)
+        else:
+            # module level code -- and lambdas and methods, whose callers aren't tracked
+            self.writes.add(name)
+
+    def _mutate(self, name):
+        """name (or an object reachable from it) may be changed in place"""
+        self._write(name)
+        if name in self.process_names:
+            # also when the module was imported by the enclosing function
+            self._write(PROCESS_STATE)
+
+    def _add_read(self, name):
+        # reads within module level functions stay reads of the defining cell as well
+        self.reads.add(name)
+        if self.scopes and self.current_reads is not None:
+            # ... and happen whenever the function is called
+            self.current_reads.add(name)
+
+    def _read(self, name):
+        if self._is_global(name):
+            self._add_read(name)
+        if name in self.process_names:
+            self._add_read(PROCESS_STATE)
+
+    def _call_effects(self, name):
+        """Writes and reads performed by calling the notebook defined function name"""
+        pending, seen = [name], set()
+        while pending:
+            callee = pending.pop()
+            if callee in seen:
+                continue
+            seen.add(callee)
+            if callee in self.defined_effects:
+                effects = self.defined_effects[callee]
+            elif callee in self.function_effects:
+                effects = self.function_effects[callee]
+            else:
+                continue
+            if effects is _UNKNOWN_EFFECTS:
+                self.opaque = True
+                return
+            for effect in effects.writes:
+                self._write(effect)
+            for read in effects.reads:
+                # module level names of the function -- not shadowed by names local to the caller
+                self._add_read(read)
+            # notebook functions the function refers to may be called by it (also those defined after it)
+            pending.extend(effects.reads)
+
+    def visit_Name(self, node):
+        if isinstance(node.ctx, ast.Load):
+            self._read(node.id)
+        else:
+            self._write(node.id)
+
+    def visit_AugAssign(self, node):
+        name = _base_name(node.target)
+        if name is not None:
+            self._read(name)
+            self._mutate(name)
+        self.generic_visit(node)
+
+    def visit_Attribute(self, node):
+        if not isinstance(node.ctx, ast.Load):
+            self._mutate(_base_name(node))
+        self.generic_visit(node)
+
+    def visit_Subscript(self, node):
+        if not isinstance(node.ctx, ast.Load):
+            self._mutate(_base_name(node))
+        self.generic_visit(node)
+
+    def visit_Call(self, node):
+        if isinstance(node.func, ast.Name):
+            if node.func.id in OPAQUE_CALLS:
+                self.opaque = True
+            if node.func.id == "open":
+                # relative paths depend on the working directory
+                self._read(PROCESS_STATE)
+            self._call_effects(node.func.id)
+        else:
+            # method calls may mutate the object they are called on
+            self._mutate(_base_name(node.func))
+            if _base_name(node.func) is None:
+                # get_ipython().run_line_magic(...) and other calls on call results
+                inner = node.func
+                while isinstance(inner, (ast.Attribute, ast.Subscript)):
+                    inner = inner.value
+                if isinstance(inner, ast.Call) and isinstance(inner.func, ast.Name) and inner.func.id in OPAQUE_CALLS:
+                    self.opaque = True
+
+        if not (isinstance(node.func, ast.Name) and node.func.id in PURE_CALLS):
+            # arguments may be mutated by the callee (setattr(x, ...), random.shuffle(x), f(x.a), ...)
+            for argument in node.args + [keyword.value for keyword in node.keywords]:
+                self._mutate(_base_name(argument))
+        self.generic_visit(node)
+
+    def _bind_module(self, module, name):
+        if module.split(".")[0] in PROCESS_STATE_MODULES:
+            self.process_names.add(name)
+
+    def visit_Import(self, node):
+        # imports depend on sys.path, sys.modules, the working directory ...
+        self._read(PROCESS_STATE)
+        for alias in node.names:
+            name = (alias.asname or alias.name).split(".")[0]
+            self._bind_module(alias.name, name)
+            self._write(name)
+
+    def visit_ImportFrom(self, node):
+        self._read(PROCESS_STATE)
+        for alias in node.names:
+            if alias.name == "*":
+                self.opaque = True
+            else:
+                self._bind_module(node.module or "", alias.asname or alias.name)
+                self._write(alias.asname or alias.name)
+
+    def visit_Global(self, node):
+        for name in node.names:
+            self._write(name)
+
+    def visit_Nonlocal(self, node):
+        # names of enclosing function scopes -- invisible at module level
+        pass
+
+    def visit_ExceptHandler(self, node):
+        if node.name:
+            self._write(node.name)
+        self.generic_visit(node)
+
+    def visit_MatchAs(self, node):
+        if node.name:
+            self._write(node.name)
+        self.generic_visit(node)
+
+    visit_MatchStar = visit_MatchAs
+
+    def visit_MatchMapping(self, node):
+        if node.rest:
+            self._write(node.rest)
+        self.generic_visit(node)
+
+    def _visit_scope(self, node, kind="function"):
+        # names bound in a nested scope shadow module level names
+        self.scopes.append((kind, _local_names(node)))
+        for child in _scope_children(node):
+            self.visit(child)
+        self.scopes.pop()
+
+    def _visit_function(self, node):
+        for expression in node.decorator_list + node.args.defaults + [d for d in node.args.kw_defaults if d is not None]:
+            self.visit(expression)
+
+        if not self.scopes and not isinstance(node, ast.Lambda):
+            # track what calling this module level function may write
+            enclosing = self.current_effects, self.current_reads, self.opaque
+            self.current_effects, self.current_reads, self.opaque = set(), set(), False
+            self._visit_scope(node)
+            self.defined_effects[node.name] = _UNKNOWN_EFFECTS if self.opaque else _FunctionEffects(
+                frozenset(self.current_effects), frozenset(self.current_reads))
+            self.current_effects, self.current_reads, self.opaque = enclosing
+        else:
+            self._visit_scope(node)
+
+        if not isinstance(node, ast.Lambda):
+            self._write(node.name)
+
+    visit_FunctionDef = _visit_function
+    visit_AsyncFunctionDef = _visit_function
+
+    def visit_Lambda(self, node):
+        for expression in node.args.defaults + [d for d in node.args.kw_defaults if d is not None]:
+            self.visit(expression)
+        self._visit_scope(node)
+
+    def visit_ClassDef(self, node):
+        for expression in node.decorator_list + node.bases + node.keywords:
+            self.visit(expression)
+        self.scopes.append(("class", None))
+        for statement in node.body:
+            self.visit(statement)
+        self.scopes.pop()
+        self._write(node.name)
+
+    def _visit_comprehension(self, node):
+        # the outermost iterable is evaluated in the enclosing scope
+        self.visit(node.generators[0].iter)
+        self.scopes.append(("comprehension", _local_names(node)))
+        for child in _scope_children(node):
+            if child is node.generators[0]:
+                self.visit(child.target)
+                for condition in child.ifs:
+                    self.visit(condition)
+            else:
+                self.visit(child)
+        self.scopes.pop()
+
+    visit_ListComp = _visit_comprehension
+    visit_SetComp = _visit_comprehension
+    visit_DictComp = _visit_comprehension
+    visit_GeneratorExp = _visit_comprehension
+
+    def visit_NamedExpr(self, node):
+        self.visit(node.value)
+        # assignment expressions bind in the enclosing function (or module) scope -- even within comprehensions
+        if all(kind == "comprehension" for kind, _ in self.scopes):
+            self.writes.add(node.target.id)
+        elif self.current_effects is not None and all(kind != "function" for kind, _ in self.scopes):
+            self.current_effects.add(node.target.id)
+
+
+def analyze_cells(sources):
+    """Summarize transformed cell sources -- returns a list of (writes, reads, opaque) tuples"""
+    function_effects = {}
+    process_names = set()
+    summaries = []
+    for source in sources:
+        try:
+            tree = ast.parse(source)
+        except SyntaxError:
+            summaries.append((frozenset(), frozenset(), True))
+            continue
+
+        visitor = _CellVisitor(function_effects, process_names)
+        visitor.visit(tree)
+        function_effects.update(visitor.defined_effects)
+        summaries.append((frozenset(visitor.writes), frozenset(visitor.reads), visitor.opaque))
+    return summaries
+
+
+def plan_cells(sources, return_values):
+    """Decide which cells to run to produce return_values -- returns a list of CellPlan tuples"""
+    summaries = analyze_cells(sources)
+    needed = set(return_values)
+    run = [False] * len(summaries)
+    for index in reversed(range(len(summaries))):
+        writes, reads, opaque = summaries[index]
+        if opaque or writes & needed:
+            run[index] = True
+            needed |= reads
+
+    return [CellPlan(index, run[index], writes, reads, opaque, source) for index, ((writes, reads, opaque), source) in enumerate(zip(summaries, sources))]
+
+
+def plan_dead_cell_elimination(path_to_notebook, return_values):
+    """Dry run of the with_dead_cell_elimination option -- reports which code cells would run to compute return_values
+
+    Args:
+        path_to_notebook: Path to .ipynb or .py file containing notebook code
+        return_values: Names of the values which would be requested from the notebook
+    Returns:
+        List of CellPlan(index, run, writes, reads, opaque, source) tuples -- one per code cell
+    """
+    from ._main import _get_shell, __receive_option as _receive_option
+    from .NotebookCodeCache import load_notebook_cells
+
+    cells = load_notebook_cells(
+        path_to_notebook,
+        _get_shell().input_transformer_manager.transform_cell,
+        use_cache=_receive_option(with_code_cache=True))
+    return plan_cells([source for source, _ in cells], list(return_values))
@@ -0,0 +1,174 @@
+"""The embedded ipython shell used to transform and execute notebook code.
+
+Kept separate from _main so that importing NotebookScripter (for example just to call
+receive_parameter) doesn't pay for importing IPython.
+
+Notebooks may run concurrently on several threads.  The embedded shell's user_ns is therefore
+resolved per thread (and asyncio task) -- magics called by a notebook see that notebook's namespace.
+Magic overrides are reference counted so that concurrent runs don't undo each other's overrides.
+"""
+
+import contextvars
+import threading
+
+from IPython import get_ipython
+from IPython.core.interactiveshell import InteractiveShell
+from IPython.core.magic import Magics, magics_class, line_magic
+
+from traitlets.config import MultipleInstanceError
+
+
+# namespace of the notebook executing in the current thread/task -- None outside of notebook runs
+_notebook_user_ns = contextvars.ContextVar("notebookscripter_user_ns", default=None)
+
+
+class NotebookScripterEmbeddedIpythonShell(InteractiveShell):
+
+    @property
+    def user_ns(self):
+        namespace = _notebook_user_ns.get()
+        return self._shell_user_ns if namespace is None else namespace
+
+    @user_ns.setter
+    def user_ns(self, namespace):
+        self._shell_user_ns = namespace
+
+    def enable_gui(self, gui=None):
+        pass
+
+    def init_sys_modules(self):
+        """Override this to create an ipython shell appropriate for embedding similar to InteractiveShellEmbed.
+
+        Needed to avoid creating new global namespace when running from command line console.
+        """
+        pass
+
+    def init_prompts(self):
+        """Override: don't mutate shell prompts.  Needed to avoid overtaking the interactive shell when this code is run from `python` command line console."""
+        # Set system prompts, so that scripts can decide if they are running
+        # interactively.
+        # sys.ps1 = 'In : '
+        # sys.ps2 = '...: '
+        # sys.ps3 = 'Out: '
+
+
+_shell_lock = threading.RLock()
+
+
+def get_shell():
+    """Return the ipython shell used to transform and run notebook code"""
+    with _shell_lock:
+        try:
+            shell = NotebookScripterEmbeddedIpythonShell.instance()
+        except MultipleInstanceError:
+            # we are already embedded into an ipython shell -- just get that one.
+            shell = get_ipython()
+    return shell
+
+
+# user_ns of shells not owned by NotebookScripter (the kernel's shell when running inside jupyter) -- [active runs, saved user_ns]
+_foreign_user_ns = {}
+
+
+def set_notebook_user_ns(shell, namespace):
+    """Make namespace the user_ns of shell for the notebook run executing in the current thread -- returns a function which undoes this"""
+    if isinstance(shell, NotebookScripterEmbeddedIpythonShell):
+        token = _notebook_user_ns.set(namespace)
+
+        def restore_user_ns():
+            _notebook_user_ns.reset(token)
+
+        return restore_user_ns
+
+    # a foreign shell's user_ns is swapped -- concurrent runs share it, but the shell's own namespace is restored once the last run finishes
+    with _shell_lock:
+        active = _foreign_user_ns.setdefault(id(shell), [0, shell.user_ns])
+        active[0] += 1
+        previous_namespace = shell.user_ns
+        shell.user_ns = namespace
+
+    def restore_foreign_user_ns():
+        with _shell_lock:
+            active[0] -= 1
+            if active[0] == 0:
+                shell.user_ns = active[1]
+                del _foreign_user_ns[id(shell)]
+            else:
+                shell.user_ns = previous_namespace
+
+    return restore_foreign_user_ns
+
+
+def register_magic(shell_instance, magic_cls):
+    """
+    Registers the provided shell_instance from IPython.
+
+    Returns a function which undoes this.
+
+    Rant: Why the f... does IPython not define it's own unregister function?
+
+    :param magic_cls: The Magics class you wish to register.
+    """
+
+    # ugh I hate this code and I hate python so much ...
+    undoes = {}
+    original_magics = shell_instance.magics_manager.magics
+    for magic_type, names in magic_cls.magics.items():
+        if magic_type in original_magics:
+            for magic_name, _ in names.items():
+                if magic_name in original_magics[magic_type]:
+                    undoesNamedMagics = undoes.setdefault(magic_type, {})
+                    undoesNamedMagics[magic_name] = original_magics[magic_type][magic_name]
+
+    shell_instance.register_magics(magic_cls)
+
+    def unregister_magics():
+        for magic_type, magic_names in undoes.items():
+            for magic_name, magic_value in magic_names.items():
+                shell_instance.magics_manager.magics[magic_type][magic_name] = magic_value
+
+    return unregister_magics
+
+
+# magics registered via acquire_magics -- {(id(shell), magic type, magic name): [active runs, function restoring the replaced magic]}
+_acquired_magics = {}
+
+
+def acquire_magics(shell_instance, magic_cls):
+    """Register magic_cls for the duration of a notebook run -- returns a function releasing the registration
+
+    The magics replaced by the first registration are restored once every run which acquired magics
+    with the same names has released them.
+    """
+    keys = [(id(shell_instance), magic_type, magic_name) for magic_type, names in magic_cls.magics.items() for magic_name in names]
+    with _shell_lock:
+        missing = [key for key in keys if key not in _acquired_magics]
+        unregister_magics = register_magic(shell_instance, magic_cls)
+        for key in keys:
+            _acquired_magics.setdefault(key, [0, unregister_magics if key in missing else None])[0] += 1
+
+    def release_magics():
+        with _shell_lock:
+            for key in keys:
+                acquired = _acquired_magics[key]
+                acquired[0] -= 1
+                if acquired[0] == 0:
+                    del _acquired_magics[key]
+                    if acquired[1] is not None:
+                        acquired[1]()
+
+    return release_magics
+
+
+def matplotlib_magics(with_backend):
+    """Create a Magics class overriding the %matplotlib line magic to always select with_backend"""
+
+    @magics_class
+    class NotebookScripterMagics(Magics):
+        @line_magic
+        def matplotlib(self, _line):
+            "Override matplotlib magic to use non-interactive backend regardless of user supplied argument ..."
+            import matplotlib
+            matplotlib.use(with_backend, force=True)
+
+    return NotebookScripterMagics
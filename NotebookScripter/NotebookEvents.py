@@ -0,0 +1,241 @@
+"""Streaming progress events from notebook runs (the with_events option).
+
+with_events is set to a callback which receives a NotebookEvent for each cell started and finished,
+for chunks written to stdout/stderr and for values passed to report_progress() within the notebook:
+
+    cell_started    -- data is None
+    cell_finished   -- data is {"elapsed": wall seconds, "error": None or a description of the exception raised by the cell}
+    stdout, stderr  -- data is the written text (subprocess and kernel runs only)
+    progress        -- data is the dict of values passed to report_progress()
+    run_finished    -- the last event of a subprocess or kernel run -- data is None
+
+Subprocess runs send their events through a bounded queue which is read by the calling process while
+it waits for the run's result -- events the queue has no room for are dropped rather than buffered, and
+the number dropped before an event is given by its dropped field.  Events (and so stream chunks and
+progress values) above a size limit carry a truncated repr instead of their data.  Kernel runs relay
+events from the messages nbclient receives from the kernel -- the callback is called as they arrive.
+"""
+
+import collections
+import pickle
+import queue
+import threading
+import time
+
+from ._main import _emit_event, _truncated_repr
+
+# event of a notebook run -- cell is the index of the notebook's code cell (None for events outside of cells)
+NotebookEvent = collections.namedtuple("NotebookEvent", ["kind", "path_to_notebook", "cell", "time", "data", "dropped"])
+
+# number of events a subprocess may have in flight before further events are dropped
+EVENT_BUFFER_SIZE = 256
+
+# pickled size above which the data of an event is replaced by its truncated repr
+MAX_EVENT_BYTES = 64 * 1024
+
+# maximum number of characters of a stdout/stderr event -- longer writes are truncated
+MAX_STREAM_CHUNK = 8192
+
+# mime type of the display data carrying events from a kernel to the calling process
+EVENT_MIME_TYPE = "application/x-notebookscripter-event"
+
+
+def encode_event(event):
+    """Pickle event -- its data is replaced by a truncated repr when it can't be pickled or is too large"""
+    try:
+        data = pickle.dumps(event, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(data) <= MAX_EVENT_BYTES:
+            return data
+    except Exception:
+        pass
+    return pickle.dumps(event._replace(data=_truncated_repr(event.data)), protocol=pickle.HIGHEST_PROTOCOL)
+
+
+class QueueEventSink(object):
+    """Sends the events of a subprocess run through a bounded queue -- events which don't fit are counted and dropped"""
+
+    def __init__(self, event_queue):
+        self.event_queue = event_queue
+        self.dropped = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        with self._lock:
+            try:
+                self.event_queue.put_nowait(encode_event(event._replace(dropped=self.dropped)))
+                self.dropped = 0
+            except queue.Full:
+                self.dropped += 1
+
+    def close(self, path_to_notebook):
+        """Send run_finished -- waits for room in the queue, so that the end of the run's events is never dropped"""
+        with self._lock:
+            self.event_queue.put(encode_event(NotebookEvent("run_finished", path_to_notebook, None, time.time(), None, self.dropped)))
+            self.dropped = 0
+
+
+class _StreamTee(object):
+    """Writes to a stream and emits the written text as events -- a line (or MAX_STREAM_CHUNK characters) at a time"""
+
+    def __init__(self, stream, kind):
+        self.stream = stream
+        self.kind = kind
+        self._pending = ""
+
+    def write(self, text):
+        written = self.stream.write(text)
+        self._pending += text
+        if "\n" in text or len(self._pending) >= MAX_STREAM_CHUNK:
+            self._emit_pending()
+        return written
+
+    def flush(self):
+        self._emit_pending()
+        self.stream.flush()
+
+    def _emit_pending(self):
+        pending, self._pending = self._pending, ""
+        if pending:
+            _emit_event(self.kind, pending[:MAX_STREAM_CHUNK])
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def capture_streams():
+    """Emit text written to sys.stdout and sys.stderr as events -- returns a function restoring the streams"""
+    import sys
+
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout = _StreamTee(stdout, "stdout")
+    sys.stderr = _StreamTee(stderr, "stderr")
+
+    def _restore():
+        for tee in (sys.stdout, sys.stderr):
+            if isinstance(tee, _StreamTee):
+                tee.flush()
+        sys.stdout, sys.stderr = stdout, stderr
+    return _restore
+
+
+class EventReceiver(object):
+    """Delivers the events a subprocess sends through event_queue to on_event -- used by the calling process"""
+
+    def __init__(self, event_queue, on_event):
+        self.event_queue = event_queue
+        self.on_event = on_event
+        self.finished = False
+
+    def _deliver(self, data):
+        event = pickle.loads(data)
+        if event.kind == "run_finished":
+            self.finished = True
+        self.on_event(event)
+
+    def drain(self):
+        """Deliver the events which have arrived so far"""
+        while not self.finished:
+            try:
+                data = self.event_queue.get_nowait()
+            except queue.Empty:
+                return
+            self._deliver(data)
+
+    def wait(self, result_queue, timeout):
+        """Deliver events until result_queue has a message to read or timeout seconds have passed"""
+        from multiprocessing.connection import wait
+
+        # pylint: disable=protected-access
+        end = time.monotonic() + timeout
+        while True:
+            readers = [result_queue._reader] if self.finished else [result_queue._reader, self.event_queue._reader]
+            ready = wait(readers, max(end - time.monotonic(), 0))
+            if self.event_queue._reader in ready:
+                self.drain()
+            if result_queue._reader in ready or time.monotonic() >= end:
+                return
+
+    def finish(self, process):
+        """Deliver the remaining events -- up to run_finished, or until process has exited and sent everything"""
+        while not self.finished:
+            try:
+                data = self.event_queue.get(timeout=0.1)
+            except queue.Empty:
+                if not process.is_alive():
+                    return
+                continue
+            self._deliver(data)
+
+
+def publish_kernel_event(event):
+    """with_events callback within kernels -- the event is sent to the calling process as display data"""
+    from IPython.display import publish_display_data
+
+    publish_display_data({EVENT_MIME_TYPE: encode_event(event).hex()})
+
+
+class KernelEventRelay(object):
+    """Turns the messages nbclient receives while executing a parameterized notebook into events
+
+    The first and last cells of a parameterized notebook pass parameters and return values -- they don't produce cell events.
+    """
+
+    def __init__(self, path_to_notebook, parameterized_notebook, on_event):
+        self.path_to_notebook = path_to_notebook
+        self.on_event = on_event
+        # index of each notebook cell among the code cells of the original notebook
+        self._code_cells = {}
+        cells = parameterized_notebook["cells"]
+        for index, cell in enumerate(cells[1:-1], 1):
+            if cell["cell_type"] == "code":
+                self._code_cells[index] = len(self._code_cells)
+        self._cell = None
+        self._started = None
+
+    def _emit(self, kind, cell, data=None):
+        self.on_event(NotebookEvent(kind, self.path_to_notebook, cell, time.time(), data, 0))
+
+    def attach(self, client):
+        """Hook into the cell and output callbacks of an nbclient NotebookClient"""
+        on_cell_execute = client.on_cell_execute
+        on_cell_executed = client.on_cell_executed
+        output = client.output
+
+        def _cell_started(**kwargs):
+            self._cell = self._code_cells.get(kwargs["cell_index"])
+            if self._cell is not None:
+                self._started = time.perf_counter()
+                self._emit("cell_started", self._cell)
+            if on_cell_execute is not None:
+                return on_cell_execute(**kwargs)
+
+        def _cell_executed(cell, cell_index, execute_reply):
+            if self._cell is not None:
+                content = execute_reply["content"] if execute_reply else {}
+                error = "{0}: {1}".format(content.get("ename"), content.get("evalue")) if content.get("status") == "error" else None
+                self._emit("cell_finished", self._cell, {"elapsed": time.perf_counter() - self._started, "error": error})
+            self._cell = None
+            if on_cell_executed is not None:
+                return on_cell_executed(cell=cell, cell_index=cell_index, execute_reply=execute_reply)
+
+        def _output(outs, msg, display_id, cell_index):
+            content = msg["content"]
+            if msg["msg_type"] == "display_data" and EVENT_MIME_TYPE in content.get("data", {}):
+                # events published within the kernel -- they aren't outputs of the cell
+                event = pickle.loads(bytes.fromhex(content["data"][EVENT_MIME_TYPE]))
+                if event.path_to_notebook is None:
+                    # emitted by the parameterized notebook's own cells rather than by a notebook they run
+                    event = event._replace(path_to_notebook=self.path_to_notebook, cell=self._cell)
+                self.on_event(event)
+                return None
+            if msg["msg_type"] == "stream" and self._cell is not None:
+                self._emit(content["name"], self._cell, content["text"][:MAX_STREAM_CHUNK])
+            return output(outs, msg, display_id, cell_index)
+
+        client.on_cell_execute = _cell_started
+        client.on_cell_executed = _cell_executed
+        client.output = _output
+        return self
+
+    def finish(self):
+        self._emit("run_finished", None)
@@ -0,0 +1,316 @@
+"""concurrent.futures and asyncio interfaces for subprocess and kernel notebook runs.
+
+The closures returned by run_notebook_in_process and run_notebook_in_jupyter can only block until the
+run is complete.  The functions in this module return NotebookFuture objects (or awaitables) instead,
+which support done(), result(timeout), cancel() and use with concurrent.futures.wait/as_completed or
+asyncio.gather/as_completed/wait_for.
+
+No thread is dedicated to an individual run: results of all subprocess runs are collected by a single
+monitor thread which waits on the result pipes and process sentinels of every in-flight run, and all
+kernel runs share one background event loop.
+"""
+
+import asyncio
+import atexit
+import concurrent.futures
+import contextlib
+import threading
+
+from ._main import _start_notebook_process, _module_from_namespace, _read_notebook_for_jupyter, _parameterize_notebook, _receive_jupyter_results, _jupyter_transport_directory
+from ._main import _run_deadline, _terminate_process, _kernel_timeouts, _raising_kernel_timeouts, _kernel_listeners, _finishing_listeners, NotebookScripterTimeoutError
+
+
+class NotebookFuture(concurrent.futures.Future):
+    """Future representing a notebook run -- cancel() terminates the subprocess or kernel executing the notebook"""
+
+    def __init__(self):
+        super().__init__()
+        self._stop_execution = None
+
+    def cancel(self):
+        if not super().cancel():
+            return False
+        if self._stop_execution is not None:
+            self._stop_execution()
+        return True
+
+
+def _resolve(future, err, value=None):
+    """Complete future unless it was cancelled in the meantime"""
+    try:
+        if err is not None:
+            future.set_exception(err)
+        else:
+            future.set_result(value)
+    except concurrent.futures.InvalidStateError:
+        pass
+
+
+class _WatchedProcess(object):
+    def __init__(self, path_to_notebook, process, parent_to_child_queue, child_to_parent_queue, future, deadline=None, events=None):
+        self.path_to_notebook = path_to_notebook
+        self.process = process
+        # keep both queues alive until the child exits -- the child may still be attaching to them
+        self.parent_to_child_queue = parent_to_child_queue
+        self.child_to_parent_queue = child_to_parent_queue
+        self.future = future
+        self.deadline = deadline
+        self.events = events
+        self.received = False
+
+    def receive(self, timeout=None):
+        err, final_namespace = self.child_to_parent_queue.get(timeout=timeout)
+        self.received = True
+        if self.events is not None:
+            # the last events are sent ahead of the result -- deliver them before the future completes
+            self.events.finish(self.process)
+        if err:
+            _resolve(self.future, err)
+        else:
+            _resolve(self.future, None, _module_from_namespace(self.path_to_notebook, final_namespace))
+
+
+class _ProcessMonitor(object):
+    """Collects the results of all in-flight subprocess runs on a single background thread"""
+
+    def __init__(self):
+        import multiprocessing as mp
+
+        self._lock = threading.Lock()
+        self._watched = []
+        self._wakeup_reader, self._wakeup_writer = mp.Pipe(duplex=False)
+        self._thread = threading.Thread(target=self._run, name="NotebookScripterProcessMonitor", daemon=True)
+        self._thread.start()
+
+    def watch(self, watched_process):
+        with self._lock:
+            self._watched.append(watched_process)
+            atexit.register(watched_process.process.terminate)
+        self._wakeup_writer.send_bytes(b"")
+
+    def _run(self):
+        import time
+        from multiprocessing.connection import wait
+
+        while True:
+            with self._lock:
+                watched = list(self._watched)
+
+            # runs past their deadline are terminated -- their sentinels then complete them below
+            now = time.monotonic()
+            deadlines = []
+            for watched_process in watched:
+                if watched_process.deadline is None or watched_process.received:
+                    continue
+                if watched_process.deadline <= now:
+                    watched_process.deadline = None
+                    _resolve(watched_process.future, NotebookScripterTimeoutError("Notebook subprocess didn't complete within the with_timeout limit"))
+                    _terminate_process(watched_process.process)
+                else:
+                    deadlines.append(watched_process.deadline)
+
+            waitables = [self._wakeup_reader]
+            for watched_process in watched:
+                waitables.append(watched_process.process.sentinel)
+                if not watched_process.received:
+                    # pylint: disable=protected-access
+                    waitables.append(watched_process.child_to_parent_queue._reader)
+                    if watched_process.events is not None and not watched_process.events.finished:
+                        waitables.append(watched_process.events.event_queue._reader)
+
+            ready = wait(waitables, timeout=min(deadlines) - now if deadlines else None)
+            if self._wakeup_reader in ready:
+                self._wakeup_reader.recv_bytes()
+
+            for watched_process in watched:
+                try:
+                    # pylint: disable=protected-access
+                    if watched_process.events is not None and watched_process.events.event_queue._reader in ready:
+                        watched_process.events.drain()
+
+                    # pylint: disable=protected-access
+                    if not watched_process.received and watched_process.child_to_parent_queue._reader in ready:
+                        watched_process.receive()
+
+                    if watched_process.process.sentinel in ready:
+                        self._finish(watched_process)
+                except Exception as e:  # pylint: disable=broad-except
+                    # a raising with_events callback or an unreadable result only fails this run
+                    self._abandon(watched_process, e)
+
+    def _abandon(self, watched_process, err):
+        """Fail the run with err and stop watching it"""
+        watched_process.received = True
+        _resolve(watched_process.future, err)
+        with self._lock:
+            if watched_process in self._watched:
+                self._watched.remove(watched_process)
+                atexit.unregister(watched_process.process.terminate)
+        _terminate_process(watched_process.process)
+
+    def _finish(self, watched_process):
+        import queue
+
+        if not watched_process.received:
+            try:
+                # the child may have exited right after flushing its result into the queue
+                watched_process.receive(timeout=1)
+            except queue.Empty:
+                pass
+            except Exception as e:
+                _resolve(watched_process.future, e)
+
+        if not watched_process.received:
+            exitcode = watched_process.process.exitcode
+            _resolve(watched_process.future, RuntimeError("Notebook subprocess exited unexpectedly with exit code {0}".format(exitcode)))
+
+        watched_process.process.join()
+        with self._lock:
+            self._watched.remove(watched_process)
+            atexit.unregister(watched_process.process.terminate)
+
+
+_PROCESS_MONITOR = None
+_BACKGROUND_LOOP = None
+_SINGLETON_LOCK = threading.Lock()
+
+
+def _process_monitor():
+    global _PROCESS_MONITOR
+    with _SINGLETON_LOCK:
+        if _PROCESS_MONITOR is None:
+            _PROCESS_MONITOR = _ProcessMonitor()
+        return _PROCESS_MONITOR
+
+
+def _background_loop():
+    """Event loop (running on a background thread) shared by all kernel runs started via run_notebook_in_jupyter_future"""
+    global _BACKGROUND_LOOP
+    with _SINGLETON_LOCK:
+        if _BACKGROUND_LOOP is None:
+            _BACKGROUND_LOOP = asyncio.new_event_loop()
+            threading.Thread(target=_BACKGROUND_LOOP.run_forever, name="NotebookScripterKernelLoop", daemon=True).start()
+        return _BACKGROUND_LOOP
+
+
+def run_notebook_in_process_future(path_to_notebook: str, **hooks):
+    """Asynchronously run a notebook in a new subprocess.
+
+    Like run_notebook_in_process the subprocess is started right away.  The returned closure accepts
+    the names of the values to retrieve and returns a NotebookFuture resolving to an (anonymous) python
+    module populated with the requested values.  Cancelling the future terminates the subprocess.
+
+    Args:
+        path_to_notebook: Path to .ipynb or .py file containing notebook code
+    Returns:
+        Returns a closure which when called with the names of values to retrieve returns a NotebookFuture
+    """
+    deadline = _run_deadline()
+    p, parent_to_child_queue, child_to_parent_queue, events = _start_notebook_process(path_to_notebook, hooks)
+
+    def _submit(*return_values):
+        future = NotebookFuture()
+        future._stop_execution = p.terminate
+
+        parent_to_child_queue.put(return_values)
+        _process_monitor().watch(_WatchedProcess(path_to_notebook, p, parent_to_child_queue, child_to_parent_queue, future, deadline, events))
+        return future
+
+    return _submit
+
+
+def run_notebook_in_process_async(path_to_notebook: str, **hooks):
+    """Asynchronously run a notebook in a new subprocess -- awaitable variant of run_notebook_in_process.
+
+    Returns a coroutine function which accepts the names of the values to retrieve.  Cancelling the
+    awaiting task (for example via asyncio.wait_for) terminates the subprocess.
+
+        module = await run_notebook_in_process_async("./Example.ipynb", a_useful_mode_switch="non_idiot_mode")("some_useful_value")
+
+    Args:
+        path_to_notebook: Path to .ipynb or .py file containing notebook code
+    Returns:
+        Returns a coroutine function which completes with an (anonymous) python module populated with the requested values
+    """
+    submit = run_notebook_in_process_future(path_to_notebook, **hooks)
+
+    async def _await_results(*return_values):
+        return await asyncio.wrap_future(submit(*return_values))
+
+    return _await_results
+
+
+async def _execute_in_kernel(parameterized_notebook, kernel_timeouts, listeners=()):
+    from nbclient import NotebookClient
+    from jupyter_client.kernelspec import NATIVE_KERNEL_NAME
+
+    # the client owns the kernel -- it is shut down when execution completes, fails or is cancelled.
+    # like run_notebook_in_jupyter, use the native python kernel rather than the notebook's kernelspec
+    timeouts, deadline = kernel_timeouts
+    client = NotebookClient(parameterized_notebook, kernel_name=NATIVE_KERNEL_NAME, **timeouts)
+    for listener in listeners:
+        listener.attach(client)
+    with _finishing_listeners(listeners), _raising_kernel_timeouts(deadline):
+        return await client.async_execute()
+
+
+def run_notebook_in_jupyter_async(path_to_notebook: str, **hooks):
+    """Run a notebook via a jupyter ipython kernel -- awaitable variant of run_notebook_in_jupyter.
+
+    Returns a coroutine function accepting the same arguments as the closure returned from
+    run_notebook_in_jupyter.  Cancelling the awaiting task shuts down the kernel.
+
+    Args:
+        path_to_notebook: Path to .ipynb or .py file containing notebook code
+    Returns:
+        Returns a coroutine function which completes with an (anonymous) python module populated with the requested values
+    """
+    notebook = _read_notebook_for_jupyter(path_to_notebook)
+
+    async def _await_results(*return_values, save_output_notebook=None):
+        with _jupyter_transport_directory() as transport_directory:
+            parameterized_notebook = _parameterize_notebook(notebook, hooks, return_values, transport_directory)
+            executed_notebook = await _execute_in_kernel(parameterized_notebook, _kernel_timeouts(), _kernel_listeners(path_to_notebook, parameterized_notebook, save_output_notebook))
+            return _receive_jupyter_results(path_to_notebook, executed_notebook, save_output_notebook, transport_directory)
+
+    return _await_results
+
+
+def run_notebook_in_jupyter_future(path_to_notebook: str, **hooks):
+    """Run a notebook via a jupyter ipython kernel, returning a NotebookFuture.
+
+    Returns a closure accepting the same arguments as the closure returned from run_notebook_in_jupyter.
+    The kernel run is started when the closure is called and executes on a shared background event
+    loop.  Cancelling the future shuts down the kernel.
+
+    Args:
+        path_to_notebook: Path to .ipynb or .py file containing notebook code
+    Returns:
+        Returns a closure which when called returns a NotebookFuture
+    """
+    notebook = _read_notebook_for_jupyter(path_to_notebook)
+
+    def _submit(*return_values, save_output_notebook=None):
+        # parameters (and options) are captured on the calling thread
+        cleanup = contextlib.ExitStack()
+        transport_directory = cleanup.enter_context(_jupyter_transport_directory())
+        parameterized_notebook = _parameterize_notebook(notebook, hooks, return_values, transport_directory)
+
+        future = NotebookFuture()
+        listeners = _kernel_listeners(path_to_notebook, parameterized_notebook, save_output_notebook)
+        execution = asyncio.run_coroutine_threadsafe(_execute_in_kernel(parameterized_notebook, _kernel_timeouts(), listeners), _background_loop())
+        future._stop_execution = execution.cancel
+
+        def _on_executed(execution):
+            with cleanup:
+                if execution.cancelled():
+                    return
+                try:
+                    _resolve(future, None, _receive_jupyter_results(path_to_notebook, execution.result(), save_output_notebook, transport_directory))
+                except Exception as e:
+                    _resolve(future, e)
+
+        execution.add_done_callback(_on_executed)
+        return future
+
+    return _submit
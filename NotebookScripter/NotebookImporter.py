@@ -0,0 +1,85 @@
+"""Import hook which makes notebooks importable with a regular `import` statement.
+
+Notebooks found on sys.path (or on a package's __path__) are executed via the same machinery used by
+run_notebook -- including the on-disk code cache -- so importing a notebook whose cache entry is warm
+costs about the same as importing a module from its .pyc file.
+
+    from NotebookScripter import install_notebook_importer
+    install_notebook_importer()
+    import Example  # executes ./Example.ipynb
+"""
+
+import importlib.abc
+import importlib.util
+import os
+import sys
+
+from ._main import execute_notebook_in_module
+
+
+class NotebookLoader(importlib.abc.Loader):
+    """Loader which executes a notebook file within the namespace of the module being imported"""
+
+    def __init__(self, fullname, path_to_notebook):
+        self.fullname = fullname
+        self.path_to_notebook = path_to_notebook
+
+    def create_module(self, spec):
+        # use the default module creation semantics
+        return None
+
+    def exec_module(self, module):
+        execute_notebook_in_module(module, self.path_to_notebook, {})
+
+    def get_filename(self, fullname):
+        return self.path_to_notebook
+
+
+class NotebookFinder(importlib.abc.MetaPathFinder):
+    """Meta path finder which locates notebook files for import
+
+    Args:
+        extensions: File extensions which should be considered importable notebooks
+    """
+
+    def __init__(self, extensions=(".ipynb",)):
+        self.extensions = tuple(extensions)
+
+    def find_spec(self, fullname, path, target=None):
+        name = fullname.rpartition(".")[2]
+        search_path = sys.path if path is None else path
+
+        for entry in search_path:
+            if not isinstance(entry, str):
+                continue
+            for extension in self.extensions:
+                candidate = os.path.join(entry or os.getcwd(), name + extension)
+                if os.path.isfile(candidate):
+                    loader = NotebookLoader(fullname, candidate)
+                    return importlib.util.spec_from_file_location(fullname, candidate, loader=loader)
+        return None
+
+
+def install_notebook_importer(extensions=(".ipynb",)):
+    """Make notebook files importable via `import`
+
+    The finder is appended to sys.meta_path so that regular python modules always take precedence over
+    notebooks with the same name.
+
+    Args:
+        extensions: File extensions which should be considered importable notebooks
+    Returns:
+        The installed NotebookFinder -- pass it to uninstall_notebook_importer to remove it again
+    """
+    finder = NotebookFinder(extensions)
+    sys.meta_path.append(finder)
+    return finder
+
+
+def uninstall_notebook_importer(finder=None):
+    """Remove notebook finders from sys.meta_path
+
+    Args:
+        finder: The finder to remove -- if None all installed NotebookFinder instances are removed
+    """
+    sys.meta_path[:] = [f for f in sys.meta_path if not (f is finder or (finder is None and isinstance(f, NotebookFinder)))]
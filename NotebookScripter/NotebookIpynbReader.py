@@ -0,0 +1,240 @@
+"""Lean reader for .ipynb files.
+
+nbformat.read parses the whole json document into NotebookNode objects and validates it against the
+notebook schema -- including base64 encoded images, html tables and other stored outputs which
+executing the notebook never looks at.  The reader in this module walks the json text of the file
+(memory mapped) and only decodes the parts needed for execution: the source, type, id and metadata of
+each cell and the notebook's metadata.  Everything else (outputs, attachments, execution counts) is
+skipped over without being decoded, so load time and memory scale with the code rather than with the
+stored outputs.
+
+Schema validation is optional (the with_notebook_validation option) -- validating notebooks, and
+notebooks in a format other than v4, are read via nbformat.
+"""
+
+import collections
+import contextlib
+import io
+import json
+import mmap
+import re
+
+NotebookCell = collections.namedtuple("NotebookCell", ["cell_type", "source", "metadata", "id", "attachments"])
+
+LeanNotebook = collections.namedtuple("LeanNotebook", ["nbformat", "nbformat_minor", "metadata", "cells"])
+
+# keys of a cell which are decoded -- the values of all other keys are skipped
+_CELL_KEYS = ("cell_type", "source", "metadata", "id")
+_CELL_KEYS_WITH_ATTACHMENTS = _CELL_KEYS + ("attachments",)
+
+# transient metadata nbformat strips when reading notebooks
+_TRANSIENT_METADATA = ("orig_nbformat", "orig_nbformat_minor", "signature")
+
+_WHITESPACE = re.compile(rb"[ \t\n\r]*")
+_SCALAR = re.compile(rb"-?[0-9][0-9.eE+-]*|true|false|null")
+_STRUCTURE = re.compile(rb'[][{}"]')
+
+
+class _Scanner(object):
+    """Walks the json text in buffer -- values are either decoded (value) or skipped (skip_value)"""
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.position = 3 if buffer[:3] == b"\xef\xbb\xbf" else 0
+
+    def _error(self, expected):
+        return ValueError("Invalid notebook json -- expected {0} at byte {1}".format(expected, self.position))
+
+    def _skip_whitespace(self):
+        self.position = _WHITESPACE.match(self.buffer, self.position).end()
+
+    def _peek(self):
+        self._skip_whitespace()
+        return self.buffer[self.position:self.position + 1]
+
+    def _expect(self, char):
+        if self._peek() != char:
+            raise self._error(char.decode())
+        self.position += 1
+
+    def _skip_string(self, position):
+        # find (memchr speed) the closing quote -- a quote preceded by an odd number of backslashes is escaped
+        end = position
+        while True:
+            end = self.buffer.find(b'"', end + 1)
+            if end < 0:
+                raise self._error("the end of a string")
+            backslashes = 0
+            while self.buffer[end - 1 - backslashes] == 0x5c:
+                backslashes += 1
+            if backslashes % 2 == 0:
+                return end + 1
+
+    def skip_value(self):
+        char = self._peek()
+        if char == b'"':
+            self.position = self._skip_string(self.position)
+        elif char in (b"{", b"["):
+            depth = 0
+            while True:
+                match = _STRUCTURE.search(self.buffer, self.position)
+                if match is None:
+                    raise self._error("the end of an object or array")
+                if match.group() == b'"':
+                    self.position = self._skip_string(match.start())
+                    continue
+                self.position = match.end()
+                depth += 1 if match.group() in (b"{", b"[") else -1
+                if depth == 0:
+                    return
+        else:
+            match = _SCALAR.match(self.buffer, self.position)
+            if match is None:
+                raise self._error("a value")
+            self.position = match.end()
+
+    def value(self):
+        self._skip_whitespace()
+        start = self.position
+        self.skip_value()
+        return json.loads(self.buffer[start:self.position])
+
+    def members(self):
+        """Iterate over the keys of an object -- the caller consumes each key's value via value() or skip_value()"""
+        self._expect(b"{")
+        if self._peek() == b"}":
+            self.position += 1
+            return
+        while True:
+            self._peek()
+            key = self.value()
+            self._expect(b":")
+            yield key
+            char = self._peek()
+            self.position += 1
+            if char == b"}":
+                return
+            if char != b",":
+                raise self._error("',' or '}'")
+
+    def items(self):
+        """Iterate over the items of an array -- the caller consumes each item"""
+        self._expect(b"[")
+        if self._peek() == b"]":
+            self.position += 1
+            return
+        while True:
+            yield
+            char = self._peek()
+            self.position += 1
+            if char == b"]":
+                return
+            if char != b",":
+                raise self._error("',' or ']'")
+
+
+def _source_text(source):
+    return source if isinstance(source, str) else "".join(source)
+
+
+def _read_cell(scanner, cell_keys):
+    values = {}
+    for key in scanner.members():
+        if key in cell_keys:
+            values[key] = scanner.value()
+        else:
+            scanner.skip_value()
+    values.get("metadata", {}).pop("trusted", None)
+    return NotebookCell(values.get("cell_type"), _source_text(values.get("source", "")), values.get("metadata", {}), values.get("id"), values.get("attachments"))
+
+
+def _from_notebook_node(notebook, with_attachments):
+    cells = [
+        NotebookCell(cell.cell_type, cell.source, cell.get("metadata", {}), cell.get("id"), cell.get("attachments") if with_attachments else None)
+        for cell in notebook.cells
+    ]
+    return LeanNotebook(notebook.nbformat, notebook.nbformat_minor, notebook.metadata, cells)
+
+
+def _read_with_nbformat(buffer, validate, with_attachments):
+    import nbformat
+
+    notebook = nbformat.reads(bytes(buffer).decode("utf-8-sig"), 4)
+    if validate:
+        nbformat.validate(notebook)
+    return _from_notebook_node(notebook, with_attachments)
+
+
+def reads_lean_notebook(buffer, validate=False, with_attachments=False):
+    """Read the cells and metadata of a notebook from the bytes (or memory map) holding its json text
+
+    Args:
+        buffer: Bytes-like object holding the .ipynb json
+        validate: Validate the notebook against the notebook schema (via nbformat) -- raises nbformat.ValidationError
+        with_attachments: Also decode the attachments (images embedded in markdown cells) of cells
+    Returns:
+        A LeanNotebook of NotebookCell tuples -- sources of cells stored as lists of lines are joined
+    """
+    if validate:
+        return _read_with_nbformat(buffer, validate, with_attachments)
+
+    cell_keys = _CELL_KEYS_WITH_ATTACHMENTS if with_attachments else _CELL_KEYS
+
+    scanner = _Scanner(buffer)
+    values = {}
+    cells = None
+    for key in scanner.members():
+        if key == "cells":
+            cells = []
+            for _ in scanner.items():
+                cells.append(_read_cell(scanner, cell_keys))
+        elif key in ("metadata", "nbformat", "nbformat_minor"):
+            values[key] = scanner.value()
+        else:
+            scanner.skip_value()
+
+    if cells is None or values.get("nbformat") != 4:
+        # older formats are converted by nbformat
+        return _read_with_nbformat(buffer, validate, with_attachments)
+
+    metadata = values.get("metadata", {})
+    for name in _TRANSIENT_METADATA:
+        metadata.pop(name, None)
+    return LeanNotebook(4, values.get("nbformat_minor", 0), metadata, cells)
+
+
+@contextlib.contextmanager
+def mapped_file(path):
+    """Memory map the file at path (read only) -- yields an empty bytes object for empty files"""
+    with io.open(path, "rb") as f:
+        try:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty files can't be mapped
+            yield b""
+            return
+        with mapped:
+            yield mapped
+
+
+def read_lean_notebook(path_to_notebook, validate=False, with_attachments=False):
+    """Read the cells and metadata of the .ipynb file at path_to_notebook -- see reads_lean_notebook"""
+    with mapped_file(path_to_notebook) as buffer:
+        return reads_lean_notebook(buffer, validate, with_attachments)
+
+
+def to_notebook_node(lean_notebook):
+    """Convert a LeanNotebook into an nbformat v4 NotebookNode -- code cells have no outputs"""
+    from nbformat.v4 import new_code_cell, new_markdown_cell, new_raw_cell, new_notebook
+
+    constructors = {"code": new_code_cell, "markdown": new_markdown_cell, "raw": new_raw_cell}
+    cells = []
+    for cell in lean_notebook.cells:
+        node = constructors[cell.cell_type](source=cell.source, metadata=cell.metadata)
+        if cell.id is not None:
+            node.id = cell.id
+        if cell.attachments and cell.cell_type != "code":
+            node.attachments = cell.attachments
+        cells.append(node)
+
+    return new_notebook(cells=cells, metadata=lean_notebook.metadata)
@@ -0,0 +1,236 @@
+"""Pool of warm jupyter kernels for running notebooks.
+
+Each call of the closure returned by run_notebook_in_jupyter starts a new kernel and shuts it down once
+the notebook has executed -- for short notebooks most of the time is spent on kernel startup and
+shutdown.  A NotebookKernelPool starts its kernels once and reuses them: between runs the kernel's user
+namespace is reset, and after a configurable number of runs the kernel is restarted.  The number of
+kernels also caps the number of notebooks executing concurrently.
+"""
+
+import atexit
+import queue
+import threading
+
+from ._main import _read_notebook_for_jupyter, _parameterize_notebook, _receive_jupyter_results, _jupyter_transport_directory, _run_timeouts, _kernel_listeners, _finishing_listeners, NotebookScripterTimeoutError
+
+# silently clears the user namespace left behind by the previous run -- imported modules stay loaded
+RESET_NAMESPACE_SOURCE = "get_ipython().reset(new_session=False)"
+
+
+class _PooledKernel(object):
+    def __init__(self, kernel_name, startup_timeout):
+        from jupyter_client import KernelManager
+
+        self.startup_timeout = startup_timeout
+        self.km = KernelManager(kernel_name=kernel_name)
+        self.km.start_kernel()
+        self.kc = self.km.client()
+        self.kc.start_channels()
+        self.kc.wait_for_ready(timeout=startup_timeout)
+        self.uses = 0
+
+    def is_alive(self):
+        return self.km.is_alive()
+
+    def reset(self):
+        reply = self.kc.execute_interactive(RESET_NAMESPACE_SOURCE, silent=True, store_history=False, timeout=self.startup_timeout)
+        if reply["content"]["status"] != "ok":
+            raise RuntimeError("Failed to reset kernel namespace: {0}".format(reply["content"]))
+
+    def restart(self):
+        self.km.restart_kernel(now=True)
+        self.kc.wait_for_ready(timeout=self.startup_timeout)
+        self.uses = 0
+
+    def shutdown(self):
+        self.kc.stop_channels()
+        if self.km.has_kernel:
+            self.km.shutdown_kernel(now=True)
+
+
+class _KernelWatchdog(object):
+    """Interrupts a pooled kernel once a cell runs past with_cell_timeout or the run passes with_timeout
+
+    nbclient's own timeouts only work with asynchronous kernel clients -- the pool's long lived clients are
+    blocking.  An interrupted cell raises KeyboardInterrupt within the kernel, which ends the execution.
+    """
+
+    def __init__(self, km, cell_timeout, deadline):
+        self.km = km
+        self.cell_timeout = cell_timeout
+        self.deadline = deadline
+        self.fired = None
+        self._cell_deadline = None
+        self._stopped = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="NotebookScripterKernelWatchdog", daemon=True)
+        self._thread.start()
+
+    def cell_started(self, **kwargs):
+        """nbclient's on_cell_execute hook"""
+        import time
+
+        if self.cell_timeout:
+            with self._condition:
+                self._cell_deadline = time.monotonic() + self.cell_timeout
+                self._condition.notify()
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        self._thread.join()
+
+    def _run(self):
+        import time
+
+        with self._condition:
+            while not self._stopped:
+                deadlines = [deadline for deadline in (self.deadline, self._cell_deadline) if deadline is not None]
+                remaining = min(deadlines) - time.monotonic() if deadlines else None
+                if remaining is None or remaining > 0:
+                    self._condition.wait(remaining)
+                    continue
+                self.fired = "with_timeout" if self.deadline is not None and time.monotonic() >= self.deadline else "with_cell_timeout"
+                break
+            else:
+                return
+        self.km.interrupt_kernel()
+
+
+class NotebookKernelPool(object):
+    """A pool of running jupyter kernels which execute notebooks
+
+    Args:
+        kernels: Number of kernels -- and so the maximum number of concurrently executing notebooks
+        max_uses_per_kernel: Number of notebook runs after which a kernel is restarted -- None means kernels are only restarted when they die
+        kernel_name: Name of the kernelspec used to start kernels -- defaults to the native python kernel (as used by run_notebook_in_jupyter)
+        startup_timeout: Seconds to wait for a kernel to become ready
+    """
+
+    def __init__(self, kernels=1, max_uses_per_kernel=None, kernel_name=None, startup_timeout=60):
+        from jupyter_client.kernelspec import NATIVE_KERNEL_NAME
+
+        if kernels < 1:
+            raise ValueError("Number of kernels must be at least 1")
+        if max_uses_per_kernel is not None and max_uses_per_kernel < 1:
+            raise ValueError("max_uses_per_kernel must be None or a positive integer")
+
+        self.kernels = kernels
+        self.max_uses_per_kernel = max_uses_per_kernel
+        self.kernel_name = kernel_name or NATIVE_KERNEL_NAME
+        self.startup_timeout = startup_timeout
+
+        self._lock = threading.Lock()
+        self._closed = False
+        self._kernels = []
+        self._idle_kernels = queue.Queue()
+        for _ in range(kernels):
+            self._idle_kernels.put(self._start_kernel())
+
+        atexit.register(self.shutdown)
+
+    def _start_kernel(self):
+        kernel = _PooledKernel(self.kernel_name, self.startup_timeout)
+        with self._lock:
+            self._kernels.append(kernel)
+        return kernel
+
+    def _acquire_kernel(self):
+        while True:
+            if self._closed:
+                raise ValueError("NotebookKernelPool is shut down")
+            try:
+                return self._idle_kernels.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+    def _release_kernel(self, kernel, restart=False):
+        if self._closed:
+            return
+
+        try:
+            kernel.uses += 1
+            if restart or not kernel.is_alive() or (self.max_uses_per_kernel is not None and kernel.uses >= self.max_uses_per_kernel):
+                kernel.restart()
+            else:
+                kernel.reset()
+        except Exception:
+            # replace kernels which can't be reset or restarted
+            with self._lock:
+                if kernel in self._kernels:
+                    self._kernels.remove(kernel)
+            kernel.shutdown()
+            kernel = self._start_kernel()
+        self._idle_kernels.put(kernel)
+
+    def _execute(self, parameterized_notebook, listeners=()):
+        from nbclient import NotebookClient
+
+        kernel = self._acquire_kernel()
+        watchdog = None
+        try:
+            if not kernel.is_alive():
+                kernel.restart()
+            cell_timeout, deadline = _run_timeouts()
+            client = NotebookClient(parameterized_notebook, timeout=None, km=kernel.km)
+            if cell_timeout or deadline is not None:
+                watchdog = _KernelWatchdog(kernel.km, cell_timeout, deadline)
+                client.on_cell_execute = watchdog.cell_started
+            for listener in listeners:
+                listener.attach(client)
+            # reuse the kernel's long lived client -- the NotebookClient doesn't own (or clean up) either of them
+            client.kc = kernel.kc
+            try:
+                with _finishing_listeners(listeners):
+                    return client.execute()
+            finally:
+                if watchdog:
+                    watchdog.stop()
+        except Exception as e:
+            if watchdog and watchdog.fired == "with_timeout":
+                raise NotebookScripterTimeoutError("Notebook kernel run didn't complete within the with_timeout limit") from e
+            if watchdog and watchdog.fired:
+                raise NotebookScripterTimeoutError("Notebook cell exceeded the with_cell_timeout limit") from e
+            raise
+        finally:
+            # restart kernels which were interrupted -- the interrupt may have hit code outside of the notebook's cells
+            self._release_kernel(kernel, restart=bool(watchdog and watchdog.fired))
+
+    def run_notebook_in_jupyter(self, path_to_notebook: str, **hooks):
+        """Run a notebook on one of the pool's kernels.
+
+        Behaves like NotebookScripter.run_notebook_in_jupyter -- the returned closure blocks until a
+        kernel is idle and the notebook has executed, and accepts the same arguments.
+
+        Args:
+            path_to_notebook: Path to .ipynb or .py file containing notebook code
+        Returns:
+            Returns a closure which will block until the notebook execution completes then return a newly created (anonymous) python module
+            populated with requested values retrieved from the kernel
+        """
+        notebook = _read_notebook_for_jupyter(path_to_notebook)
+
+        def _block_and_receive_results(*return_values, save_output_notebook=None):
+            with _jupyter_transport_directory() as transport_directory:
+                parameterized_notebook = _parameterize_notebook(notebook, hooks, return_values, transport_directory)
+                executed_notebook = self._execute(parameterized_notebook, _kernel_listeners(path_to_notebook, parameterized_notebook, save_output_notebook))
+                return _receive_jupyter_results(path_to_notebook, executed_notebook, save_output_notebook, transport_directory)
+
+        return _block_and_receive_results
+
+    def shutdown(self):
+        """Shut down all kernels -- kernels executing a notebook are shut down immediately"""
+        self._closed = True
+        with self._lock:
+            kernels = list(self._kernels)
+            self._kernels = []
+        for kernel in kernels:
+            kernel.shutdown()
+        atexit.unregister(self.shutdown)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
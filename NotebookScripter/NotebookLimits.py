@@ -0,0 +1,100 @@
+"""Cell timeouts and resource limits enforced within the process executing a notebook.
+
+with_cell_timeout is enforced with a SIGALRM timer armed around each cell -- the signal handler raises
+NotebookScripterTimeoutError within the cell.  Python only runs signal handlers on the main thread (and
+between bytecodes), so cell timeouts apply to notebooks executing on the main thread of a process --
+subprocess runs and process pool workers.  A cell blocked in native code is interrupted once that code
+returns; the with_timeout option (enforced by the calling process, which terminates the subprocess) covers
+runs which never return.
+
+with_memory_limit and with_cpu_time_limit set the soft RLIMIT_AS and RLIMIT_CPU limits of the process.
+Exceeding the address space limit makes allocations fail with MemoryError.  Exceeding the cpu time limit
+delivers SIGXCPU -- its handler lifts the soft limit (so the signal isn't repeated) and raises
+NotebookScripterTimeoutError.  The cpu time limit counts from the start of the run, so workers which run
+one notebook after another get the full limit for each run.
+"""
+
+import contextlib
+import signal
+import threading
+import time
+
+from ._main import NotebookScripterTimeoutError
+
+# soft limits of the process before any limit was applied -- {resource: soft limit}
+_original_soft_limits = {}
+
+
+def _raise_cell_timeout(seconds):
+    def _handler(signum, frame):
+        raise NotebookScripterTimeoutError(f"Notebook cell exceeded the cell timeout of {seconds} seconds")
+    return _handler
+
+
+@contextlib.contextmanager
+def cell_timeout(seconds):
+    """Raise NotebookScripterTimeoutError within the block once it has run for seconds -- only enforced on the main thread of POSIX systems"""
+    if not seconds or not hasattr(signal, "setitimer") or threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
+    previous_handler = signal.signal(signal.SIGALRM, _raise_cell_timeout(seconds))
+    # a notebook run by a cell of another notebook arms its own timer -- the outer cell's timer resumes afterwards
+    previous_remaining, previous_interval = signal.setitimer(signal.ITIMER_REAL, seconds)
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous_handler)
+        if previous_remaining:
+            # fire right away if the outer timer ran out while this cell executed
+            signal.setitimer(signal.ITIMER_REAL, max(previous_remaining - (time.monotonic() - started), 0.001), previous_interval)
+
+
+def _set_soft_limit(resource_module, limit, soft_limit):
+    current_soft_limit, hard_limit = resource_module.getrlimit(limit)
+    _original_soft_limits.setdefault(limit, current_soft_limit)
+    if soft_limit is None:
+        soft_limit = _original_soft_limits[limit]
+    elif hard_limit != resource_module.RLIM_INFINITY:
+        soft_limit = min(soft_limit, hard_limit)
+    resource_module.setrlimit(limit, (soft_limit, hard_limit))
+
+
+def _cpu_time_exceeded(seconds):
+    def _handler(signum, frame):
+        import resource
+
+        # stop further SIGXCPU signals -- the hard limit (if any) still applies
+        _set_soft_limit(resource, resource.RLIMIT_CPU, None)
+        raise NotebookScripterTimeoutError(f"Notebook exceeded the cpu time limit of {seconds} seconds")
+    return _handler
+
+
+def apply_resource_limits(memory_limit, cpu_time_limit):
+    """Set (or, for None, reset) the soft address space and cpu time limits of the current process
+
+    Args:
+        memory_limit: Maximum size of the address space in bytes
+        cpu_time_limit: Maximum number of cpu seconds used from now on
+    """
+    try:
+        import resource
+    except ImportError:
+        if memory_limit is None and cpu_time_limit is None:
+            return
+        raise ValueError("Resource limits require POSIX resource limits (the resource module)")
+
+    _set_soft_limit(resource, resource.RLIMIT_AS, memory_limit)
+
+    if cpu_time_limit is None:
+        _set_soft_limit(resource, resource.RLIMIT_CPU, None)
+        return
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    used = usage.ru_utime + usage.ru_stime
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGXCPU, _cpu_time_exceeded(cpu_time_limit))
+    # RLIMIT_CPU has a resolution of whole seconds
+    _set_soft_limit(resource, resource.RLIMIT_CPU, int(used + cpu_time_limit + 0.999))
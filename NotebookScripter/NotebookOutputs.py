@@ -0,0 +1,238 @@
+"""Handling of the outputs of kernel runs as they arrive (the with_jupyter_outputs and with_output_sidecars options).
+
+nbclient appends every output message of a cell to the in-memory notebook -- including images, html
+and widget payloads which are never looked at when the executed notebook isn't saved.  In lean mode
+only what the run needs is kept: the output of the last cell (which carries the return values) plus
+errors and the tail of each cell's stdout/stderr (used in the messages of failed runs).
+
+When the executed notebook is saved, binary outputs (images, pdfs) can be written to sidecar files in
+a "<notebook name>_files" directory next to it -- as they arrive, so the decoded payloads aren't kept in
+memory.  The output keeps its text representations and links to the sidecar file from text/html, and
+records the file in its "filenames" metadata like nbconvert's extracted outputs.
+
+A saved output notebook is also written while the kernel runs: each cell is serialized once, when it
+has executed, and a background thread atomically replaces the file with the cells serialized so far
+(at most once per with_output_notebook_interval seconds).  A run which fails or times out leaves the
+outputs of the cells executed up to then on disk -- a completed run ends with the usual nbformat write.
+"""
+
+import base64
+import mimetypes
+import os
+import tempfile
+import threading
+import time
+
+# number of trailing stdout/stderr characters kept for each cell in lean mode
+LEAN_STREAM_CHARS = 10000
+
+# binary mime types which aren't images -- image types other than svg are all binary
+_BINARY_MIME_TYPES = ("application/pdf",)
+
+# extensions of mime types mimetypes doesn't know (or guesses badly)
+_EXTENSIONS = {"image/jpeg": ".jpg", "image/webp": ".webp"}
+
+
+def _is_binary(mime_type):
+    return (mime_type.startswith("image/") and mime_type != "image/svg+xml") or mime_type in _BINARY_MIME_TYPES
+
+
+def sidecar_directory_for(path_to_output_notebook):
+    """Return the directory holding the sidecar files of an output notebook"""
+    return os.path.splitext(path_to_output_notebook)[0] + "_files"
+
+
+class LeanOutputs(object):
+    """Keeps only the outputs of the cells in keep_cells -- other cells keep errors and the tail of their stdout/stderr"""
+
+    def __init__(self, keep_cells):
+        self.keep_cells = set(keep_cells)
+
+    def attach(self, client):
+        output = client.output
+
+        def _output(outs, msg, display_id, cell_index):
+            msg_type = msg["msg_type"]
+            if cell_index in self.keep_cells or msg_type == "error":
+                return output(outs, msg, display_id, cell_index)
+            if msg_type != "stream":
+                return None
+
+            content = msg["content"]
+            if outs and outs[-1].get("output_type") == "stream" and outs[-1].get("name") == content["name"]:
+                # extend the cell's last stream output rather than adding outputs
+                outs[-1]["text"] = (outs[-1]["text"] + content["text"])[-LEAN_STREAM_CHARS:]
+                return outs[-1]
+            out = output(outs, msg, display_id, cell_index)
+            if out is not None:
+                out["text"] = out["text"][-LEAN_STREAM_CHARS:]
+            return out
+
+        client.output = _output
+        return self
+
+    def finish(self):
+        pass
+
+
+class OutputSidecars(object):
+    """Writes binary outputs of at least min_bytes to sidecar files of the output notebook at path_to_output_notebook"""
+
+    def __init__(self, path_to_output_notebook, min_bytes=0):
+        self.directory = sidecar_directory_for(path_to_output_notebook)
+        # sidecar paths are stored relative to the output notebook
+        self.relative_directory = os.path.basename(self.directory)
+        self.min_bytes = min_bytes
+        self._counts = {}
+
+    def _write(self, cell_index, mime_type, payload):
+        output_number = self._counts.get(cell_index, 0)
+        self._counts[cell_index] = output_number + 1
+        extension = _EXTENSIONS.get(mime_type) or mimetypes.guess_extension(mime_type) or ".bin"
+        filename = "output_{0}_{1}{2}".format(cell_index, output_number, extension)
+
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, filename), "wb") as f:
+            f.write(payload)
+        return self.relative_directory + "/" + filename
+
+    def _extract(self, out, cell_index):
+        data = out.get("data", {})
+        filenames = {}
+        for mime_type in [mime_type for mime_type in data if _is_binary(mime_type)]:
+            encoded = data[mime_type]
+            if not isinstance(encoded, str) or len(encoded) * 3 // 4 < self.min_bytes:
+                continue
+            filenames[mime_type] = self._write(cell_index, mime_type, base64.b64decode(encoded))
+            del data[mime_type]
+
+        if filenames:
+            out.setdefault("metadata", {})["filenames"] = filenames
+            if "text/html" not in data:
+                links = []
+                for mime_type, filename in filenames.items():
+                    if mime_type.startswith("image/"):
+                        links.append('<img src="{0}"/>'.format(filename))
+                    else:
+                        links.append('<a href="{0}">{0}</a>'.format(filename))
+                data["text/html"] = "\n".join(links)
+
+    def attach(self, client):
+        output = client.output
+
+        def _output(outs, msg, display_id, cell_index):
+            out = output(outs, msg, display_id, cell_index)
+            if out is not None and msg["msg_type"] in ("display_data", "execute_result"):
+                self._extract(out, cell_index)
+            return out
+
+        client.output = _output
+        return self
+
+    def finish(self):
+        pass
+
+
+def write_atomic(path, write):
+    """Write a file by calling write with a file object open on a temporary file which then replaces path"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix="." + os.path.basename(path) + ".")
+    try:
+        with open(fd, "w", encoding="utf-8") as f:
+            write(f)
+        # readers see either the previous or the new content -- never a partial file
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+def _serialize_cell(cell):
+    """Serialize a cell the way nbformat writes cells"""
+    import copy
+    import json
+    from nbformat import NotebookNode
+    from nbformat.v4.rwbase import split_lines
+    from nbformat.v4.nbjson import BytesEncoder
+
+    cell = split_lines(NotebookNode(cells=[copy.deepcopy(cell)])).cells[0]
+    return json.dumps(cell, cls=BytesEncoder, indent=1, sort_keys=True, separators=(",", ": "), ensure_ascii=False)
+
+
+class IncrementalNotebookWriter(object):
+    """Writes the notebook executing on an nbclient NotebookClient to path after cells have executed
+
+    Args:
+        path: Path of the output notebook
+        notebook: The (parameterized) notebook being executed
+        interval: Minimum number of seconds between writes
+    """
+
+    def __init__(self, path, notebook, interval):
+        import json
+
+        self.path = path
+        self.interval = interval
+        self._cells = [_serialize_cell(cell) for cell in notebook["cells"]]
+        self._header = '{\n "cells": [\n'
+        self._footer = '\n ],\n "metadata": %s,\n "nbformat": %d,\n "nbformat_minor": %d\n}\n' % (
+            json.dumps(notebook.get("metadata", {}), sort_keys=True, ensure_ascii=False), notebook["nbformat"], notebook["nbformat_minor"])
+        self._pending = None
+        self._stopped = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="NotebookScripterNotebookWriter", daemon=True)
+
+    def attach(self, client):
+        self._thread.start()
+        on_cell_executed = client.on_cell_executed
+
+        def _cell_executed(**kwargs):
+            # only the executed cell is serialized on the client's thread -- writing happens in the background
+            self._cells[kwargs["cell_index"]] = _serialize_cell(kwargs["cell"])
+            with self._condition:
+                self._pending = list(self._cells)
+                self._condition.notify()
+            if on_cell_executed is not None:
+                return on_cell_executed(**kwargs)
+
+        client.on_cell_executed = _cell_executed
+        return self
+
+    def _write(self, cells):
+        write_atomic(self.path, lambda f: f.write(self._header + ",\n".join(cells) + self._footer))
+
+    def _run(self):
+        last_write = None
+        while True:
+            with self._condition:
+                while self._pending is None and not self._stopped:
+                    self._condition.wait()
+                if self._stopped:
+                    return
+                if last_write is not None and time.monotonic() - last_write < self.interval:
+                    # let later cells supersede this snapshot -- unless the run finishes first
+                    self._condition.wait(self.interval - (time.monotonic() - last_write))
+                    continue
+                cells, self._pending = self._pending, None
+            try:
+                self._write(cells)
+            except OSError:
+                # partial results are best effort -- the final write reports errors
+                pass
+            last_write = time.monotonic()
+
+    def finish(self):
+        """Stop writing in the background and write the last snapshot -- the outputs of a failed run stay on disk"""
+        if not self._thread.is_alive():
+            return
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        self._thread.join()
+        if self._pending is not None:
+            try:
+                self._write(self._pending)
+            except OSError:
+                # like the background writes -- the final nbformat write of a completed run reports errors
+                pass
+            self._pending = None
@@ -0,0 +1,209 @@
+"""Pipelines of notebooks whose returned values feed the parameters of other notebooks.
+
+A NotebookPipeline is a directed acyclic graph: each node is a notebook path plus parameters, and each
+edge passes a value returned by one node to a receive_parameter() parameter of another.  Nodes run
+on the worker processes of a NotebookProcessPool as soon as the nodes they depend on have completed,
+so independent branches run in parallel.  Intermediate values are passed through the calling process
+using the process transport (set with_process_transport="shared_memory" to move large buffers through
+shared memory) -- only the values named by edges and by return_values are transferred.
+
+Each node has a fingerprint covering the notebook's content, its parameters, the parameters and notebook
+options of the frames enclosing the call to run (which apply to every node) and the fingerprints of the
+nodes it depends on.  When a pipeline is run again, nodes whose fingerprint is unchanged are not re-run
+-- their modules from the previous run are reused.  Nodes whose parameters can't be hashed always run.
+"""
+
+import collections
+import contextvars
+
+from .NotebookProcessPool import NotebookProcessPool
+from .NotebookResultCache import stable_hash, result_frames, _notebook_hash, _Unhashable
+from ._main import _current_parameter_frames
+
+# a node of a pipeline -- inputs maps parameter names to (node, returned name) pairs
+PipelineNode = collections.namedtuple("PipelineNode", ["name", "path_to_notebook", "parameters", "inputs", "return_values"])
+
+
+class NotebookPipelineError(Exception):
+    """Raised by NotebookPipeline.run when a node fails -- the node's exception is the __cause__"""
+
+    def __init__(self, node):
+        super().__init__("Pipeline node {0!r} failed".format(node))
+        self.node = node
+
+
+def _parse_input(source):
+    if isinstance(source, str):
+        node, _, returned_name = source.partition(".")
+        if not returned_name:
+            raise ValueError("Pipeline inputs given as strings must have the form 'node.returned_name': {0!r}".format(source))
+        return node, returned_name
+    node, returned_name = source
+    return node, returned_name
+
+
+class NotebookPipeline(object):
+    """A graph of notebook runs -- the values returned by nodes are passed as parameters to downstream nodes
+
+        pipeline = NotebookPipeline()
+        pipeline.add_node("load", "./Load.ipynb", parameters={"source": "data.csv"})
+        pipeline.add_node("clean", "./Clean.ipynb", inputs={"raw": ("load", "frame")})
+        pipeline.add_node("report", "./Report.ipynb", inputs={"table": "clean.frame"}, return_values=["summary"])
+        modules = pipeline.run(processes=4)
+        print(modules["report"].summary)
+    """
+
+    def __init__(self):
+        self._nodes = collections.OrderedDict()
+        # modules of the last run -- {node name: (fingerprint, module)}
+        self._completed = {}
+
+    def add_node(self, name, path_to_notebook, parameters=None, inputs=None, return_values=()):
+        """Add a notebook run to the pipeline
+
+        Args:
+            name: Name of the node -- used to refer to it in the inputs of other nodes and in the result of run
+            path_to_notebook: Path to .ipynb or .py file containing notebook code
+            parameters: Dict of constant parameters passed to the node
+            inputs: Dict mapping parameter names of this node to the values returned by other nodes -- given as
+                (node, returned name) pairs or "node.returned_name" strings
+            return_values: Names of values to retrieve from the node in addition to those passed to downstream nodes
+        """
+        if name in self._nodes:
+            raise ValueError("Pipeline already has a node named {0!r}".format(name))
+        inputs = {parameter: _parse_input(source) for parameter, source in (inputs or {}).items()}
+        self._nodes[name] = PipelineNode(name, path_to_notebook, dict(parameters or {}), inputs, tuple(return_values))
+        return self
+
+    @property
+    def nodes(self):
+        return list(self._nodes.values())
+
+    def _execution_order(self):
+        """Return the node names in topological order -- raises ValueError for unknown nodes and cycles"""
+        dependents = {name: [] for name in self._nodes}
+        missing = {}
+        for node in self._nodes.values():
+            upstream = set(source for source, _ in node.inputs.values())
+            for source in upstream:
+                if source not in self._nodes:
+                    raise ValueError("Input of pipeline node {0!r} refers to unknown node {1!r}".format(node.name, source))
+                dependents[source].append(node.name)
+            missing[node.name] = len(upstream)
+
+        order = []
+        ready = [name for name, count in missing.items() if count == 0]
+        while ready:
+            name = ready.pop(0)
+            order.append(name)
+            for dependent in dependents[name]:
+                missing[dependent] -= 1
+                if missing[dependent] == 0:
+                    ready.append(dependent)
+
+        if len(order) != len(self._nodes):
+            raise ValueError("Pipeline has a cycle through nodes {0}".format(sorted(name for name in self._nodes if name not in order)))
+        return order
+
+    def _requested_names(self):
+        """Names to retrieve from each node -- its return_values and the values used by downstream nodes"""
+        requested = {name: list(node.return_values) for name, node in self._nodes.items()}
+        for node in self._nodes.values():
+            for source, returned_name in node.inputs.values():
+                if returned_name not in requested[source]:
+                    requested[source].append(returned_name)
+        return requested
+
+    def _fingerprints(self, order, requested):
+        """Fingerprint of each node -- None for nodes (and the nodes downstream of them) whose parameters can't be hashed"""
+        # parameters and options of the enclosing frames apply to every node
+        frames = result_frames(_current_parameter_frames())
+        fingerprints = {}
+        for name in order:
+            node = self._nodes[name]
+            inputs = sorted((parameter, fingerprints[source], returned_name) for parameter, (source, returned_name) in node.inputs.items())
+            if any(fingerprint is None for _, fingerprint, _ in inputs):
+                fingerprints[name] = None
+                continue
+            try:
+                fingerprints[name] = stable_hash((_notebook_hash(node.path_to_notebook), frames, node.parameters, inputs, requested[name]))
+            except _Unhashable:
+                fingerprints[name] = None
+        return fingerprints
+
+    def run(self, processes=None, pool=None, force=False):
+        """Run the pipeline -- nodes whose notebook, parameters and inputs are unchanged since the last run are skipped
+
+        Args:
+            processes: Number of nodes run concurrently -- defaults to the number of nodes (at most os.cpu_count())
+            pool: NotebookProcessPool used for the runs -- by default a pool is created for the duration of the run
+            force: Run every node, even those whose fingerprint is unchanged
+        Returns:
+            Dict mapping node names to the (anonymous) python modules populated with the values retrieved from each node
+        """
+        from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+        order = self._execution_order()
+        requested = self._requested_names()
+        fingerprints = self._fingerprints(order, requested)
+
+        modules = {}
+        for name in order:
+            completed = self._completed.get(name)
+            if not force and completed is not None and completed[0] is not None and completed[0] == fingerprints[name]:
+                modules[name] = completed[1]
+        to_run = [name for name in order if name not in modules]
+        if not to_run:
+            return modules
+
+        owns_pool = pool is None
+        if owns_pool:
+            import os
+            pool = NotebookProcessPool(processes=processes or min(len(to_run), os.cpu_count() or 1))
+
+        # runs are started on driver threads -- each starts from the caller's context so that enclosing parameters and options apply
+        context = contextvars.copy_context()
+        executor = ThreadPoolExecutor(max_workers=pool.processes)
+        running = {}
+        failure = None
+        try:
+            while to_run or running:
+                if failure is None:
+                    for name in list(to_run):
+                        node = self._nodes[name]
+                        if all(source in modules for source, _ in node.inputs.values()):
+                            to_run.remove(name)
+                            parameters = dict(node.parameters)
+                            try:
+                                parameters.update((parameter, getattr(modules[source], returned_name)) for parameter, (source, returned_name) in node.inputs.items())
+                            except AttributeError as e:
+                                # an upstream notebook didn't define a value this node receives
+                                failure = (name, e)
+                                break
+                            future = executor.submit(context.copy().run, self._run_node, pool, node, parameters, requested[name])
+                            running[future] = name
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        modules[name] = future.result()
+                        self._completed[name] = (fingerprints[name], modules[name])
+                    except Exception as e:
+                        # let the nodes already running finish, but don't start new ones
+                        if failure is None:
+                            failure = (name, e)
+        finally:
+            executor.shutdown(wait=True)
+            if owns_pool:
+                pool.terminate()
+
+        if failure is not None:
+            raise NotebookPipelineError(failure[0]) from failure[1]
+        return modules
+
+    @staticmethod
+    def _run_node(pool, node, parameters, names):
+        return pool.run_notebook_in_process(node.path_to_notebook, **parameters)(*names)
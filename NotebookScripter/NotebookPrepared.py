@@ -0,0 +1,136 @@
+"""Prepared notebooks -- in-process runs which skip the per-call setup of run_notebook.
+
+Each run_notebook call gets the embedded shell, selects the matplotlib backend (matplotlib.use with
+force=True), builds and registers the Magics class overriding %matplotlib, and loads the notebook's
+transformed and compiled cells (a stat and a read of the code cache entry at best).  For small
+notebooks called many times that fixed cost is most of the cost of a run.
+
+prepare_notebook does that work once.  Calling the returned PreparedNotebook only creates the module
+and the parameter frame of the run and executes the prepared code objects.  The %matplotlib override
+is only registered for runs of notebooks whose code mentions matplotlib.  Changes to the notebook file
+are picked up when refresh() is called -- or before every call with check_for_changes=True, which
+costs a stat of the file.
+"""
+
+import os
+import threading
+import types
+
+from ._main import set_notebook_option, execute_cells_in_module, _use_matplotlib_backend, _get_shell, _current_frame, _ParameterFrame
+from ._main import __receive_option as _receive_option, __add_parameter_frame as _add_parameter_frame, __pop_parameter_frame as _pop_parameter_frame
+from .NotebookCodeCache import load_notebook_cells
+from .NotebookEmbeddedShell import acquire_magics, matplotlib_magics
+
+
+def _validate_options(options):
+    """Check option names the way set_notebook_option does -- without changing the options in effect"""
+    token = _current_frame.set(_ParameterFrame(_current_frame.get(), {}))
+    try:
+        set_notebook_option(**options)
+    finally:
+        _current_frame.reset(token)
+
+
+class PreparedNotebook(object):
+    """A notebook loaded once and run in process by calling the object
+
+    Args:
+        path_to_notebook: Path to .ipynb or .py file containing notebook code
+        check_for_changes: When True every call checks whether the notebook file changed (and reloads it if it did)
+        options: Notebook options in effect for each run -- as if set with set_notebook_option by the run's first cell
+
+    with_matplotlib_backend, with_code_cache and with_notebook_validation are read when the notebook is
+    prepared (from options, else from the options in effect) -- later changes to them don't affect the
+    prepared notebook.
+    """
+
+    def __init__(self, path_to_notebook: str, check_for_changes=False, **options):
+        _validate_options(options)
+
+        self.path_to_notebook = path_to_notebook
+        self.check_for_changes = check_for_changes
+        self.options = options
+
+        def _option(**kwords):
+            name = next(iter(kwords))
+            return options[name] if name in options else _receive_option(**kwords)
+
+        self._with_backend = _option(with_matplotlib_backend="agg")
+        self._use_cache = _option(with_code_cache=True)
+        self._validate = _option(with_notebook_validation=False)
+
+        self._shell = _get_shell()
+        self._magics = None
+        if self._with_backend:
+            _use_matplotlib_backend(self._with_backend)
+            self._magics = matplotlib_magics(self._with_backend)
+
+        self._lock = threading.Lock()
+        self._stat = None
+        self._cells = ()
+        self._uses_matplotlib = False
+        self.refresh(force=True)
+
+    def refresh(self, force=False):
+        """Reload the notebook if its file changed since it was loaded (or unconditionally with force=True) -- returns whether it was reloaded"""
+        stat = os.stat(self.path_to_notebook)
+        stat = (stat.st_mtime_ns, stat.st_size)
+        if not force and stat == self._stat:
+            return False
+
+        with self._lock:
+            cells = load_notebook_cells(self.path_to_notebook, self._shell.input_transformer_manager.transform_cell,
+                                        use_cache=self._use_cache, validate=self._validate)
+            # the %matplotlib override is only needed by notebooks which mention matplotlib
+            uses_matplotlib = any("matplotlib" in source for source, _ in cells)
+            # concurrent calls see either the previous or the reloaded cells
+            self._cells = tuple((index, source, code_block) for index, (source, code_block) in enumerate(cells))
+            self._uses_matplotlib, self._stat = uses_matplotlib, stat
+        return True
+
+    def __call__(self, **hooks):
+        """Run the notebook within the calling process
+
+        Args:
+            hooks: Parameters made available to receive_parameter() calls within the notebook
+        Returns:
+            Returns newly created (anonymous) python module in which the notebook code was executed
+        """
+        if self.check_for_changes:
+            self.refresh()
+
+        cells = self._cells
+        dynamic_module = types.ModuleType("loaded_notebook")
+        dynamic_module.__file__ = self.path_to_notebook
+
+        release_magics = None
+        if self._uses_matplotlib and self._magics is not None:
+            release_magics = acquire_magics(self._shell, self._magics)
+
+        frame_token = _add_parameter_frame(hooks, self.options)
+        try:
+            execute_cells_in_module(self._shell, dynamic_module, self.path_to_notebook, cells)
+        finally:
+            if release_magics:
+                release_magics()
+            _pop_parameter_frame(frame_token)
+        return dynamic_module
+
+    def __repr__(self):
+        return "PreparedNotebook({0!r})".format(self.path_to_notebook)
+
+
+def prepare_notebook(path_to_notebook: str, check_for_changes=False, **options):
+    """Load a notebook once for many in-process runs -- returns a PreparedNotebook which runs the notebook when called
+
+    Calling the prepared notebook with keyword parameters behaves like run_notebook(path_to_notebook, **parameters)
+    with options in effect, without repeating the setup run_notebook does on every call.
+
+    Args:
+        path_to_notebook: Path to .ipynb or .py file containing notebook code
+        check_for_changes: When True every call checks whether the notebook file changed (and reloads it if it did)
+        options: Notebook options in effect for each run (for example with_matplotlib_backend=None)
+    Returns:
+        A PreparedNotebook
+    """
+    return PreparedNotebook(path_to_notebook, check_for_changes=check_for_changes, **options)
@@ -0,0 +1,354 @@
+"""Pool of warm worker processes for running notebooks.
+
+run_notebook_in_process starts a new process for each call -- paying for interpreter startup, the
+imports of IPython/nbformat and the creation of the embedded ipython shell every time.  The workers
+of a NotebookProcessPool are started once and then run notebook after notebook.  Each run is handed
+to an idle worker using the same protocol (NotebookScripter._main.worker) used by
+run_notebook_in_process.
+"""
+
+import atexit
+import collections
+import contextvars
+import functools
+import importlib
+import itertools
+import os
+import queue
+import threading
+
+from ._main import worker, _process_context, _parameters_for_process_transport, _receive_from_child, _run_deadline, _get_shell, _module_from_namespace, _with_result_cache, _event_receiver, NotebookScripterWrappedException
+from .NotebookEvents import EVENT_BUFFER_SIZE
+
+
+class _TrackingQueue(object):
+    """Wraps a queue and records whether the worker protocol consumed the requested return values"""
+
+    def __init__(self, wrapped_queue):
+        self.wrapped_queue = wrapped_queue
+        self.consumed = False
+
+    def get(self):
+        self.consumed = True
+        return self.wrapped_queue.get()
+
+
+def pool_worker(parent_to_child_queue, child_to_parent_queue, event_queue, preload_modules):
+    """Main loop of a pool worker process -- runs notebooks until it receives None"""
+    for module_name in preload_modules:
+        importlib.import_module(module_name)
+
+    # create the embedded shell up front so that the first notebook run doesn't pay for it
+    _get_shell()
+
+    while True:
+        task = parent_to_child_queue.get()
+        if task is None:
+            break
+        path_to_notebook, all_parent_parameters, hooks = task
+
+        tracking_queue = _TrackingQueue(parent_to_child_queue)
+        worker(tracking_queue, child_to_parent_queue, path_to_notebook, all_parent_parameters, event_queue, **hooks)
+
+        if not tracking_queue.consumed:
+            # the run failed before the requested return values were read -- discard them so
+            # they aren't mistaken for the next task
+            parent_to_child_queue.get()
+
+
+class _PoolWorker(object):
+    def __init__(self, context, preload_modules):
+        self.parent_to_child_queue = context.Queue()
+        self.child_to_parent_queue = context.Queue()
+        # only used by runs with a with_events callback
+        self.event_queue = context.Queue(EVENT_BUFFER_SIZE)
+        self.process = context.Process(target=pool_worker, args=(self.parent_to_child_queue, self.child_to_parent_queue, self.event_queue, preload_modules))
+        self.process.start()
+        self.tasks_completed = 0
+        # ident of the thread which started the worker's current run -- None while the worker is idle
+        self.owner = None
+
+    def stop(self):
+        if self.process.is_alive():
+            self.parent_to_child_queue.put(None)
+        self.process.join()
+
+    def terminate(self):
+        self.process.terminate()
+        self.process.join()
+
+
+class NotebookProcessPool(object):
+    """A pool of pre-initialized worker processes which execute notebooks
+
+    Args:
+        processes: Number of worker processes -- defaults to os.cpu_count()
+        max_tasks_per_child: Number of notebook runs after which a worker is replaced with a fresh process -- None means workers live as long as the pool
+        preload_modules: Names of modules imported by each worker before it receives its first notebook
+
+    Workers are started with the with_start_method option in effect when the pool is created -- with "forkserver" the
+    preload_modules are also imported by the forkserver (if it isn't running yet).
+    """
+
+    def __init__(self, processes=None, max_tasks_per_child=None, preload_modules=()):
+        if processes is None:
+            processes = os.cpu_count() or 1
+        if processes < 1:
+            raise ValueError("Number of processes must be at least 1")
+        if max_tasks_per_child is not None and max_tasks_per_child < 1:
+            raise ValueError("max_tasks_per_child must be None or a positive integer")
+
+        self.processes = processes
+        self.max_tasks_per_child = max_tasks_per_child
+        self.preload_modules = tuple(preload_modules)
+
+        self._context = _process_context(self.preload_modules)
+        self._lock = threading.Lock()
+        self._closed = False
+        self._workers = []
+        self._idle_workers = queue.Queue()
+        for _ in range(processes):
+            self._idle_workers.put(self._start_worker())
+
+        atexit.register(self.terminate)
+
+    def _start_worker(self):
+        pool_worker_instance = _PoolWorker(self._context, self.preload_modules)
+        with self._lock:
+            self._workers.append(pool_worker_instance)
+        return pool_worker_instance
+
+    def _acquire_worker(self):
+        owner = threading.get_ident()
+        while True:
+            if self._closed:
+                raise ValueError("NotebookProcessPool is closed")
+            try:
+                pool_worker_instance = self._idle_workers.get(timeout=0.1)
+            except queue.Empty:
+                with self._lock:
+                    held = sum(1 for pool_worker_instance in self._workers if pool_worker_instance.owner == owner)
+                if held >= self.processes:
+                    # the workers only come back when this thread calls the closures it holds -- waiting would never end
+                    raise RuntimeError(f"All {self.processes} workers of the NotebookProcessPool are held by closures created on this thread "
+                                       "which haven't been called yet -- call them before starting further runs")
+                continue
+            pool_worker_instance.owner = owner
+            return pool_worker_instance
+
+    def _retire_worker(self, pool_worker_instance, terminate=False):
+        with self._lock:
+            if pool_worker_instance in self._workers:
+                self._workers.remove(pool_worker_instance)
+        if terminate:
+            pool_worker_instance.terminate()
+        else:
+            pool_worker_instance.stop()
+
+    def _release_worker(self, pool_worker_instance, healthy):
+        pool_worker_instance.owner = None
+        pool_worker_instance.tasks_completed += 1
+        recycle = self.max_tasks_per_child is not None and pool_worker_instance.tasks_completed >= self.max_tasks_per_child
+
+        if not healthy or not pool_worker_instance.process.is_alive():
+            self._retire_worker(pool_worker_instance, terminate=True)
+        elif recycle or self._closed:
+            self._retire_worker(pool_worker_instance)
+        else:
+            self._idle_workers.put(pool_worker_instance)
+            return
+
+        # replace the retired worker -- the new process initializes while the caller carries on
+        if not self._closed:
+            self._idle_workers.put(self._start_worker())
+
+    def run_notebook_in_process(self, path_to_notebook: str, **hooks):
+        """Asynchronously run a notebook on one of the pool's worker processes.
+
+        Behaves like NotebookScripter.run_notebook_in_process -- blocks until a worker is idle, then
+        returns a closure which when called will block until the execution has completed.  The worker
+        is handed back to the pool once the closure has been called, so each closure must be called
+        exactly once.  A thread can't hold more closures than the pool has processes -- when all workers
+        are held by uncalled closures created on the calling thread RuntimeError is raised rather than
+        waiting forever.
+
+        Args:
+            path_to_notebook: Path to .ipynb or .py file containing notebook code
+        Returns:
+            Returns a closure which will block until the notebook execution completes then return a newly created (anonymous) python module
+            populated with requested values retrieved from the worker process
+        """
+        return _with_result_cache(path_to_notebook, hooks, lambda: self._start_run(path_to_notebook, hooks))
+
+    def _start_run(self, path_to_notebook, hooks):
+        all_parent_parameters, hooks = _parameters_for_process_transport(hooks)
+        pool_worker_instance = self._acquire_worker()
+        deadline = _run_deadline()
+        events = _event_receiver(self._context, pool_worker_instance.event_queue)
+        pool_worker_instance.parent_to_child_queue.put((path_to_notebook, all_parent_parameters, hooks))
+
+        def _block_and_receive_results(*return_values):
+            """
+            Block until the notebook execution has completed.  Then retrieve return_values from the worker's module scope and return
+            the newly created (anonymous) python module populated with the requested values retrieved from the worker
+
+            Args:
+                return_values: Optional list of strings to pass back from the worker
+            """
+            healthy = False
+            try:
+                pool_worker_instance.parent_to_child_queue.put(return_values)
+                err, final_namespace = _receive_from_child(pool_worker_instance.child_to_parent_queue, pool_worker_instance.process, deadline, events)
+                healthy = True
+            finally:
+                self._release_worker(pool_worker_instance, healthy)
+
+            if err:
+                raise err
+
+            return _module_from_namespace(path_to_notebook, final_namespace)
+
+        return _block_and_receive_results
+
+    def close(self):
+        """Stop idle workers once they have finished -- no further notebooks can be submitted"""
+        self._closed = True
+        while True:
+            try:
+                pool_worker_instance = self._idle_workers.get_nowait()
+            except queue.Empty:
+                break
+            self._retire_worker(pool_worker_instance)
+
+    def terminate(self):
+        """Immediately stop all worker processes"""
+        self._closed = True
+        with self._lock:
+            workers = list(self._workers)
+            self._workers = []
+        for pool_worker_instance in workers:
+            pool_worker_instance.terminate()
+        atexit.unregister(self.terminate)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.terminate()
+
+
+# result of one run within run_notebook_map -- exactly one of module and exception is not None
+NotebookMapResult = collections.namedtuple("NotebookMapResult", ["index", "parameters", "module", "exception"])
+
+
+def _run_in_pool(pool, path_to_notebook, return_values, parameters):
+    return pool.run_notebook_in_process(path_to_notebook, **parameters)(*return_values)
+
+
+def _run_chunk(pool, path_to_notebook, return_values, context, chunk, stopped):
+    results = []
+    for index, parameters in chunk:
+        if stopped.is_set():
+            break
+        try:
+            # each run starts from the caller's context -- parameters and options of enclosing runs are inherited
+            module = context.copy().run(_run_in_pool, pool, path_to_notebook, return_values, parameters)
+            results.append(NotebookMapResult(index, parameters, module, None))
+        except NotebookScripterWrappedException as e:
+            results.append(NotebookMapResult(index, parameters, None, e))
+        except Exception:
+            # failures outside the notebook (for example a worker process that died) are reported the same way
+            results.append(NotebookMapResult(index, parameters, None, NotebookScripterWrappedException()))
+    return results
+
+
+def run_notebook_map(path_to_notebook: str, parameter_sets, return_values=(), max_workers=None, chunksize=1, ordered=False, pool=None):
+    """Run a notebook once for each set of parameters, yielding results as the runs finish.
+
+    Runs are executed on the workers of a NotebookProcessPool.  At most 2 * max_workers chunks are
+    in flight at any time, so parameter_sets may be a lazy (or very long) iterable.  A run which raises
+    doesn't affect the other runs -- its exception is reported in the yielded result.
+
+    Args:
+        path_to_notebook: Path to .ipynb or .py file containing notebook code
+        parameter_sets: Iterable of dicts -- each dict is passed as the keyword parameters of one run
+        return_values: Names of values to retrieve from each run
+        max_workers: Number of runs executed concurrently -- defaults to the size of the pool
+        chunksize: Number of consecutive parameter sets handed to a worker at a time
+        ordered: When True results are yielded in the order of parameter_sets rather than in completion order
+        pool: NotebookProcessPool used for the runs -- by default a pool with max_workers processes is created for the duration of the map
+    Returns:
+        Generator of NotebookMapResult(index, parameters, module, exception) tuples
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    if chunksize < 1:
+        raise ValueError("chunksize must be at least 1")
+
+    owns_pool = pool is None
+    if owns_pool:
+        pool = NotebookProcessPool(processes=max_workers)
+    if max_workers is None:
+        max_workers = pool.processes
+
+    return_values = tuple(return_values)
+    context = contextvars.copy_context()
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    stopped = threading.Event()
+
+    try:
+        yield from _map_chunks(executor, functools.partial(_run_chunk, pool, path_to_notebook, return_values, context, stopped=stopped), parameter_sets, chunksize, 2 * max_workers, ordered)
+    finally:
+        stopped.set()
+        if owns_pool:
+            pool.terminate()
+        executor.shutdown(wait=True)
+
+
+def _map_chunks(executor, run_chunk, parameter_sets, chunksize, max_in_flight, ordered):
+    """Submit run_chunk for consecutive chunks of (index, parameters) pairs -- yields the results of the chunks as they finish
+
+    At most max_in_flight chunks are submitted but not yet yielded at any time.  Pending chunks are
+    cancelled when the generator is closed.
+    """
+    from concurrent.futures import wait, FIRST_COMPLETED
+
+    enumerated_parameters = enumerate(parameter_sets)
+    pending = {}
+    finished_chunks = {}
+    next_chunk_index = 0
+    next_chunk_to_yield = 0
+    exhausted = False
+
+    try:
+        while True:
+            # keep the number of submitted but not yet yielded chunks bounded
+            while not exhausted and len(pending) + len(finished_chunks) < max_in_flight:
+                chunk = list(itertools.islice(enumerated_parameters, chunksize))
+                if not chunk:
+                    exhausted = True
+                    break
+                future = executor.submit(run_chunk, chunk)
+                pending[future] = next_chunk_index
+                next_chunk_index += 1
+
+            if not pending and not finished_chunks:
+                break
+
+            if pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    chunk_index = pending.pop(future)
+                    if ordered:
+                        finished_chunks[chunk_index] = future.result()
+                    else:
+                        for result in future.result():
+                            yield result
+
+            while next_chunk_to_yield in finished_chunks:
+                for result in finished_chunks.pop(next_chunk_to_yield):
+                    yield result
+                next_chunk_to_yield += 1
+    finally:
+        for future in pending:
+            future.cancel()
@@ -0,0 +1,209 @@
+"""Per cell profiling of notebook runs (the with_profile option).
+
+For each executed code cell the profiler records the wall time, the cpu time of the process and the peak
+memory allocated while the cell ran (traced by tracemalloc -- above the memory in use when the cell
+started).  With with_profile="cprofile" the cell also runs under cProfile and its most expensive
+functions are kept.
+
+tracemalloc traces the whole process: it is started by the first profiler running and stopped when the
+last one stops, so profiled runs on several threads (run_notebooks_threaded) don't stop each other's
+tracing -- their peak memory figures do include the allocations of the cells running concurrently.
+
+The profile is a list of CellProfile tuples stored in the __notebookscripter_profile__ attribute of the
+returned module.  Runs via run_notebook_in_process/run_notebook_in_jupyter pass it back along with the
+requested values -- within a jupyter kernel the cells are measured from ipython's pre_run_cell and
+post_run_cell events.  format_profile_report renders a profile as a hotspot report.
+"""
+
+import collections
+import threading
+import time
+import tracemalloc
+
+# profile of one executed code cell -- index is the position of the cell among the notebook's code cells
+CellProfile = collections.namedtuple("CellProfile", ["index", "first_line", "wall_time", "cpu_time", "peak_memory", "functions"])
+
+# one of the most expensive functions of a cell (with_profile="cprofile")
+FunctionProfile = collections.namedtuple("FunctionProfile", ["filename", "line", "function", "calls", "total_time", "cumulative_time"])
+
+# number of functions (by cumulative time) kept for each cell
+PROFILED_FUNCTIONS = 20
+
+# profilers currently using tracemalloc -- and whether tracing was started by them (rather than by the caller)
+_TRACING_LOCK = threading.Lock()
+_TRACING_USERS = 0
+_STARTED_TRACING = False
+
+
+def _acquire_tracing():
+    global _TRACING_USERS, _STARTED_TRACING
+    with _TRACING_LOCK:
+        if _TRACING_USERS == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _STARTED_TRACING = True
+        _TRACING_USERS += 1
+
+
+def _release_tracing():
+    global _TRACING_USERS, _STARTED_TRACING
+    with _TRACING_LOCK:
+        _TRACING_USERS -= 1
+        if _TRACING_USERS == 0 and _STARTED_TRACING:
+            tracemalloc.stop()
+            _STARTED_TRACING = False
+
+
+def _first_line(source):
+    for line in source.splitlines():
+        if line.strip():
+            return line.strip()
+    return ""
+
+
+def _top_functions(profile):
+    import pstats
+
+    stats = pstats.Stats(profile).stats
+    functions = [
+        FunctionProfile(filename, line, function, calls, total_time, cumulative_time)
+        for (filename, line, function), (_, calls, total_time, cumulative_time, _) in stats.items()
+    ]
+    functions.sort(key=lambda function: function.cumulative_time, reverse=True)
+    return functions[:PROFILED_FUNCTIONS]
+
+
+class CellProfiler(object):
+    """Measures notebook cells -- call start() before the first and stop() after the last cell"""
+
+    def __init__(self, with_cprofile=False):
+        self.with_cprofile = with_cprofile
+        self.profiles = []
+        self._tracing = False
+        self._cell = None
+
+    def start(self):
+        if not self._tracing:
+            _acquire_tracing()
+            self._tracing = True
+
+    def stop(self):
+        if self._cell is not None and self._cell[0] is not None:
+            self._cell[0].disable()
+        self._cell = None
+        if self._tracing:
+            _release_tracing()
+            self._tracing = False
+
+    def begin_cell(self):
+        if hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+        start_memory = tracemalloc.get_traced_memory()[0]
+
+        profile = None
+        if self.with_cprofile:
+            import cProfile
+            profile = cProfile.Profile()
+            profile.enable()
+
+        self._cell = (profile, start_memory, time.perf_counter(), time.process_time())
+
+    def end_cell(self, index, source):
+        wall_end, cpu_end = time.perf_counter(), time.process_time()
+        profile, start_memory, wall_start, cpu_start = self._cell
+        self._cell = None
+
+        functions = ()
+        if profile is not None:
+            profile.disable()
+            functions = tuple(_top_functions(profile))
+
+        peak_memory = max(0, tracemalloc.get_traced_memory()[1] - start_memory)
+        self.profiles.append(CellProfile(index, _first_line(source), wall_end - wall_start, cpu_end - cpu_start, peak_memory, functions))
+
+    def run_cell(self, index, source, code_block, namespace):
+        self.begin_cell()
+        try:
+            exec(code_block, namespace)
+        finally:
+            self.end_cell(index, source)
+
+
+class _KernelCellProfiler(CellProfiler):
+    """Measures the cells executed by an ipython kernel via the shell's cell events"""
+
+    def __init__(self, shell, with_cprofile=False):
+        super().__init__(with_cprofile)
+        self.shell = shell
+        self._source = None
+
+    def pre_run_cell(self, info):
+        self._source = info.raw_cell
+        self.begin_cell()
+
+    def post_run_cell(self, result):
+        # the cell which started the profiler isn't measured
+        if self._cell is not None:
+            self.end_cell(len(self.profiles), self._source)
+
+    def start(self):
+        super().start()
+        self.shell.events.register("pre_run_cell", self.pre_run_cell)
+        self.shell.events.register("post_run_cell", self.post_run_cell)
+
+    def stop(self):
+        self.shell.events.unregister("pre_run_cell", self.pre_run_cell)
+        self.shell.events.unregister("post_run_cell", self.post_run_cell)
+        super().stop()
+
+
+_KERNEL_PROFILER = None
+
+
+def start_kernel_profiler(with_cprofile=False):
+    """Profile the cells subsequently executed by the current ipython kernel"""
+    from IPython import get_ipython
+
+    global _KERNEL_PROFILER
+    _KERNEL_PROFILER = _KernelCellProfiler(get_ipython(), with_cprofile)
+    _KERNEL_PROFILER.start()
+
+
+def stop_kernel_profiler():
+    """Stop profiling kernel cells -- returns the profile of the cells executed since start_kernel_profiler"""
+    global _KERNEL_PROFILER
+    profiler, _KERNEL_PROFILER = _KERNEL_PROFILER, None
+    if profiler is None:
+        return []
+    profiler.stop()
+    return profiler.profiles
+
+
+def _format_bytes(size):
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024 or unit == "GiB":
+            return "{0:.1f}{1}".format(size, unit) if unit != "B" else "{0}B".format(size)
+        size /= 1024.0
+
+
+def format_profile_report(profile, top=10):
+    """Render a profile (the __notebookscripter_profile__ of a module, or the module itself) as a hotspot report
+
+    Args:
+        profile: List of CellProfile tuples or a module returned by one of the run_notebook functions
+        top: Number of cells (and functions per cell) listed
+    Returns:
+        The report as a string -- cells ordered by wall time
+    """
+    from ._main import PROFILE_NAME
+
+    profile = getattr(profile, PROFILE_NAME, profile)
+    total_wall_time = sum(cell.wall_time for cell in profile) or 1.0
+
+    lines = ["{0:>5}  {1:>10}  {2:>10}  {3:>10}  {4:>6}  {5}".format("cell", "wall", "cpu", "peak mem", "wall%", "first line")]
+    for cell in sorted(profile, key=lambda cell: cell.wall_time, reverse=True)[:top]:
+        lines.append("{0:>5}  {1:>9.3f}s  {2:>9.3f}s  {3:>10}  {4:>5.1f}%  {5}".format(
+            cell.index, cell.wall_time, cell.cpu_time, _format_bytes(cell.peak_memory), 100.0 * cell.wall_time / total_wall_time, cell.first_line[:60]))
+        for function in cell.functions[:top]:
+            lines.append("{0:>5}  {1:>9.3f}s  {2:>9.3f}s  {3:>10}  {4:>6}  {5}:{6}({7})".format(
+                "", function.cumulative_time, function.total_time, "", function.calls, function.filename, function.line, function.function))
+    return "\n".join(lines)
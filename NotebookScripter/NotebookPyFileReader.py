@@ -1,14 +1,124 @@
+import collections
+import io
 import re
 
-from nbformat.v4 import (
-    new_code_cell,
-    new_markdown_cell,
-    new_notebook
-)
-
 
 CELL_SEPARATOR_RE = r"^#\s*%%"
 
+# a cell of a .py notebook -- first_line is the 0-based line number of the first line of source in the file
+PyFileCell = collections.namedtuple("PyFileCell", ["cell_type", "source", "first_line"])
+
+# the cell markers of both supported formats -- "# %%" (vscode, jupytext, spyder) and "# <codecell>" (ipython's legacy v3 .py format).
+# nbformat and encoding declarations of the legacy format are blanked out rather than starting a new cell
+_MARKER_RE = re.compile(
+    r"^(?:"
+    r"#[ \t]*%%(?P<vscode>[^\n]*)"
+    r"|# <(?P<legacy>codecell|markdowncell|htmlcell|rawcell|plaintextcell|headingcell|nbformat)\b[^\n]*"
+    r"|(?P<coding>#[^\n]*coding[:=][ \t]*[-\w.]+[^\n]*)"
+    r")$",
+    re.MULTILINE)
+
+_HEADING_LEVEL_RE = re.compile(r"# <headingcell level=(\d)>")
+
+_LEGACY_CELL_TYPES = {
+    "codecell": "code",
+    "markdowncell": "markdown",
+    "htmlcell": "markdown",
+    "rawcell": "raw",
+    "plaintextcell": "raw",
+}
+
+
+def _cell_type_of_marker(match):
+    """Return (cell_type, heading_level) of the cell started by the marker"""
+    vscode = match.group("vscode")
+    if vscode is not None:
+        if "[markdown]" in vscode:
+            return "markdown", None
+        if "[raw]" in vscode:
+            return "raw", None
+        return "code", None
+
+    legacy = match.group("legacy")
+    if legacy == "headingcell":
+        level = _HEADING_LEVEL_RE.match(match.group())
+        # like nbformat's v3 reader, a heading marker without a level starts a code cell
+        return ("markdown", int(level.group(1))) if level else ("code", None)
+    return _LEGACY_CELL_TYPES[legacy], None
+
+
+def _remove_comments(lines):
+    return [line[2:] if line.startswith("#") else line for line in lines]
+
+
+def _new_cell(cell_type, heading_level, first_line, text):
+    lines = text.split("\n")
+    start, end = 0, len(lines)
+    while start < end and not lines[start].strip():
+        start += 1
+    while end > start and not lines[end - 1].strip():
+        end -= 1
+    if start == end:
+        return None
+
+    lines = lines[start:end]
+    if cell_type != "code":
+        lines = _remove_comments(lines)
+    source = "\n".join(lines)
+    if heading_level is not None:
+        source = "{0} {1}".format("#" * heading_level, " ".join(source.splitlines()))
+    return PyFileCell(cell_type, source, first_line + start)
+
+
+def split_pyfile_cells(text):
+    """Split the text of a .py notebook into a list of PyFileCell tuples in a single pass over the text
+
+    Cells start at "# %%" markers ("# %% [markdown]" and "# %% [raw]" for markdown and raw cells) or at
+    the markers of ipython's legacy .py format ("# <codecell>", "# <markdowncell>", ...).  Text before the
+    first marker is a code cell -- a file without markers is a single code cell.  Cells holding only
+    whitespace are dropped and the leading "# " of lines in markdown and raw cells is removed.
+    """
+    text = text.replace("\r\n", "\n")
+    cells = []
+    cell_type, heading_level = "code", None
+    segments = []
+    position, line = 0, 0
+
+    def _finish_cell():
+        cell = _new_cell(cell_type, heading_level, segments[0][0], "".join(segment for _, segment in segments))
+        if cell is not None:
+            cells.append(cell)
+
+    for match in _MARKER_RE.finditer(text):
+        marker_line = line + text.count("\n", position, match.start())
+        if match.group("coding") is not None and marker_line >= 2:
+            # only the first two lines can hold an encoding declaration
+            continue
+
+        segments.append((line, text[position:match.start()]))
+        position, line = match.end() + 1, marker_line + 1
+
+        if match.group("coding") is not None or match.group("legacy") == "nbformat":
+            # keep the line numbering of the cell intact
+            segments.append((marker_line, "\n"))
+            continue
+
+        _finish_cell()
+        cell_type, heading_level = _cell_type_of_marker(match)
+        segments = []
+
+    segments.append((line, text[position:]))
+    _finish_cell()
+    return cells
+
+
+def pyfile_cells_to_notebook(cells):
+    """Build an nbformat v4 notebook from a list of PyFileCell tuples"""
+    from nbformat.v4 import new_code_cell, new_markdown_cell, new_raw_cell, new_notebook
+
+    constructors = {"code": new_code_cell, "markdown": new_markdown_cell, "raw": new_raw_cell}
+    return new_notebook(cells=[constructors[cell.cell_type](source=cell.source) for cell in cells], metadata={'language': 'python'})
+
 
 class VscodePyReader(object):
 
@@ -22,86 +132,17 @@ class VscodePyReader(object):
         return self.to_notebook(s, **kwargs)
 
     def to_notebook(self, s, **kwargs):
-        lines = s.splitlines()
-        cells = []
-        cell_lines = []
-        state = None
-
-        # .match(some_text) should be true if some_text starts with '# %%' with any amount of whitespace after the # and before the %%
-        find_cell_start = re.compile(CELL_SEPARATOR_RE)
-
-        for line in lines:
-            if find_cell_start.match(line):
-                if cell_lines:
-                    cell = self.new_cell(state, cell_lines)
-                    if cell is not None:
-                        cells.append(cell)
-                if "[markdown]" in line:
-                    state = 'markdowncell'
-                    cell_lines = []
-                else:
-                    state = 'codecell'
-                    cell_lines = []
-            elif state is not None:
-                cell_lines.append(line)
-        if cell_lines:
-            cell = self.new_cell(state, cell_lines)
-            if cell is not None:
-                cells.append(cell)
-        nb = new_notebook(cells=cells, metadata={'language': 'python'})
-        return nb
-
-    def new_cell(self, state, lines, **kwargs):
-        if state == 'codecell':
-            code_text = u'\n'.join(lines)
-            code_text = code_text.strip(u'\n')
-            if code_text:
-                return new_code_cell(source=code_text)
-        elif state == u'markdowncell':
-            text = self._remove_comments(lines)
-            if text:
-                return new_markdown_cell(source=text)
-
-    def _remove_comments(self, lines):
-        new_lines = []
-        for line in lines:
-            if line.startswith(u'#'):
-                new_lines.append(line[2:])
-            else:
-                new_lines.append(line)
-        text = u'\n'.join(new_lines)
-        text = text.strip(u'\n')
-        return text
+        return pyfile_cells_to_notebook(split_pyfile_cells(s))
 
 
 def read_pyfile_as_notebook(pyfile):
-    with open(pyfile) as fp:
-        pytext = fp.read()
-
-    decide_if_vscode_style = re.compile(CELL_SEPARATOR_RE, re.MULTILINE)
-
-    if decide_if_vscode_style.match(pytext):
-        return read_vscode_pyfile_as_notebook(pytext)
-    else:
-        return read_legacy_pyfile_as_notebook(pytext)
+    with io.open(pyfile, encoding="utf-8") as fp:
+        return pyfile_cells_to_notebook(split_pyfile_cells(fp.read()))
 
 
 def read_vscode_pyfile_as_notebook(pytext):
-    _reader = VscodePyReader()
-    nbook = _reader.reads(pytext)
-    return nbook
+    return pyfile_cells_to_notebook(split_pyfile_cells(pytext))
 
 
 def read_legacy_pyfile_as_notebook(pytext):
-    from nbformat import v3, v4
-
-    pytext += """
-    # <markdowncell>
-
-    # If you can read this, reads_py() is no longer broken!
-    """
-
-    nbook = v3.reads_py(pytext)
-    nbook = v4.upgrade(nbook)  # Upgrade v3 to v4
-
-    return nbook
+    return pyfile_cells_to_notebook(split_pyfile_cells(pytext))
@@ -0,0 +1,223 @@
+"""On-disk cache of the values returned by notebook runs (the with_result_cache option).
+
+A run of run_notebook_in_process (or of a NotebookProcessPool) is keyed by a chain of hashes covering
+the content of the notebook file, the parameters passed to the run, the enclosing parameter frames and
+notebook options and the names of the requested return values.  Extra values can be added to the key
+with the with_result_cache_keys option -- for example the mtimes of input files the notebook reads.
+When an entry for the key exists its values are returned without starting a process.
+
+Entries are stored in a directory per run (notebook, parameters and options) holding one file per set
+of requested names.  Each file is written to a temporary file which is atomically renamed into place,
+so concurrent processes never read partial entries.  The cache is kept within a disk budget by removing
+the least recently used entries.
+"""
+
+import hashlib
+import io
+import os
+import pickle
+import sys
+import tempfile
+
+from .NotebookCodeCache import cache_path_for
+from .NotebookIpynbReader import mapped_file
+
+# bump when the layout of entries or the derivation of keys changes
+RESULT_CACHE_FORMAT_VERSION = 1
+
+RESULT_SUFFIX = ".result"
+
+# options which change how a run is carried out but not the values it returns
+_RESULT_NEUTRAL_OPTIONS = ("with_code_cache", "with_jupyter_transport", "with_process_transport", "with_notebook_validation",
+                           "with_checkpoints", "with_checkpoint_budget", "with_result_cache", "with_result_cache_budget",
+                           "with_start_method", "with_forkserver_preload", "with_timeout", "with_cell_timeout", "with_memory_limit",
+                           "with_cpu_time_limit", "with_events",
+                           "with_jupyter_outputs", "with_output_sidecars", "with_output_notebook_interval")
+
+# attributes of every module -- not part of cached namespaces
+_MODULE_ATTRIBUTES = ("__name__", "__doc__", "__package__", "__loader__", "__spec__", "__file__")
+
+
+class _Unhashable(Exception):
+    pass
+
+
+def result_cache_directory_for(path_to_notebook):
+    """Return the default result cache directory of a notebook -- next to its code cache entry"""
+    return cache_path_for(path_to_notebook) + ".results"
+
+
+def _update_stable(digest, obj):
+    """Feed a representation of obj into digest which doesn't depend on dict/set ordering or on the process"""
+    if obj is None or isinstance(obj, (bool, int, float, complex)):
+        digest.update(repr((type(obj).__name__, obj)).encode("utf-8"))
+    elif isinstance(obj, str):
+        digest.update(b"s%d:" % len(obj))
+        digest.update(obj.encode("utf-8", "surrogatepass"))
+    elif isinstance(obj, (bytes, bytearray)):
+        digest.update(b"b%d:" % len(obj))
+        digest.update(obj)
+    elif isinstance(obj, (list, tuple)):
+        digest.update(b"%s%d:" % (type(obj).__name__.encode(), len(obj)))
+        for item in obj:
+            _update_stable(digest, item)
+    elif isinstance(obj, dict):
+        digest.update(b"d%d:" % len(obj))
+        for key_hash, value in sorted(((stable_hash(key), value) for key, value in obj.items()), key=lambda item: item[0]):
+            digest.update(key_hash.encode())
+            _update_stable(digest, value)
+    elif isinstance(obj, (set, frozenset)):
+        digest.update(b"e%d:" % len(obj))
+        for item_hash in sorted(stable_hash(item) for item in obj):
+            digest.update(item_hash.encode())
+    elif type(obj).__name__ == "ndarray" and hasattr(obj, "dtype") and not obj.dtype.hasobject:
+        # numpy arrays -- hash the raw data rather than the pickle, which holds the (large) data in a copy
+        digest.update(b"a" + repr((obj.dtype.str, obj.shape)).encode())
+        digest.update(memoryview(obj.copy(order="C") if not obj.flags.c_contiguous else obj).cast("B"))
+    else:
+        try:
+            data = pickle.dumps(obj, protocol=4)
+        except Exception:
+            raise _Unhashable(type(obj).__name__)
+        digest.update(b"p%d:" % len(data))
+        digest.update(data)
+
+
+def stable_hash(obj):
+    """Return a hex digest of obj which is the same in every process -- raises _Unhashable for values which can't be pickled"""
+    digest = hashlib.sha256()
+    _update_stable(digest, obj)
+    return digest.hexdigest()
+
+
+def _notebook_hash(path_to_notebook):
+    with mapped_file(path_to_notebook) as raw_source:
+        return hashlib.sha256(raw_source).hexdigest()
+
+
+def result_frames(parameter_frames):
+    """Return parameter_frames without the options which don't change the values a run returns"""
+    return [[parameters, {k: v for k, v in options.items() if k not in _RESULT_NEUTRAL_OPTIONS}] for parameters, options in parameter_frames]
+
+
+def run_key(path_to_notebook, parameter_frames, hooks):
+    """Return the key of a run -- None when the parameters or options hold values which can't be hashed"""
+    frames = result_frames(parameter_frames)
+    try:
+        return stable_hash((RESULT_CACHE_FORMAT_VERSION, sys.version, _notebook_hash(path_to_notebook), frames, hooks))
+    except _Unhashable:
+        return None
+
+
+def _entry_path(directory, key, return_values):
+    return os.path.join(directory, key, stable_hash(sorted(set(return_values))) + RESULT_SUFFIX)
+
+
+def has_entries(directory, key):
+    """Return whether any entry of the run exists -- for any set of return values"""
+    return os.path.isdir(os.path.join(directory, key))
+
+
+def read_entry(directory, key, return_values):
+    """Return the namespace cached for the run and return values -- None when there is no (readable) entry"""
+    path = _entry_path(directory, key, return_values)
+    try:
+        with io.open(path, "rb") as f:
+            namespace = pickle.loads(f.read())
+        # reading counts as use for the least recently used eviction
+        os.utime(path)
+        return namespace
+    except Exception:
+        return None
+
+
+def write_entry(directory, key, return_values, module, budget):
+    """Store the values of module (returned by a run) as the entry of the run and return values"""
+    namespace = {k: v for k, v in module.__dict__.items() if k not in _MODULE_ATTRIBUTES}
+    try:
+        data = pickle.dumps(namespace, protocol=5)
+    except Exception:
+        # returned values which can't be pickled (their repr was returned) aren't cached
+        return
+    if len(data) <= budget:
+        _write_atomic(_entry_path(directory, key, return_values), data)
+    enforce_result_cache_budget(directory, budget)
+
+
+def _write_atomic(path, data):
+    directory = os.path.dirname(path)
+    try:
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        try:
+            with io.open(fd, "wb") as f:
+                f.write(data)
+            # atomic on posix and windows -- concurrent readers never see a partial entry
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+    except OSError:
+        # the cache is best effort only
+        pass
+
+
+def enforce_result_cache_budget(directory, budget):
+    """Remove the least recently used entries in directory until they use at most budget bytes"""
+    entries = []
+    try:
+        run_directories = [run_directory.path for run_directory in os.scandir(directory) if run_directory.is_dir()]
+    except OSError:
+        return
+    for run_directory in run_directories:
+        try:
+            for entry in os.scandir(run_directory):
+                if entry.name.endswith(RESULT_SUFFIX):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        except OSError:
+            # removed by a concurrent process
+            continue
+
+    used = 0
+    for _, size, path in sorted(entries, reverse=True):
+        used += size
+        if used > budget:
+            try:
+                os.unlink(path)
+                # remove the run's directory once its last entry is gone -- fails while other entries remain
+                os.rmdir(os.path.dirname(path))
+            except OSError:
+                pass
+
+
+def cached_run(path_to_notebook, directory, budget, key, start_run):
+    """Wrap a run in the result cache
+
+    Args:
+        path_to_notebook: Path of the notebook
+        directory: Directory holding the cache entries
+        budget: Maximum number of bytes used by entries in directory
+        key: Key of the run (see run_key)
+        start_run: Function which starts the run -- returns a closure which blocks until the run has completed
+    Returns:
+        A closure like the one returned by start_run -- the values it retrieves are read from the cache when an entry exists
+    """
+    from ._main import _module_from_namespace
+
+    # start the run right away unless it was cached before (for some return values) -- a likely hit doesn't pay for starting it
+    started = None if has_entries(directory, key) else start_run()
+
+    def _block_and_receive_results(*return_values):
+        receive = started
+        if receive is None:
+            namespace = read_entry(directory, key, return_values)
+            if namespace is not None:
+                return _module_from_namespace(path_to_notebook, namespace)
+            receive = start_run()
+
+        module = receive(*return_values)
+        write_entry(directory, key, return_values, module, budget)
+        return module
+
+    return _block_and_receive_results
@@ -0,0 +1,64 @@
+"""Concurrent in-process notebook runs on a thread pool.
+
+run_notebook keeps the state of a run (its parameter frames, the namespace magics operate on, magic
+overrides) per thread, so notebooks can execute concurrently on several threads of the same process.
+Threads don't help with notebooks holding the GIL, but notebooks which mostly wait on I/O or run
+numpy (and other extension) code which releases the GIL run concurrently without the cost of
+starting processes and pickling return values.
+"""
+
+import contextvars
+import functools
+import threading
+
+from ._main import run_notebook, _get_shell
+from .NotebookProcessPool import NotebookMapResult, _map_chunks
+
+
+def _run_chunk(context, path_to_notebook, stopped, chunk):
+    results = []
+    for index, parameters in chunk:
+        if stopped.is_set():
+            break
+        try:
+            # each run starts from the caller's context -- parameters and options of enclosing runs are inherited
+            module = context.copy().run(run_notebook, path_to_notebook, **parameters)
+            results.append(NotebookMapResult(index, parameters, module, None))
+        except Exception as e:
+            results.append(NotebookMapResult(index, parameters, None, e))
+    return results
+
+
+def run_notebooks_threaded(path_to_notebook: str, parameter_sets, max_workers=None, chunksize=1, ordered=False):
+    """Run a notebook in process once for each set of parameters on a pool of threads, yielding results as the runs finish.
+
+    Like run_notebook_map, but the runs execute via run_notebook on threads of the calling process --
+    the yielded modules are the complete notebook modules and a failing run reports the exception it
+    raised.  At most 2 * max_workers chunks are in flight at any time.
+
+    Args:
+        path_to_notebook: Path to .ipynb or .py file containing notebook code
+        parameter_sets: Iterable of dicts -- each dict is passed as the keyword parameters of one run
+        max_workers: Number of threads -- defaults to the default of concurrent.futures.ThreadPoolExecutor
+        chunksize: Number of consecutive parameter sets handed to a thread at a time
+        ordered: When True results are yielded in the order of parameter_sets rather than in completion order
+    Returns:
+        Generator of NotebookMapResult(index, parameters, module, exception) tuples
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    if chunksize < 1:
+        raise ValueError("chunksize must be at least 1")
+
+    # create the embedded shell on the calling thread -- its history database can only be used by the thread creating it
+    _get_shell()
+
+    context = contextvars.copy_context()
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="NotebookScripterThread")
+    stopped = threading.Event()
+    try:
+        # pylint: disable=protected-access
+        yield from _map_chunks(executor, functools.partial(_run_chunk, context, path_to_notebook, stopped), parameter_sets, chunksize, 2 * executor._max_workers, ordered)
+    finally:
+        stopped.set()
+        executor.shutdown(wait=True)
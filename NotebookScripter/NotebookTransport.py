@@ -0,0 +1,169 @@
+"""Out-of-band transport of parameters and return values.
+
+Values are pickled with protocol 5 and large buffers (numpy arrays, arrow buffers, pandas blocks ...)
+are written out-of-band rather than being copied into the pickle stream.
+
+Sidecar files are used by run_notebook_in_jupyter (with_jupyter_transport="file") instead of embedding
+hex encoded pickles in the notebook source and cell outputs.  A sidecar file holds the pickle stream
+followed by each out-of-band buffer (aligned so that arrays can be used in place).  Reading maps the
+file into memory copy-on-write -- buffers are rebuilt directly over the mapping rather than being read
+into new memory.
+
+run_notebook_in_process (with_process_transport="shared_memory") moves out-of-band buffers of parameters and
+return values to multiprocessing.shared_memory segments instead of copying them through a pipe.
+"""
+
+import io
+import mmap
+import os
+import pickle
+import struct
+from multiprocessing import shared_memory
+
+SIDECAR_MAGIC = b"NBSCRIPTER5\n"
+BUFFER_ALIGNMENT = 64
+
+_HEADER = struct.Struct("<QQ")
+_LENGTH = struct.Struct("<Q")
+
+
+def _aligned(offset):
+    return (offset + BUFFER_ALIGNMENT - 1) // BUFFER_ALIGNMENT * BUFFER_ALIGNMENT
+
+
+def dumps_out_of_band(obj):
+    """Pickle obj with protocol 5 -- returns the pickle stream and the list of out-of-band buffers (as memoryviews)"""
+    buffers = []
+
+    def _collect_buffer(pickle_buffer):
+        try:
+            buffers.append(pickle_buffer.raw())
+        except BufferError:
+            # non-contiguous buffers are serialized in-band
+            return True
+        return False
+
+    data = pickle.dumps(obj, protocol=5, buffer_callback=_collect_buffer)
+    return data, buffers
+
+
+def dump_to_file(obj, path):
+    """Write obj to a sidecar file at path"""
+    data, buffers = dumps_out_of_band(obj)
+
+    with io.open(path, "wb") as f:
+        f.write(SIDECAR_MAGIC)
+        f.write(_HEADER.pack(len(data), len(buffers)))
+        for buffer in buffers:
+            f.write(_LENGTH.pack(buffer.nbytes))
+        f.write(data)
+        for buffer in buffers:
+            padding = _aligned(f.tell()) - f.tell()
+            f.write(b"\0" * padding)
+            f.write(buffer)
+
+
+def load_from_file(path):
+    """Read an object written by dump_to_file -- out-of-band buffers reference a copy-on-write mapping of the file"""
+    with io.open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise ValueError("Empty notebook transport file: {0}".format(path))
+        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    view = memoryview(mapping)
+    if bytes(view[:len(SIDECAR_MAGIC)]) != SIDECAR_MAGIC:
+        raise ValueError("Not a notebook transport file: {0}".format(path))
+
+    offset = len(SIDECAR_MAGIC)
+    data_length, buffer_count = _HEADER.unpack_from(view, offset)
+    offset += _HEADER.size
+
+    buffer_lengths = []
+    for _ in range(buffer_count):
+        buffer_lengths.append(_LENGTH.unpack_from(view, offset)[0])
+        offset += _LENGTH.size
+
+    data = view[offset:offset + data_length]
+    offset += data_length
+
+    buffers = []
+    for length in buffer_lengths:
+        offset = _aligned(offset)
+        buffers.append(pickle.PickleBuffer(view[offset:offset + length]))
+        offset += length
+
+    return pickle.loads(data, buffers=buffers)
+
+
+class _AttachedSegment(shared_memory.SharedMemory):
+    """Shared memory segment whose close() can be called while buffers rebuilt over it are still in use"""
+
+    def close(self):
+        try:
+            super().close()
+        except BufferError:
+            # objects rebuilt over the segment still reference the mapping -- it is unmapped when the last of
+            # them is released.  Only the file descriptor needs to be closed now
+            self._mmap = None
+            fd = getattr(self, "_fd", -1)
+            if fd >= 0:
+                os.close(fd)
+                self._fd = -1
+
+
+class SharedMemoryPayload(object):
+    """Picklable handle to an object whose out-of-band buffers were copied to a shared memory segment
+
+    Unpickling the handle (in the receiving process) rebuilds the object over the segment and unlinks the
+    segment -- the memory is released once the rebuilt object is no longer referenced.  Segments whose
+    handle is never unpickled (for example because the receiving process crashed) are removed by the
+    multiprocessing resource tracker.
+    """
+
+    def __init__(self, data, segment_name, buffer_spans):
+        self.data = data
+        self.segment_name = segment_name
+        self.buffer_spans = buffer_spans
+
+    def __reduce__(self):
+        return (load_from_shared_memory, (self.data, self.segment_name, self.buffer_spans))
+
+
+def to_shared_memory(obj):
+    """Copy the out-of-band buffers of obj to a new shared memory segment and return a SharedMemoryPayload for it
+
+    Objects without out-of-band buffers are returned unchanged.
+    """
+    data, buffers = dumps_out_of_band(obj)
+
+    buffer_spans = []
+    offset = 0
+    for buffer in buffers:
+        offset = _aligned(offset)
+        buffer_spans.append((offset, buffer.nbytes))
+        offset += buffer.nbytes
+
+    if offset == 0:
+        return obj
+
+    segment = shared_memory.SharedMemory(create=True, size=offset)
+    try:
+        for (start, length), buffer in zip(buffer_spans, buffers):
+            segment.buf[start:start + length] = buffer.cast("B")
+        return SharedMemoryPayload(data, segment.name, buffer_spans)
+    except BaseException:
+        segment.unlink()
+        raise
+    finally:
+        segment.close()
+
+
+def load_from_shared_memory(data, segment_name, buffer_spans):
+    """Rebuild an object written by to_shared_memory -- the segment is unlinked as soon as it is attached"""
+    segment = _AttachedSegment(name=segment_name)
+    try:
+        segment.unlink()
+        buffers = [pickle.PickleBuffer(segment.buf[start:start + length]) for start, length in buffer_spans]
+        return pickle.loads(data, buffers=buffers)
+    finally:
+        segment.close()
@@ -1 +1,35 @@
-from ._main import run_notebook, run_notebook_in_process, run_notebook_in_jupyter, receive_parameter, NotebookScripterWrappedException, set_notebook_option, rehydrate, dehydrate_return_values
+from ._main import run_notebook, run_notebook_in_process, run_notebook_in_jupyter, receive_parameter, NotebookScripterWrappedException, NotebookScripterTimeoutError, set_notebook_option, report_progress, rehydrate, dehydrate_return_values, rehydrate_from_file, dehydrate_return_values_to_file
+from .NotebookImporter import install_notebook_importer, uninstall_notebook_importer, NotebookFinder
+from .NotebookProcessPool import NotebookProcessPool, run_notebook_map, NotebookMapResult
+from .NotebookKernelPool import NotebookKernelPool
+
+# names exported from modules with expensive imports (asyncio, concurrent.futures, ast) -- imported on first use
+_LAZY_EXPORTS = {
+    "NotebookFuture": ".NotebookFutures",
+    "run_notebook_in_process_future": ".NotebookFutures",
+    "run_notebook_in_process_async": ".NotebookFutures",
+    "run_notebook_in_jupyter_future": ".NotebookFutures",
+    "run_notebook_in_jupyter_async": ".NotebookFutures",
+    "plan_dead_cell_elimination": ".NotebookDataflow",
+    "format_profile_report": ".NotebookProfiler",
+    "run_notebooks_threaded": ".NotebookThreads",
+    "NotebookPipeline": ".NotebookPipeline",
+    "NotebookPipelineError": ".NotebookPipeline",
+    "NotebookEvent": ".NotebookEvents",
+    "prepare_notebook": ".NotebookPrepared",
+    "PreparedNotebook": ".NotebookPrepared",
+}
+
+
+def __getattr__(name):
+    import importlib
+
+    if name not in _LAZY_EXPORTS:
+        raise AttributeError("module {0!r} has no attribute {1!r}".format(__name__, name))
+    value = getattr(importlib.import_module(_LAZY_EXPORTS[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_EXPORTS))
@@ -0,0 +1,5 @@
+import sys
+
+from .NotebookCli import main
+
+sys.exit(main())
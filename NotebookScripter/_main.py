@@ -1,33 +1,124 @@
 
 import types
-import io
 import os
 import sys
 import traceback
 import typing
 import pickle
 import codecs
+import contextlib
+import contextvars
 
-from IPython import get_ipython
-from IPython.core.interactiveshell import InteractiveShell
-from IPython.core.magic import Magics, magics_class, line_magic
+from .NotebookCodeCache import load_notebook_cells
 
-from traitlets.config import MultipleInstanceError
 
-from nbformat import read as read_notebook
+# default disk budget of with_checkpoints snapshots
+DEFAULT_CHECKPOINT_BUDGET = 1 << 30
 
+# default disk budget of with_result_cache entries
+DEFAULT_RESULT_CACHE_BUDGET = 1 << 30
 
-# Holds values to be injected into module execution context via receive_parameter/__receive_options
+# name of the per cell profile (with_profile) in the namespace of executed notebooks
+PROFILE_NAME = "__notebookscripter_profile__"
+
+# name of the pickled sizes of the return values (with_return_sizes option)
+RETURN_SIZES_NAME = "__notebookscripter_return_sizes__"
+
+# Holds values to be injected into module execution context via receive_parameter/__receive_options -- the root frames of the
+# process (parameters and options inherited from a parent process or kernel and options set outside of any notebook run)
 __notebookscripter_injected__ = [[{}, {}]]
 
 
-def __add_parameter_frame(injected_parameters):
-    global __notebookscripter_injected__
-    __notebookscripter_injected__ += [[injected_parameters, {}]]
+class _ParameterFrame(object):
+    """Parameters and options of one run_notebook call -- chained to the frame of the calling run
+
+    The values inherited from the calling frames are merged when the frame is created so lookups don't
+    depend on the nesting depth.  Options set while the run executes (set_notebook_option called by a
+    cell) are kept in options and are inherited by the frames of runs started afterwards.
+    """
+
+    __slots__ = ("parameters", "options", "inherited_options")
+
+    def __init__(self, parent, injected_parameters):
+        if parent is None:
+            inherited_parameters, self.inherited_options = _flatten_frames(__notebookscripter_injected__)
+        else:
+            inherited_parameters, self.inherited_options = parent.parameters, parent.resolved_options()
+        self.parameters = dict(inherited_parameters)
+        self.parameters.update(injected_parameters)
+        self.options = {}
+
+    def resolved_options(self):
+        options = dict(self.inherited_options)
+        options.update(self.options)
+        return options
+
+
+def _flatten_frames(frames):
+    parameters, options = {}, {}
+    for frame_parameters, frame_options in frames:
+        parameters.update(frame_parameters)
+        options.update(frame_options)
+    return parameters, options
+
+
+# the frame of the innermost run_notebook call -- per thread (and asyncio task), None outside of any run
+_current_frame = contextvars.ContextVar("notebookscripter_parameter_frame", default=None)
+
+
+def __add_parameter_frame(injected_parameters, options=None):
+    frame = _ParameterFrame(_current_frame.get(), injected_parameters)
+    if options:
+        # options applied to the run as if set_notebook_option had been called by its first cell
+        frame.options.update(options)
+    return _current_frame.set(frame)
+
+
+def __pop_parameter_frame(token):
+    _current_frame.reset(token)
+
+
+def _current_options():
+    """Return the options dict set_notebook_option writes to"""
+    frame = _current_frame.get()
+    return __notebookscripter_injected__[-1][1] if frame is None else frame.options
 
 
-def __pop_parameter_frame():
-    __notebookscripter_injected__.pop()
+def _current_parameter_frames():
+    """Return the parameter stack -- passed to child processes so that receive_parameter can search the caller's frames"""
+    frame = _current_frame.get()
+    if frame is None:
+        return __notebookscripter_injected__
+    return [[dict(frame.parameters), frame.resolved_options()]]
+
+
+def _transportable_parameter_frames():
+    """Return the parameter stack to send to a subprocess or kernel -- with_events callbacks stay in this process, the child only learns that events are wanted"""
+    return [[parameters, dict(options, with_events=True) if callable(options.get("with_events")) else options]
+            for parameters, options in _current_parameter_frames()]
+
+
+# the notebook and code cell executing in this thread -- the source of events emitted via _emit_event
+_current_cell = contextvars.ContextVar("notebookscripter_current_cell", default=(None, None))
+
+
+def _emit_event(kind, data=None):
+    """Pass an event to the with_events callback of the current run -- does nothing without one"""
+    on_event = __receive_option(with_events=None)
+    if callable(on_event):
+        import time
+        from .NotebookEvents import NotebookEvent
+
+        path_to_notebook, cell = _current_cell.get()
+        on_event(NotebookEvent(kind, path_to_notebook, cell, time.time(), data, 0))
+
+
+def report_progress(**values):
+    """Report intermediate values of a running notebook as a progress event -- does nothing unless with_events is set
+
+    Within subprocess and kernel runs the values are sent to the calling process, so they should be small and picklable.
+    """
+    _emit_event("progress", values)
 
 
 def set_notebook_option(
@@ -38,13 +129,88 @@ def set_notebook_option(
 
     with_matplotlib_backend: Override behavior of ipython's matplotlib 'magic directive' -- by default reinterprets "%matplotlib inline" as "%matplotlib agg" -- set to None to disable
 
+    with_code_cache: Cache transformed and compiled notebook code in a __pycache__ directory next to the notebook -- defaults to True, set to False to disable
+
+    with_jupyter_transport: How run_notebook_in_jupyter passes parameters and return values to and from the kernel -- "inline" (the default) embeds them
+    in the notebook's cells, "file" passes them through temporary sidecar files using pickle protocol 5 with out-of-band buffers
+
+    with_process_transport: How run_notebook_in_process (and process pools) pass parameters and return values to and from subprocesses -- "pipe"
+    (the default) pickles them through a pipe, "shared_memory" moves large buffers (numpy arrays, arrow buffers, pandas blocks) to shared memory segments
+
+    with_max_return_value_bytes: Maximum pickled size of each value returned from a subprocess or kernel -- defaults to None (no limit)
+
+    with_max_return_bytes: Maximum pickled size of all values returned from a subprocess or kernel together -- defaults to None (no limit)
+
+    with_oversized_return_values: What happens to return values exceeding the size limits -- "error" (the default) fails the run, "repr" returns
+    a (truncated) repr of the value instead
+
+    with_return_sizes: Report the pickled size (in bytes) of each value returned from a subprocess or kernel in the
+    __notebookscripter_return_sizes__ value of the returned module -- defaults to False
+
+    with_checkpoints: Snapshot the notebook namespace after each cell and resume later runs from the last unchanged cell -- defaults to False,
+    set to True to keep checkpoints in the notebook's __pycache__ directory or to the path of a directory to keep them in
+
+    with_checkpoint_budget: Maximum number of bytes used by checkpoint snapshots and manifests in the checkpoint directory -- least recently
+    used files are removed first -- defaults to 1GiB
+
+    with_dead_cell_elimination: Only run the cells needed (according to a static analysis of the cells) to compute the given names -- defaults to
+    False, set to a list of names or (for run_notebook_in_process and process pools) to True to use the names passed to the returned closure
+
+    with_profile: Record wall time, cpu time and peak (tracemalloc) memory of each cell in __notebookscripter_profile__ -- defaults to False,
+    set to True to enable or to "cprofile" to also record the most expensive functions of each cell
+
+    with_notebook_validation: Validate .ipynb files against the notebook schema (via nbformat) when they are read -- defaults to False, which
+    reads only the cells' sources and metadata without decoding the stored outputs
+
+    with_result_cache: Cache the values returned by run_notebook_in_process (and process pools) on disk, keyed by the notebook's content, the
+    parameters, the options and the requested names -- defaults to False, set to True to keep entries in the notebook's __pycache__ directory
+    or to the path of a directory to keep them in
+
+    with_result_cache_budget: Maximum number of bytes used by entries in the result cache directory -- least recently used entries are
+    removed first -- defaults to 1GiB
+
+    with_result_cache_keys: Extra values added to the key of with_result_cache entries -- for example the mtimes of files the notebook reads
+
+    with_start_method: How run_notebook_in_process (and process pools) start subprocesses -- "spawn" (the default) starts a new interpreter for
+    each process, "forkserver" (POSIX only) forks processes from a server process which has already imported NotebookScripter and IPython
+
+    with_forkserver_preload: Names of further modules imported by the forkserver (for example ["numpy", "pandas"]) -- only takes effect when the
+    forkserver starts, which happens with the first "forkserver" subprocess
+
+    with_timeout: Maximum number of seconds a subprocess or kernel run may take -- the subprocess is terminated (the kernel's cell interrupted)
+    and NotebookScripterTimeoutError is raised -- defaults to None (no limit)
+
+    with_cell_timeout: Maximum number of seconds each cell of a subprocess or kernel run may take -- defaults to None (no limit)
+
+    with_memory_limit: Maximum address space (RLIMIT_AS) in bytes of the subprocess or kernel running the notebook -- defaults to None (no limit)
+
+    with_cpu_time_limit: Maximum number of cpu seconds (RLIMIT_CPU) used by a subprocess or kernel run -- defaults to None (no limit)
+
+    with_events: Callback receiving a NotebookEvent when a cell starts or finishes, for output written by subprocess and kernel runs
+    and for values passed to report_progress() -- events of subprocess runs are delivered while the closure waits for the run -- defaults to None
+
+    with_jupyter_outputs: Which outputs kernel runs keep in the executed notebook -- "full" keeps every output, "lean" keeps only errors and the
+    tail of each cell's stdout/stderr, "auto" (the default) is lean unless the executed notebook is saved (save_output_notebook)
+
+    with_output_sidecars: Write binary outputs (images, pdfs) of kernel runs to files in a "<name>_files" directory next to the saved output
+    notebook instead of embedding them as base64 -- defaults to False, set to True or to the minimum size in bytes of outputs written to sidecars
+
+    with_output_notebook_interval: Minimum number of seconds between the writes of a saved output notebook while the kernel runs -- defaults
+    to 1, set to 0 to write after every cell or to None to only write once the run has completed
+
     """
-    valid_parameters = ["with_matplotlib_backend"]
+    valid_parameters = ["with_matplotlib_backend", "with_code_cache", "with_jupyter_transport", "with_process_transport",
+                        "with_max_return_value_bytes", "with_max_return_bytes", "with_oversized_return_values",
+                        "with_return_sizes", "with_checkpoints", "with_checkpoint_budget", "with_dead_cell_elimination", "with_profile",
+                        "with_notebook_validation", "with_result_cache", "with_result_cache_budget", "with_result_cache_keys",
+                        "with_start_method", "with_forkserver_preload", "with_timeout", "with_cell_timeout", "with_memory_limit",
+                        "with_cpu_time_limit", "with_events", "with_jupyter_outputs", "with_output_sidecars",
+                        "with_output_notebook_interval"]
     for key, value in kwords.items():
         if key not in valid_parameters:
             raise ValueError(f"Unknown notebook configuration parameter: {key} -- valid parameters {','.join(valid_parameters)}")
-        elif key == "with_matplotlib_backend":
-            __notebookscripter_injected__[-1][1][key] = value
+        else:
+            _current_options()[key] = value
 
 
 def __receive_option(**kwords):
@@ -59,21 +225,21 @@ def __receive_option(**kwords):
     if len(kwords) != 1:
         raise ValueError("Exactly 1 kword argument must be passed to receive_option")
 
-    namespaces_to_search = [i for _, i in __notebookscripter_injected__]
-    ret = []
+    param_name, default_value = next(iter(kwords.items()))
+
+    frame = _current_frame.get()
+    if frame is not None:
+        if param_name in frame.options:
+            return frame.options[param_name]
+        return frame.inherited_options.get(param_name, default_value)
 
     # search the namespaces in reverse order
-    param_name, default_value = next(iter(kwords.items()))
-    for module_namespace in reversed(namespaces_to_search):
+    for _, module_namespace in reversed(__notebookscripter_injected__):
         if param_name in module_namespace:
-            ret.append(module_namespace[param_name])
+            return module_namespace[param_name]
 
     # search space did not contain item -- use default value
-    if not ret:
-        ret.append(default_value)
-
-    # return the found item
-    return ret[0]
+    return default_value
 
 
 def receive_parameter(**kwords):
@@ -90,73 +256,62 @@ def receive_parameter(**kwords):
     if len(kwords) != 1:
         raise ValueError("Exactly 1 kword argument must be passed to receive_parameter")
 
-    namespaces_to_search = [i for i, _ in __notebookscripter_injected__]
-    ret = []
-
-    # search the namespaces in reverse order
     param_name, default_value = next(iter(kwords.items()))
-    for module_namespace in reversed(namespaces_to_search):
-        if param_name in module_namespace:
-            ret.append(module_namespace[param_name])
+    for requested_parameters in _parameter_recorders.get():
+        requested_parameters.append(param_name)
+
+    found, value = _lookup_parameter(param_name)
 
     # search space did not contain item -- use default value
-    if not ret:
-        ret.append(default_value)
+    if not found:
+        return default_value
 
     # return the found item
-    return ret[0]
-
+    return value
 
-class NotebookScripterEmbeddedIpythonShell(InteractiveShell):
 
-    def enable_gui(self, gui=None):
-        pass
-
-    def init_sys_modules(self):
-        """Override this to create an ipython shell appropriate for embedding similar to InteractiveShellEmbed.
-
-        Needed to avoid creating new global namespace when running from command line console.
-        """
-        pass
+# lists which record the names passed to receive_parameter -- used by checkpointing to learn which parameters a cell depends on
+_parameter_recorders = contextvars.ContextVar("notebookscripter_parameter_recorders", default=())
 
-    def init_prompts(self):
-        """Override: don't mutate shell prompts.  Needed to avoid overtaking the interactive shell when this code is run from `python` command line console."""
-        # Set system prompts, so that scripts can decide if they are running
-        # interactively.
-        # sys.ps1 = 'In : '
-        # sys.ps2 = '...: '
-        # sys.ps3 = 'Out: '
 
+@contextlib.contextmanager
+def _recording_parameters():
+    """Record the names passed to receive_parameter (in this thread) within the with block into the yielded list"""
+    requested_parameters = []
+    token = _parameter_recorders.set(_parameter_recorders.get() + (requested_parameters,))
+    try:
+        yield requested_parameters
+    finally:
+        _parameter_recorders.reset(token)
 
-def register_magic(shell_instance, magic_cls):
-    """
-    Registers the provided shell_instance from IPython.
 
-    Returns a function which undoes this.
+def _lookup_parameter(param_name):
+    """Search the parameter frames for param_name -- returns a (found, value) pair"""
+    frame = _current_frame.get()
+    if frame is not None:
+        if param_name in frame.parameters:
+            return True, frame.parameters[param_name]
+        return False, None
 
-    Rant: Why the f... does IPython not define it's own unregister function?
+    # search the namespaces in reverse order
+    for module_namespace, _ in reversed(__notebookscripter_injected__):
+        if param_name in module_namespace:
+            return True, module_namespace[param_name]
 
-    :param magic_cls: The Magics class you wish to register.
-    """
+    return False, None
 
-    # ugh I hate this code and I hate python so much ...
-    undoes = {}
-    original_magics = shell_instance.magics_manager.magics
-    for magic_type, names in magic_cls.magics.items():
-        if magic_type in original_magics:
-            for magic_name, _ in names.items():
-                if magic_name in original_magics[magic_type]:
-                    undoesNamedMagics = undoes.setdefault(magic_type, {})
-                    undoesNamedMagics[magic_name] = original_magics[magic_type][magic_name]
 
-    shell_instance.register_magics(magic_cls)
+def _get_shell():
+    from .NotebookEmbeddedShell import get_shell
+    return get_shell()
 
-    def unregister_magics():
-        for magic_type, magic_names in undoes.items():
-            for magic_name, magic_value in magic_names.items():
-                shell_instance.magics_manager.magics[magic_type][magic_name] = magic_value
 
-    return unregister_magics
+def __getattr__(name):
+    # the ipython dependent parts of this module live in NotebookEmbeddedShell and are only imported on first use
+    if name in ("NotebookScripterEmbeddedIpythonShell", "register_magic"):
+        from . import NotebookEmbeddedShell
+        return getattr(NotebookEmbeddedShell, name)
+    raise AttributeError("module {0!r} has no attribute {1!r}".format(__name__, name))
 
 
 def run_notebook(
@@ -170,100 +325,167 @@ def run_notebook(
     Returns:
         Returns newly created (anonymous) python module in which the target code was executed.
     """
-    try:
-        shell = NotebookScripterEmbeddedIpythonShell.instance()
-    except MultipleInstanceError:
-        # we are already embedded into an ipython shell -- just get that one.
-        shell = get_ipython()
+    # create new module scope for notebook execution
+    module_identity = "loaded_notebook"
+    dynamic_module = types.ModuleType(module_identity)
+    dynamic_module.__file__ = path_to_notebook
+
+    execute_notebook_in_module(dynamic_module, path_to_notebook, hooks)
+    return dynamic_module
+
 
-    unregister_magics = None
+def execute_notebook_in_module(dynamic_module, path_to_notebook, hooks):
+    """Execute the code cells of a notebook within the namespace of an existing module
+
+    Shared by run_notebook and the notebook import hook.
+
+    Args:
+        dynamic_module: Module in whose namespace the notebook code is executed
+        path_to_notebook: Path to .ipynb or .py file containing notebook code
+        hooks: Parameters made available to receive_parameter() calls within the notebook
+    """
+    from .NotebookEmbeddedShell import get_shell, acquire_magics, matplotlib_magics
+
+    shell = get_shell()
+
+    release_magics = None
 
     with_backend = __receive_option(with_matplotlib_backend="agg")
 
     if with_backend:
-        try:
-            # try to initialize the matplotlib backend as early as possible
-            # (cuts down on potential for complex bugs)
-            import matplotlib
-            matplotlib.use(with_backend, force=True)
-        except ModuleNotFoundError:
-            # don't error out here when matplotlib is missing -- instead there will be
-            # a failure within the notebook if notebook actually tries to use
-            # matplotlib ...
-            pass
-
-        @magics_class
-        class NotebookScripterMagics(Magics):
-            @line_magic
-            def matplotlib(self, _line):
-                "Override matplotlib magic to use non-interactive backend regardless of user supplied argument ..."
-                import matplotlib
-                matplotlib.use(with_backend, force=True)
-
-        unregister_magics = register_magic(shell, NotebookScripterMagics)
-
-    # load the notebook object
+        _use_matplotlib_backend(with_backend)
+        release_magics = acquire_magics(shell, matplotlib_magics(with_backend))
+
+    frame_token = __add_parameter_frame(hooks)
+
+    try:
+        # load the transformed and compiled notebook code (via the on-disk code cache)
+        cells = load_notebook_cells(
+            path_to_notebook,
+            shell.input_transformer_manager.transform_cell,
+            use_cache=__receive_option(with_code_cache=True),
+            validate=__receive_option(with_notebook_validation=False))
+
+        execute_cells_in_module(shell, dynamic_module, path_to_notebook, [(index, source, code_block) for index, (source, code_block) in enumerate(cells)])
+    finally:
+        # revert the magics changes ...
+        if release_magics:
+            release_magics()
+
+        # pop parameters stack
+        __pop_parameter_frame(frame_token)
+
+
+def _use_matplotlib_backend(with_backend):
+    try:
+        # try to initialize the matplotlib backend as early as possible
+        # (cuts down on potential for complex bugs)
+        import matplotlib
+        matplotlib.use(with_backend, force=True)
+    except ModuleNotFoundError:
+        # don't error out here when matplotlib is missing -- instead there will be
+        # a failure within the notebook if notebook actually tries to use
+        # matplotlib ...
+        pass
+
+
+def execute_cells_in_module(shell, dynamic_module, path_to_notebook, cells):
+    """Execute loaded notebook cells within the namespace of a module -- the parameter frame of the run must already be pushed
+
+    Shared by execute_notebook_in_module and prepared notebooks.
+
+    Args:
+        shell: The embedded ipython shell
+        dynamic_module: Module in whose namespace the notebook code is executed
+        path_to_notebook: Path to .ipynb or .py file the cells were loaded from
+        cells: Sequence of (index, transformed_source, code_object) tuples
+    """
+    from IPython import get_ipython
+    from .NotebookEmbeddedShell import set_notebook_user_ns
 
-    # create new module scope for notebook execution
-    module_identity = "loaded_notebook"
-    dynamic_module = types.ModuleType(module_identity)
-    dynamic_module.__file__ = path_to_notebook
     dynamic_module.__dict__['get_ipython'] = get_ipython
 
     # do some extra work to ensure that magics that would affect the user_ns
-    # actually affect the notebook module's ns
-    save_user_ns = shell.user_ns
-    shell.user_ns = dynamic_module.__dict__
+    # actually affect the notebook module's ns (only for this run -- other threads keep their own)
+    restore_user_ns = set_notebook_user_ns(shell, dynamic_module.__dict__)
 
-    __add_parameter_frame(hooks)
+    try:
+        # dead cell elimination and profiling only apply to this notebook -- not to notebooks run by its cells
+        live_names = __receive_option(with_dead_cell_elimination=False)
+        with_profile = __receive_option(with_profile=False)
+        _current_options().update(with_dead_cell_elimination=False, with_profile=False)
+
+        if live_names and live_names is not True:
+            from .NotebookDataflow import plan_cells
+            plans = plan_cells([source for _, source, _ in cells], live_names)
+            cells = [cell for cell, plan in zip(cells, plans) if plan.run]
+
+        profiler = None
+        if with_profile:
+            from .NotebookProfiler import CellProfiler
+            profiler = CellProfiler(with_cprofile=with_profile == "cprofile")
+            profiler.start()
+
+        cell_timeout = __receive_option(with_cell_timeout=None)
+
+        def _run_cell(index, source, code_block):
+            # run the code in the module
+            if profiler:
+                profiler.run_cell(index, source, code_block, dynamic_module.__dict__)
+            else:
+                exec(code_block, dynamic_module.__dict__)
 
-    _, extension = os.path.splitext(path_to_notebook)
-    if extension == ".ipynb":
-        is_ipynb = True
-    else:
-        is_ipynb = False
+        run_cell = _run_cell
 
-    with io.open(path_to_notebook, 'r', encoding='utf-8') as f:
-        if is_ipynb:
-            notebook = read_notebook(f, 4)
-        else:
-            file_source = f.read()
+        if cell_timeout:
+            from .NotebookLimits import cell_timeout as _cell_timeout
+            _run_cell_without_timeout = run_cell
 
-    try:
-        if is_ipynb:
-            # execute ipynb notebook files
-            for cell in notebook.cells:
-                # loop over the code cells
-                if cell.cell_type == 'code':
-                    # transform the input to executable Python
-                    code = shell.input_transformer_manager.transform_cell(
-                        cell.source)
-
-                    # run the code in the module
-                    exec(code, dynamic_module.__dict__)
-
-                    # # inject caller provided values into the module namespace after execution of any hook cells
-                    # if 'metadata' in cell and 'NotebookScripterHookName' in cell.metadata:
-                    #     hook_name = cell.metadata["NotebookScripterHookName"]
-                    #     dynamic_module.__dict__.update(hooks.get(hook_name, {}))
-        else:
-            # execute .py files as notebooks
-            code = shell.input_transformer_manager.transform_cell(file_source)
+            def _run_cell_with_timeout(index, source, code_block):
+                with _cell_timeout(cell_timeout):
+                    _run_cell_without_timeout(index, source, code_block)
 
-            # run the code in the module, compile first to provide source mapping support
-            code_block = compile(code, path_to_notebook, 'exec')
-            exec(code_block, dynamic_module.__dict__)
-    finally:
-        shell.user_ns = save_user_ns
+            run_cell = _run_cell_with_timeout
 
-        # revert the magics changes ...
-        if unregister_magics:
-            unregister_magics()
+        if callable(__receive_option(with_events=None)):
+            import time
+            _run_cell_without_events = run_cell
 
-        # pop parameters stack
-        __pop_parameter_frame()
+            def _run_cell_with_events(index, source, code_block):
+                cell_token = _current_cell.set((path_to_notebook, index))
+                try:
+                    _emit_event("cell_started")
+                    started = time.perf_counter()
+                    try:
+                        _run_cell_without_events(index, source, code_block)
+                    except BaseException as e:
+                        _emit_event("cell_finished", {"elapsed": time.perf_counter() - started, "error": "{0}: {1}".format(type(e).__name__, e)})
+                        raise
+                    _emit_event("cell_finished", {"elapsed": time.perf_counter() - started, "error": None})
+                finally:
+                    _current_cell.reset(cell_token)
+
+            run_cell = _run_cell_with_events
+
+        try:
+            checkpoints = __receive_option(with_checkpoints=False)
+            if checkpoints:
+                from .NotebookCheckpoints import execute_with_checkpoints, checkpoint_directory_for
+                checkpoint_directory = checkpoints if isinstance(checkpoints, str) else checkpoint_directory_for(path_to_notebook)
+                execute_with_checkpoints(dynamic_module, path_to_notebook, cells, checkpoint_directory, __receive_option(with_checkpoint_budget=DEFAULT_CHECKPOINT_BUDGET), run_cell)
+            else:
+                for index, source, code_block in cells:
+                    run_cell(index, source, code_block)
+        finally:
+            if profiler:
+                profiler.stop()
+                dynamic_module.__dict__[PROFILE_NAME] = profiler.profiles
+    finally:
+        restore_user_ns()
 
-    return dynamic_module
+
+class NotebookScripterTimeoutError(TimeoutError):
+    """Raised when a notebook run exceeds the with_timeout, with_cell_timeout or with_cpu_time_limit options"""
 
 
 class NotebookScripterWrappedException(Exception):
@@ -276,40 +498,125 @@ class NotebookScripterWrappedException(Exception):
         return '%s\nOriginal traceback:\n%s' % (Exception.__str__(self), self.formatted)
 
 
-def worker(parent_to_child_queue, child_to_parent_queue, path_to_notebook, all_parent_parameters, **hooks):
+def worker(parent_to_child_queue, child_to_parent_queue, path_to_notebook, all_parent_parameters, event_queue=None, **hooks):
+    events = None
+    restore_streams = None
     try:
         global __notebookscripter_injected__
         # at this point we are in a new spawned -- and __notebook_scripter_injected__ is equal to [{}, {}]
         # update it to hold the value passed in from the calling process
         __notebookscripter_injected__ = all_parent_parameters
+        _apply_resource_limits()
+
+        if event_queue is not None and __receive_option(with_events=None):
+            # events are sent to the calling process -- which passes them to its with_events callback
+            from .NotebookEvents import QueueEventSink, capture_streams
+            events = QueueEventSink(event_queue)
+            __notebookscripter_injected__[-1][1]["with_events"] = events
+            restore_streams = capture_streams()
+
+        return_values = None
+        if __receive_option(with_dead_cell_elimination=False) is True:
+            # the cells to run depend on the requested return values -- wait for them before running the notebook
+            return_values = parent_to_child_queue.get()
+            __notebookscripter_injected__[-1][1]["with_dead_cell_elimination"] = list(return_values)
 
         # then run the notebook
         dynamic_module = run_notebook(path_to_notebook, **hooks)
 
         # now get the return values requested by the caller from the module, serialize them, then pass them back to the calling process
-        return_values = parent_to_child_queue.get()
+        if return_values is None:
+            return_values = parent_to_child_queue.get()
 
-        if return_values:
-            ret = serialize_return_values(dynamic_module.__dict__, return_values)
-            child_to_parent_queue.put((None, ret))
-        else:
-            child_to_parent_queue.put((None, {}))
+        ret = serialize_return_values(dynamic_module.__dict__, _with_profile(return_values, dynamic_module.__dict__))
+        result = (None, _for_process_transport(ret))
     except Exception:
         # if an exception occurred -- wrap it up and pass it back to the calling process
-        wrapped_exception = NotebookScripterWrappedException()
-        child_to_parent_queue.put((wrapped_exception, None))
+        result = (NotebookScripterWrappedException(), None)
+
+    if events is not None:
+        restore_streams()
+        # the end of the events is sent ahead of the result -- the calling process delivers all events before returning
+        events.close(path_to_notebook)
+    child_to_parent_queue.put(result)
     # worker subprocess done -- if join() is called in parent process when this process's thread of execution has gotten here it will not block
 
 
+def _apply_resource_limits():
+    """Apply the with_memory_limit and with_cpu_time_limit options to the current process -- or lift the limits of a previous run"""
+    memory_limit = __receive_option(with_memory_limit=None)
+    cpu_time_limit = __receive_option(with_cpu_time_limit=None)
+    if memory_limit is None and cpu_time_limit is None and __package__ + ".NotebookLimits" not in sys.modules:
+        return
+
+    from .NotebookLimits import apply_resource_limits
+    apply_resource_limits(memory_limit, cpu_time_limit)
+
+
+def _run_deadline():
+    """Return the time.monotonic() deadline of a run started now -- None without with_timeout"""
+    import time
+
+    timeout = __receive_option(with_timeout=None)
+    return None if timeout is None else time.monotonic() + timeout
+
+
+def _with_profile(return_values, namespace):
+    """The profile of a run (with_profile) is passed back along with the requested values"""
+    if PROFILE_NAME in namespace:
+        return list(return_values) + [PROFILE_NAME]
+    return return_values
+
+
+def _start_kernel_profiler():
+    with_profile = __receive_option(with_profile=False)
+    if with_profile:
+        from .NotebookProfiler import start_kernel_profiler
+        start_kernel_profiler(with_cprofile=with_profile == "cprofile")
+
+
+def _start_kernel_events():
+    if __receive_option(with_events=None):
+        # events of notebooks run by the kernel's cells are published to the calling process -- which relays them to its callback
+        from .NotebookEvents import publish_kernel_event
+        __notebookscripter_injected__[-1][1]["with_events"] = publish_kernel_event
+
+
+def _stop_kernel_profiler(namespace):
+    if __receive_option(with_profile=False):
+        from .NotebookProfiler import stop_kernel_profiler
+        namespace[PROFILE_NAME] = stop_kernel_profiler()
+
+
 def rehydrate(string_like):
     obj = str_to_obj(string_like)
     global __notebookscripter_injected__
     __notebookscripter_injected__ = obj
+    _apply_resource_limits()
+    _start_kernel_events()
+    _start_kernel_profiler()
 
 
 def dehydrate_return_values(namespace):
+    _stop_kernel_profiler(namespace)
+    names = __notebookscripter_injected__[-1][1].get("return_values", [])
+    return obj_to_string_literal(serialize_return_values(namespace, _with_profile(names, namespace)))
+
+
+def rehydrate_from_file(path):
+    from .NotebookTransport import load_from_file
+    global __notebookscripter_injected__
+    __notebookscripter_injected__ = load_from_file(path)
+    _apply_resource_limits()
+    _start_kernel_events()
+    _start_kernel_profiler()
+
+
+def dehydrate_return_values_to_file(namespace, path):
+    from .NotebookTransport import dump_to_file
+    _stop_kernel_profiler(namespace)
     names = __notebookscripter_injected__[-1][1].get("return_values", [])
-    return obj_to_string_literal(serialize_return_values(namespace, names))
+    dump_to_file(serialize_return_values(namespace, _with_profile(names, namespace)), path)
 
 
 def obj_to_string_literal(obj):
@@ -320,20 +627,317 @@ def str_to_obj(str_value):
     return pickle.loads(codecs.decode(str_value, "hex"))
 
 
+# maximum length of the repr substituted for values which can't be pickled or exceed the size budget
+OVERSIZED_REPR_LENGTH = 1000
+
+
+def _loads_serialized_value(data, buffers):
+    return pickle.loads(data, buffers=buffers)
+
+
+class SerializedValue(object):
+    """A value pickled (once) for transfer out of a subprocess or kernel
+
+    Pickling a SerializedValue reuses the bytes produced by serialize_value rather than pickling the
+    wrapped object again -- unpickling it rebuilds the wrapped object.  Large buffers are kept
+    out-of-band so that transports using pickle protocol 5 can move them without copying.
+    """
+
+    def __init__(self, data, buffers):
+        self.data = data
+        self.buffers = buffers
+        self.size = len(data) + sum(buffer.raw().nbytes for buffer in buffers)
+
+    def __reduce_ex__(self, protocol):
+        if protocol >= 5:
+            return (_loads_serialized_value, (self.data, self.buffers))
+        # older protocols can't carry PickleBuffers -- copy the raw buffer contents instead of re-pickling the object
+        return (_loads_serialized_value, (self.data, [bytearray(buffer.raw()) for buffer in self.buffers]))
+
+
+def serialize_value(obj):
+    """Pickle obj with protocol 5 -- returns a SerializedValue"""
+    buffers = []
+
+    def _collect_buffer(pickle_buffer):
+        try:
+            pickle_buffer.raw()
+        except BufferError:
+            # non-contiguous buffers are serialized in-band
+            return True
+        buffers.append(pickle_buffer)
+        return False
+
+    data = pickle.dumps(obj, protocol=5, buffer_callback=_collect_buffer)
+    return SerializedValue(data, buffers)
+
+
+class ReturnValues(dict):
+    """The values returned by a subprocess or kernel run -- pickling it reuses the values' SerializedValues
+
+    Before transport the dict holds the values themselves (or the reprs substituted for them).
+    """
+
+    def __init__(self, values=(), serialized=None):
+        super().__init__(values)
+        self.serialized = serialized
+
+    def __reduce_ex__(self, protocol):
+        # unpickles to a plain dict
+        return (dict, (dict(self) if self.serialized is None else self.serialized,))
+
+
+def _truncated_repr(obj):
+    text = repr(obj)
+    if len(text) > OVERSIZED_REPR_LENGTH:
+        text = text[:OVERSIZED_REPR_LENGTH - 3] + "..."
+    return text
+
+
 def serialize_return_values(namespace, names, to_string=False):
-    obj = {k: simple_serialize(namespace[k]) for k in names if k in namespace}
+    """Serialize the values of namespace named by names -- each value is pickled exactly once
+
+    With the with_return_sizes option the byte size of each serialized value is reported under the
+    __notebookscripter_return_sizes__ key.  Values which can't be pickled are replaced by their repr.  The with_max_return_value_bytes and
+    with_max_return_bytes options limit the size of individual values and of all values together --
+    values exceeding the limits raise ValueError or (with with_oversized_return_values="repr") are
+    replaced by their repr.
+    """
+    max_value_bytes = __receive_option(with_max_return_value_bytes=None)
+    max_total_bytes = __receive_option(with_max_return_bytes=None)
+    oversized = __receive_option(with_oversized_return_values="error")
+    if oversized not in ("error", "repr"):
+        raise ValueError(f"Unknown oversized return value handling: {oversized} -- valid values error,repr")
+
+    values = {}
+    serialized_values = {}
+    total_bytes = 0
+    for name in names:
+        if name not in namespace:
+            continue
+
+        value = namespace[name]
+        try:
+            serialized = serialize_value(value)
+        except Exception:
+            value = repr(value)
+            serialized = serialize_value(value)
+
+        too_large = None
+        if max_value_bytes is not None and serialized.size > max_value_bytes:
+            too_large = f"{serialized.size} bytes exceeds the per value limit of {max_value_bytes} bytes"
+        elif max_total_bytes is not None and total_bytes + serialized.size > max_total_bytes:
+            too_large = f"{serialized.size} bytes exceeds the remaining {max_total_bytes - total_bytes} bytes of the {max_total_bytes} byte limit for all return values"
+
+        if too_large:
+            if oversized == "error":
+                raise ValueError(f"Return value {name} is too large: {too_large}")
+            value = _truncated_repr(namespace[name])
+            serialized = serialize_value(value)
+
+        values[name] = value
+        serialized_values[name] = serialized
+        total_bytes += serialized.size
+
+    if __receive_option(with_return_sizes=False):
+        sizes = {name: serialized.size for name, serialized in serialized_values.items()}
+        values[RETURN_SIZES_NAME] = serialized_values[RETURN_SIZES_NAME] = sizes
+
+    obj = ReturnValues(values, serialized_values)
     if to_string:
         obj = obj_to_string_literal(obj)
     return obj
 
 
-def simple_serialize(obj):
-    try:
-        pickle.dumps(obj)
-        # if we didn't raise, then (theoretically) obj should be serializable ...
+def _for_process_transport(obj):
+    """Prepare obj to be sent to or from a subprocess -- with the shared memory transport large buffers are moved to shared memory"""
+    transport = __receive_option(with_process_transport="pipe")
+    if transport == "pipe":
         return obj
-    except Exception:
-        return repr(obj)
+    elif transport == "shared_memory":
+        if os.name == "nt":
+            # windows releases a segment when its last handle closes -- before the receiving process can attach to it
+            raise ValueError("The shared_memory process transport requires POSIX shared memory")
+        from .NotebookTransport import to_shared_memory
+        return to_shared_memory(obj)
+    else:
+        raise ValueError(f"Unknown process transport: {transport} -- valid transports pipe,shared_memory")
+
+
+def _parameters_for_process_transport(hooks):
+    """Return the parameter frames and hooks to send to a subprocess"""
+    return _for_process_transport(_transportable_parameter_frames()), {k: _for_process_transport(v) for k, v in hooks.items()}
+
+
+def _receive_from_child(child_to_parent_queue, process, deadline=None, events=None):
+    """Block until the child process sends its result -- raises if the child exits without sending one
+
+    When the deadline (a time.monotonic() value) passes first the child is terminated and NotebookScripterTimeoutError raised.
+    The events of the run (an EventReceiver) are delivered while waiting -- all of them before the result is returned.
+    """
+    import queue
+    import time
+
+    while True:
+        timeout = 1
+        if deadline is not None:
+            timeout = min(timeout, deadline - time.monotonic())
+            if timeout <= 0:
+                _terminate_process(process)
+                raise NotebookScripterTimeoutError("Notebook subprocess didn't complete within the with_timeout limit")
+        try:
+            if events is None:
+                return child_to_parent_queue.get(timeout=timeout)
+            events.wait(child_to_parent_queue, timeout)
+            result = child_to_parent_queue.get_nowait()
+            events.finish(process)
+            return result
+        except queue.Empty:
+            if not process.is_alive():
+                break
+
+    # the child may have exited right after flushing its result into the queue
+    try:
+        result = child_to_parent_queue.get(timeout=1)
+        if events is not None:
+            events.finish(process)
+        return result
+    except queue.Empty:
+        raise RuntimeError("Notebook subprocess exited unexpectedly with exit code {0}".format(process.exitcode))
+
+
+# modules the forkserver imports before forking workers -- NotebookScripter and IPython (via the embedded shell)
+FORKSERVER_PRELOAD = ("NotebookScripter._main", "NotebookScripter.NotebookEmbeddedShell")
+
+# start methods which give each run a fresh interpreter state
+_START_METHODS = ("spawn", "forkserver")
+
+
+def _process_context(preload_modules=()):
+    """Return the multiprocessing context used to start notebook subprocesses -- configured by with_start_method"""
+    import multiprocessing as mp
+
+    start_method = __receive_option(with_start_method="spawn")
+    if start_method not in _START_METHODS:
+        raise ValueError(f"Unknown start method: {start_method} -- valid start methods {','.join(_START_METHODS)}")
+
+    context = mp.get_context(start_method)
+    if start_method == "forkserver":
+        # only takes effect when the forkserver is started -- by the first forkserver process of the calling process
+        preload = list(FORKSERVER_PRELOAD)
+        if __receive_option(with_matplotlib_backend="agg"):
+            # each run imports matplotlib to select the backend -- the forkserver skips preload modules which aren't installed
+            preload.append("matplotlib")
+        for module_name in list(__receive_option(with_forkserver_preload=())) + list(preload_modules):
+            if module_name not in preload:
+                preload.append(module_name)
+        context.set_forkserver_preload(preload)
+    return context
+
+
+def _terminate_process(process):
+    """Stop process -- killing it if it ignores SIGTERM"""
+    process.terminate()
+    process.join(5)
+    if process.is_alive():
+        process.kill()
+        process.join()
+
+
+def _start_notebook_process(path_to_notebook, hooks):
+    """Start a subprocess running the notebook via worker -- returns the process, the queues used to talk to it and the receiver of its events (or None)"""
+    context = _process_context()
+    child_to_parent_queue = context.Queue()
+    parent_to_child_queue = context.Queue()
+    events = _event_receiver(context)
+
+    all_parent_parameters, hooks = _parameters_for_process_transport(hooks)
+    event_queue = events.event_queue if events is not None else None
+    p = context.Process(target=worker, args=(parent_to_child_queue, child_to_parent_queue, path_to_notebook, all_parent_parameters, event_queue), kwargs=hooks)
+    p.start()
+    return p, parent_to_child_queue, child_to_parent_queue, events
+
+
+def _event_receiver(context, event_queue=None):
+    """Return an EventReceiver passing the events of a subprocess run to the with_events callback -- None without a callback
+
+    Args:
+        context: The multiprocessing context of the subprocess
+        event_queue: The queue the subprocess sends its events through -- by default a new (bounded) queue
+    """
+    on_event = __receive_option(with_events=None)
+    if not callable(on_event):
+        return None
+
+    from .NotebookEvents import EventReceiver, EVENT_BUFFER_SIZE
+    return EventReceiver(event_queue if event_queue is not None else context.Queue(EVENT_BUFFER_SIZE), on_event)
+
+
+@contextlib.contextmanager
+def _finishing_listeners(listeners):
+    """Finish each kernel listener when the with block exits -- a listener failing to finish doesn't keep the others from
+    finishing, and doesn't replace the exception of a failed run"""
+    def _finish_all():
+        errors = []
+        for listener in listeners:
+            try:
+                listener.finish()
+            except Exception as e:
+                errors.append(e)
+        return errors
+
+    try:
+        yield
+    except BaseException:
+        _finish_all()
+        raise
+    errors = _finish_all()
+    if errors:
+        raise errors[0]
+
+
+def _kernel_listeners(path_to_notebook, parameterized_notebook, save_output_notebook):
+    """Return the listeners applying the output options and with_events to a kernel run -- attached to its NotebookClient in order
+
+    Listeners intercept the client's outputs as they arrive -- the event relay comes last so that it sees every output.  Each
+    listener's finish() is called once execution has ended, whether or not it succeeded.
+    """
+    listeners = []
+
+    outputs = __receive_option(with_jupyter_outputs="auto")
+    if outputs not in ("auto", "lean", "full"):
+        raise ValueError(f"Unknown jupyter outputs mode: {outputs} -- valid modes auto,lean,full")
+    if outputs == "lean" or (outputs == "auto" and not save_output_notebook):
+        from .NotebookOutputs import LeanOutputs
+        # the last cell passes back the return values
+        listeners.append(LeanOutputs([len(parameterized_notebook["cells"]) - 1]))
+
+    sidecars = __receive_option(with_output_sidecars=False)
+    if sidecars and isinstance(save_output_notebook, str):
+        from .NotebookOutputs import OutputSidecars
+        listeners.append(OutputSidecars(save_output_notebook, 0 if sidecars is True else sidecars))
+
+    write_interval = __receive_option(with_output_notebook_interval=1)
+    if write_interval is not None and isinstance(save_output_notebook, str):
+        from .NotebookOutputs import IncrementalNotebookWriter
+        listeners.append(IncrementalNotebookWriter(save_output_notebook, parameterized_notebook, write_interval))
+
+    on_event = __receive_option(with_events=None)
+    if callable(on_event):
+        from .NotebookEvents import KernelEventRelay
+        listeners.append(KernelEventRelay(path_to_notebook, parameterized_notebook, on_event))
+    return listeners
+
+
+def _module_from_namespace(path_to_notebook, final_namespace):
+    """Package values retrieved from a subprocess or kernel in a newly created (anonymous) python module"""
+    module_identity = "loaded_notebook_from_subprocess"
+    dynamic_module = types.ModuleType(module_identity)
+    dynamic_module.__file__ = path_to_notebook
+
+    # inject retrieved return values into the returned module namespace
+    dynamic_module.__dict__.update(final_namespace)
+    return dynamic_module
 
 
 def run_notebook_in_process(
@@ -353,15 +957,33 @@ def run_notebook_in_process(
         populated with requested values retrieved from the subprocess
     """
 
-    import multiprocessing as mp
-    import atexit
+    return _with_result_cache(path_to_notebook, hooks, lambda: _start_run_in_process(path_to_notebook, hooks))
 
-    context = mp.get_context("spawn")
-    child_to_parent_queue = context.Queue()
-    parent_to_child_queue = context.Queue()
 
-    p = context.Process(target=worker, args=(parent_to_child_queue, child_to_parent_queue, path_to_notebook, __notebookscripter_injected__), kwargs=hooks)
-    p.start()
+def _with_result_cache(path_to_notebook, hooks, start_run):
+    """Start a run via start_run -- going through the result cache when with_result_cache is set"""
+    result_cache = __receive_option(with_result_cache=False)
+    if not result_cache:
+        return start_run()
+
+    from .NotebookResultCache import cached_run, run_key, result_cache_directory_for
+    key = run_key(path_to_notebook, _current_parameter_frames(), hooks)
+    if key is None:
+        # parameters which can't be hashed -- run without the cache
+        return start_run()
+
+    directory = result_cache if isinstance(result_cache, str) else result_cache_directory_for(path_to_notebook)
+    budget = __receive_option(with_result_cache_budget=DEFAULT_RESULT_CACHE_BUDGET)
+    # the run may only be started once the closure is called -- start it with the parameters and options of this call
+    context = contextvars.copy_context()
+    return cached_run(path_to_notebook, directory, budget, key, lambda: context.run(start_run))
+
+
+def _start_run_in_process(path_to_notebook, hooks):
+    import atexit
+
+    deadline = _run_deadline()
+    p, parent_to_child_queue, child_to_parent_queue, events = _start_notebook_process(path_to_notebook, hooks)
 
     def _terminate_when_parent_process_ends():
         p.terminate()
@@ -383,110 +1005,189 @@ def run_notebook_in_process(
 
         parent_to_child_queue.put(return_values)
 
-        module_identity = "loaded_notebook_from_subprocess"
-        dynamic_module = types.ModuleType(module_identity)
-        dynamic_module.__file__ = path_to_notebook
-
-        err, final_namespace = child_to_parent_queue.get()
+        err, final_namespace = _receive_from_child(child_to_parent_queue, p, deadline, events)
         p.join()
 
         if err:
             raise err
 
-        # inject retrieved return values into the returned module namespace
-        dynamic_module.__dict__.update(final_namespace)
-
-        return dynamic_module
+        return _module_from_namespace(path_to_notebook, final_namespace)
 
     return _block_and_receive_results
 
 
-def run_notebook_in_jupyter(path_to_notebook: str,
-                            **hooks
-                            ) -> None:
-    """Run a notebook via a jupyter ipython kernel 
+def _read_notebook_for_jupyter(path_to_notebook):
+    from .NotebookIpynbReader import read_lean_notebook, to_notebook_node
+    from .NotebookPyFileReader import read_pyfile_as_notebook
 
-    Returns a closure which when called will block until the execution has completed.
+    _, extension = os.path.splitext(path_to_notebook)
+    if extension == ".ipynb":
+        # stored outputs are replaced when the kernel executes the notebook -- don't decode them
+        lean_notebook = read_lean_notebook(path_to_notebook, validate=__receive_option(with_notebook_validation=False), with_attachments=True)
+        return to_notebook_node(lean_notebook)
+    else:
+        return read_pyfile_as_notebook(path_to_notebook)
 
-    *args Arguments passed to the closure will retrieve values from the executed kernel and package them in an (anonymous) python module with the requested values retrieved from the exrecuted subprocess.  
-    The closure also accepts a save_output_notebook parameter which is none by default -- if provided it should be a file path where the executed notebook with computed output cells will be written.
 
-    Args:
-        path_to_notebook: Path to .ipynb or .py file containing notebook code
-    Returns:
-        Returns a closure which will block until the notebook execution completes then return a newly created (anonymous) python module
-        populated with requested values retrieved from the subprocess
-    """
-    from nbconvert.preprocessors.execute import executenb
-    from nbformat import write as write_notebook
+@contextlib.contextmanager
+def _jupyter_transport_directory():
+    """Provide a temporary directory for sidecar files when the "file" jupyter transport is selected -- None for the inline transport"""
+    transport = __receive_option(with_jupyter_transport="inline")
+    if transport == "inline":
+        yield None
+    elif transport == "file":
+        import shutil
+        import tempfile
+
+        transport_directory = tempfile.mkdtemp(prefix="notebookscripter-")
+        try:
+            yield transport_directory
+        finally:
+            shutil.rmtree(transport_directory, ignore_errors=True)
+    else:
+        raise ValueError(f"Unknown jupyter transport: {transport} -- valid transports inline,file")
+
+
+def _parameterize_notebook(notebook, hooks, return_values, transport_directory=None):
+    """Return a copy of notebook with cells added to inject parameters and to retrieve return values"""
+    import copy
     from nbformat.notebooknode import from_dict as notebook_node_from_dict
 
-    from jupyter_client import KernelManager
-    from .NotebookPyFileReader import read_pyfile_as_notebook
+    # add an extra cell to beginning of notebook to populate parameters
+    notebook_parameters = _transportable_parameter_frames() + [[hooks, {"return_values": return_values}]]
 
-    _, extension = os.path.splitext(path_to_notebook)
-    if extension == ".ipynb":
-        is_ipynb = True
-    else:
-        is_ipynb = False
+    if transport_directory:
+        from .NotebookTransport import dump_to_file
 
-    with open(path_to_notebook, 'r') as f:
-        if is_ipynb:
-            notebook = read_notebook(f, 4)
-        else:
-            notebook = read_pyfile_as_notebook(path_to_notebook)
+        parameters_path = os.path.join(transport_directory, "parameters.pickle")
+        results_path = os.path.join(transport_directory, "results.pickle")
+        dump_to_file(notebook_parameters, parameters_path)
 
-    def _block_and_receive_results(*return_values, save_output_notebook=None):
+        initialization_source = """from NotebookScripter import (rehydrate_from_file as __rehydrate_from_file__, dehydrate_return_values_to_file as __dehydrate_return_values_to_file__)
+__rehydrate_from_file__({0!r})""".format(parameters_path)
 
-        # add an extra cell to beginning of notebook to populate parameters
-        notebook_parameters = __notebookscripter_injected__ + [[hooks, {"return_values": return_values}]]
+        finalization_source = """__dehydrate_return_values_to_file__(locals(), {0!r})""".format(results_path)
+    else:
         base64_parameters = obj_to_string_literal(notebook_parameters)
 
         initialization_source = """from NotebookScripter import (rehydrate as __rehydrate__, dehydrate_return_values as __dehydrate_return_values__)
 __rehydrate__({})""".format(base64_parameters)
 
-        initialization_cell = notebook_node_from_dict({
-            "cell_type": "code",
-            "execution_count": 0,
-            "metadata": {},
-            "outputs": [],
-            "source": initialization_source
-        })
-
         finalization_source = """__dehydrate_return_values__(locals())"""
 
-        finalization_cell = notebook_node_from_dict({
-            "cell_type": "code",
-            "execution_count": 0,
-            "metadata": {},
-            "outputs": [],
-            "source": finalization_source})
-
-        notebook['cells'].insert(0, initialization_cell)
-        notebook['cells'].append(finalization_cell)
-
-        km = KernelManager()
-        # hack -- needed because the code within ExecutePreprocessor.start_kernel to start
-        # the kernel when km hasn't started a kernel already can't possibly work
-        km.start_kernel()
-        executed_notebook = executenb(notebook, timeout=None, km=km)
-        km.shutdown_kernel()
-
-        if save_output_notebook:
-            if isinstance(save_output_notebook, str):
-                with open(save_output_notebook, 'w') as f:
-                    write_notebook(executed_notebook, f)
-            else:
-                write_notebook(executed_notebook, save_output_notebook)
+    initialization_cell = notebook_node_from_dict({
+        "cell_type": "code",
+        "execution_count": 0,
+        "metadata": {},
+        "outputs": [],
+        "source": initialization_source
+    })
+
+    finalization_cell = notebook_node_from_dict({
+        "cell_type": "code",
+        "execution_count": 0,
+        "metadata": {},
+        "outputs": [],
+        "source": finalization_source})
+
+    # copy so that the closure can be called more than once
+    parameterized_notebook = copy.deepcopy(notebook)
+    parameterized_notebook['cells'].insert(0, initialization_cell)
+    parameterized_notebook['cells'].append(finalization_cell)
+    return parameterized_notebook
+
+
+def _receive_jupyter_results(path_to_notebook, executed_notebook, save_output_notebook, transport_directory=None):
+    """Write the executed notebook if requested and package the returned values in an (anonymous) module"""
+    from nbformat import write as write_notebook
+
+    if save_output_notebook:
+        if isinstance(save_output_notebook, str):
+            from .NotebookOutputs import write_atomic
+            # replaces any partial notebook written while the kernel ran
+            write_atomic(save_output_notebook, lambda f: write_notebook(executed_notebook, f))
+        else:
+            write_notebook(executed_notebook, save_output_notebook)
 
+    if transport_directory:
+        from .NotebookTransport import load_from_file
+        final_namespace = load_from_file(os.path.join(transport_directory, "results.pickle"))
+    else:
         encoded_return_values = eval(executed_notebook["cells"][-1]["outputs"][0]["data"]["text/plain"])
         final_namespace = str_to_obj(encoded_return_values)
 
-        module_identity = "loaded_notebook_from_subprocess"
-        dynamic_module = types.ModuleType(module_identity)
-        dynamic_module.__file__ = path_to_notebook
+    return _module_from_namespace(path_to_notebook, final_namespace)
+
+
+def _run_timeouts():
+    """Return the with_cell_timeout option and the deadline of a run started now"""
+    return __receive_option(with_cell_timeout=None), _run_deadline()
+
 
-        # inject retrieved return values into the returned module namespace
-        dynamic_module.__dict__.update(final_namespace)
-        return dynamic_module
+def _kernel_timeouts():
+    """Return the NotebookClient arguments enforcing with_cell_timeout and with_timeout for a kernel run started now -- and the run's deadline"""
+    import time
+
+    cell_timeout, deadline = _run_timeouts()
+    arguments = {"timeout": cell_timeout}
+    if deadline is not None:
+        def _timeout_func(cell):
+            # nbclient treats a timeout of 0 as no timeout at all
+            remaining = max(deadline - time.monotonic(), 0.001)
+            return remaining if cell_timeout is None else min(remaining, cell_timeout)
+
+        arguments["timeout_func"] = _timeout_func
+    return arguments, deadline
+
+
+@contextlib.contextmanager
+def _raising_kernel_timeouts(deadline):
+    """Raise NotebookScripterTimeoutError when nbclient stops a cell because of a timeout"""
+    import time
+
+    try:
+        yield
+    except TimeoutError as e:
+        if isinstance(e, NotebookScripterTimeoutError):
+            raise
+        if deadline is not None and time.monotonic() >= deadline:
+            raise NotebookScripterTimeoutError("Notebook kernel run didn't complete within the with_timeout limit") from e
+        raise NotebookScripterTimeoutError("Notebook cell exceeded the with_cell_timeout limit") from e
+
+
+def run_notebook_in_jupyter(path_to_notebook: str,
+                            **hooks
+                            ) -> None:
+    """Run a notebook via a jupyter ipython kernel 
+
+    Returns a closure which when called will block until the execution has completed.
+
+    *args Arguments passed to the closure will retrieve values from the executed kernel and package them in an (anonymous) python module with the requested values retrieved from the exrecuted subprocess.  
+    The closure also accepts a save_output_notebook parameter which is none by default -- if provided it should be a file path where the executed notebook with computed output cells will be written.
+
+    Args:
+        path_to_notebook: Path to .ipynb or .py file containing notebook code
+    Returns:
+        Returns a closure which will block until the notebook execution completes then return a newly created (anonymous) python module
+        populated with requested values retrieved from the subprocess
+    """
+    from nbclient import NotebookClient
+    from jupyter_client.kernelspec import NATIVE_KERNEL_NAME
+
+    notebook = _read_notebook_for_jupyter(path_to_notebook)
+
+    def _block_and_receive_results(*return_values, save_output_notebook=None):
+        with _jupyter_transport_directory() as transport_directory:
+            parameterized_notebook = _parameterize_notebook(notebook, hooks, return_values, transport_directory)
+
+            # the client owns the kernel -- it is shut down when execution completes or fails (including on a timeout)
+            timeouts, deadline = _kernel_timeouts()
+            client = NotebookClient(parameterized_notebook, kernel_name=NATIVE_KERNEL_NAME, **timeouts)
+            listeners = _kernel_listeners(path_to_notebook, parameterized_notebook, save_output_notebook)
+            for listener in listeners:
+                listener.attach(client)
+            with _finishing_listeners(listeners), _raising_kernel_timeouts(deadline):
+                executed_notebook = client.execute()
+
+            return _receive_jupyter_results(path_to_notebook, executed_notebook, save_output_notebook, transport_directory)
     return _block_and_receive_results
@@ -0,0 +1,50 @@
+"""Benchmarks of running notebooks in process, in a subprocess and in a jupyter kernel"""
+
+import pytest
+
+import NotebookScripter
+from synthetic import final_state
+
+
+@pytest.mark.parametrize("extension", [".ipynb", ".py"])
+@pytest.mark.parametrize("cells", [10, 100, 1000, 10000])
+def bench_run_notebook(benchmark, synthetic_notebook, code_cache_enabled, cells, extension):
+    path = synthetic_notebook(cells, extension)
+    module = benchmark(NotebookScripter.run_notebook, path)
+    assert module.state == final_state(cells)
+
+
+@pytest.mark.parametrize("cells", [10, 100])
+def bench_prepared_notebook(benchmark, synthetic_notebook, code_cache_enabled, cells):
+    # compare with bench_run_notebook -- the per-call setup of run_notebook is done once
+    prepared = NotebookScripter.prepare_notebook(synthetic_notebook(cells, ".py"))
+    module = benchmark(prepared)
+    assert module.state == final_state(cells)
+
+
+@pytest.mark.parametrize("start_method", ["spawn", "forkserver"])
+@pytest.mark.parametrize("cells", [10, 1000])
+def bench_run_notebook_in_process(benchmark, synthetic_notebook, code_cache_enabled, cells, start_method):
+    # dominated by starting the subprocess for small notebooks
+    path = synthetic_notebook(cells)
+    NotebookScripter.set_notebook_option(with_start_method=start_method)
+
+    def _run():
+        return NotebookScripter.run_notebook_in_process(path)("state")
+
+    try:
+        module = benchmark.pedantic(_run, rounds=5, warmup_rounds=1)
+    finally:
+        NotebookScripter.set_notebook_option(with_start_method="spawn")
+    assert module.state == final_state(cells)
+
+
+@pytest.mark.parametrize("cells", [10, 100])
+def bench_run_notebook_in_jupyter(benchmark, synthetic_notebook, cells):
+    path = synthetic_notebook(cells)
+
+    def _run():
+        return NotebookScripter.run_notebook_in_jupyter(path)("state")
+
+    module = benchmark.pedantic(_run, rounds=3, warmup_rounds=1)
+    assert module.state == final_state(cells)
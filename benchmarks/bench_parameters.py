@@ -0,0 +1,32 @@
+"""Benchmarks of receive_parameter with deeply nested parameter frames"""
+
+import pytest
+
+import NotebookScripter
+from NotebookScripter._main import _ParameterFrame, _current_frame
+
+
+def _nested_frames(depth, parameters):
+    # frames as created by depth nested run_notebook calls -- the outermost call provides parameters
+    frame = _ParameterFrame(None, parameters)
+    for i in range(depth - 1):
+        frame = _ParameterFrame(frame, {"other_{0}".format(i): i})
+    return frame
+
+
+@pytest.mark.parametrize("depth", [1, 10, 100, 1000])
+def bench_receive_parameter(benchmark, depth):
+    token = _current_frame.set(_nested_frames(depth, {"width": 10}))
+    try:
+        assert benchmark(NotebookScripter.receive_parameter, width=0) == 10
+    finally:
+        _current_frame.reset(token)
+
+
+@pytest.mark.parametrize("depth", [1, 10, 100, 1000])
+def bench_receive_missing_parameter(benchmark, depth):
+    token = _current_frame.set(_nested_frames(depth, {}))
+    try:
+        assert benchmark(NotebookScripter.receive_parameter, width=0) == 0
+    finally:
+        _current_frame.reset(token)
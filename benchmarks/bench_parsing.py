@@ -0,0 +1,24 @@
+"""Benchmarks of loading the code cells of .ipynb and .py notebooks -- with and without the code cache"""
+
+import pytest
+
+from NotebookScripter._main import _get_shell
+from NotebookScripter.NotebookCodeCache import load_notebook_cells
+
+
+@pytest.mark.parametrize("extension", [".ipynb", ".py"])
+@pytest.mark.parametrize("cells", [10, 100, 1000, 10000])
+def bench_parse_notebook(benchmark, synthetic_notebook, cells, extension):
+    path = synthetic_notebook(cells, extension)
+    transform_cell = _get_shell().input_transformer_manager.transform_cell
+    benchmark(load_notebook_cells, path, transform_cell, use_cache=False)
+
+
+@pytest.mark.parametrize("extension", [".ipynb", ".py"])
+@pytest.mark.parametrize("cells", [10, 100, 1000, 10000])
+def bench_load_cached_notebook(benchmark, synthetic_notebook, code_cache_enabled, cells, extension):
+    path = synthetic_notebook(cells, extension)
+    transform_cell = _get_shell().input_transformer_manager.transform_cell
+    # populate the cache entry
+    load_notebook_cells(path, transform_cell)
+    benchmark(load_notebook_cells, path, transform_cell)
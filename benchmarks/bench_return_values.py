@@ -0,0 +1,54 @@
+"""Benchmarks of passing return values back from subprocess and kernel runs at several payload sizes"""
+
+import os
+from unittest.mock import patch
+
+import pytest
+
+import NotebookScripter
+from NotebookScripter._main import serialize_return_values
+
+PAYLOAD_SIZES = [1 << 10, 1 << 20, 1 << 26]
+
+PAYLOAD_NOTEBOOK = """# %%
+from NotebookScripter import receive_parameter
+payload = bytearray(receive_parameter(size=0))
+"""
+
+
+@pytest.fixture(scope="module")
+def payload_notebook(tmp_path_factory):
+    path = os.path.join(str(tmp_path_factory.mktemp("payload")), "Payload.py")
+    with open(path, "w") as f:
+        f.write(PAYLOAD_NOTEBOOK)
+    return path
+
+
+@pytest.mark.parametrize("size", PAYLOAD_SIZES)
+def bench_serialize_return_values(benchmark, size):
+    namespace = {"payload": bytearray(size)}
+    benchmark(serialize_return_values, namespace, ["payload"])
+
+
+@pytest.mark.parametrize("transport", ["pipe", "shared_memory"])
+@pytest.mark.parametrize("size", PAYLOAD_SIZES)
+def bench_return_from_process(benchmark, payload_notebook, size, transport):
+    def _run():
+        with patch('NotebookScripter._main.__notebookscripter_injected__', [[{}, {}]]):
+            NotebookScripter.set_notebook_option(with_process_transport=transport)
+            return NotebookScripter.run_notebook_in_process(payload_notebook, size=size)("payload")
+
+    module = benchmark.pedantic(_run, rounds=5, warmup_rounds=1)
+    assert len(module.payload) == size
+
+
+@pytest.mark.parametrize("transport", ["inline", "file"])
+@pytest.mark.parametrize("size", PAYLOAD_SIZES[:2])
+def bench_return_from_jupyter(benchmark, payload_notebook, size, transport):
+    def _run():
+        with patch('NotebookScripter._main.__notebookscripter_injected__', [[{}, {}]]):
+            NotebookScripter.set_notebook_option(with_jupyter_transport=transport)
+            return NotebookScripter.run_notebook_in_jupyter(payload_notebook, size=size)("payload")
+
+    module = benchmark.pedantic(_run, rounds=3, warmup_rounds=1)
+    assert len(module.payload) == size
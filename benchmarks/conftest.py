@@ -0,0 +1,44 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from synthetic import write_notebook  # noqa: E402 pylint: disable=wrong-import-position
+
+# notebook sizes (in cells) of the synthetic notebooks
+NOTEBOOK_SIZES = (10, 100, 1000, 10000)
+
+
+def pytest_addoption(parser):
+    parser.addoption("--max-cells", type=int, default=max(NOTEBOOK_SIZES), help="skip benchmarks of synthetic notebooks with more cells")
+
+
+def pytest_collection_modifyitems(config, items):
+    max_cells = config.getoption("--max-cells")
+    skip = pytest.mark.skip(reason="more than --max-cells cells")
+    for item in items:
+        callspec = getattr(item, "callspec", None)
+        if callspec is not None and callspec.params.get("cells", 0) > max_cells:
+            item.add_marker(skip)
+
+
+@pytest.fixture(scope="session")
+def synthetic_notebook(tmp_path_factory):
+    """Factory returning the path of a synthetic notebook with the given number of cells and extension"""
+    directory = str(tmp_path_factory.mktemp("notebooks"))
+    written = {}
+
+    def _synthetic_notebook(cells, extension=".ipynb"):
+        if (cells, extension) not in written:
+            written[(cells, extension)] = write_notebook(directory, cells, extension)
+        return written[(cells, extension)]
+
+    return _synthetic_notebook
+
+
+@pytest.fixture
+def code_cache_enabled(monkeypatch):
+    """Let the code cache write entries even when PYTHONDONTWRITEBYTECODE is set"""
+    monkeypatch.setattr(sys, "dont_write_bytecode", False)
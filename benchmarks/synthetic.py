@@ -0,0 +1,65 @@
+"""Generate synthetic notebooks of a given size for the benchmarks.
+
+The first code cell receives a parameter, every following code cell defines a function and applies it
+to the notebook state -- so cells depend on each other the way analysis notebooks usually do.  Every
+tenth cell is a markdown cell.  The .ipynb and .py variants of a notebook hold the same cells.
+"""
+
+import os
+
+import nbformat
+
+FIRST_CELL = "from NotebookScripter import receive_parameter\nstate = list(range(receive_parameter(width=10)))\n"
+
+CODE_CELL = """def step_{0}(values):
+    return [value + {0} for value in values]
+
+state = step_{0}(state)
+"""
+
+MARKDOWN_CELL = "## Step {0}\n\nSome explanation of the next steps."
+
+
+def synthetic_cells(cells):
+    """Return a list of (cell_type, source) pairs -- cells in total"""
+    result = [("code", FIRST_CELL)]
+    for i in range(1, cells):
+        if i % 10 == 0:
+            result.append(("markdown", MARKDOWN_CELL.format(i)))
+        else:
+            result.append(("code", CODE_CELL.format(i)))
+    return result
+
+
+def write_ipynb(path, cells):
+    notebook = nbformat.v4.new_notebook()
+    notebook.cells = [
+        nbformat.v4.new_code_cell(source) if cell_type == "code" else nbformat.v4.new_markdown_cell(source)
+        for cell_type, source in synthetic_cells(cells)
+    ]
+    nbformat.write(notebook, path)
+
+
+def write_py(path, cells):
+    with open(path, "w") as f:
+        for cell_type, source in synthetic_cells(cells):
+            if cell_type == "code":
+                f.write("# %%\n" + source + "\n")
+            else:
+                f.write("# %% [markdown]\n" + "".join("# " + line + "\n" for line in source.splitlines()) + "\n")
+
+
+def write_notebook(directory, cells, extension):
+    """Write a synthetic notebook with the given number of cells -- returns its path"""
+    path = os.path.join(directory, "Synthetic{0}{1}".format(cells, extension))
+    if extension == ".ipynb":
+        write_ipynb(path, cells)
+    else:
+        write_py(path, cells)
+    return path
+
+
+def final_state(cells, width=10):
+    """The value of state after running a synthetic notebook"""
+    offset = sum(i for i in range(1, cells) if i % 10 != 0)
+    return [value + offset for value in range(width)]
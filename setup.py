@@ -2,21 +2,28 @@ from setuptools import setup
 
 setup(
     name='NotebookScripter',
-    version='6.0.0',
+    version='6.1.0',
     packages=('NotebookScripter',),
     url='https://github.com/breathe/NotebookScripter',
     license='MIT',
     author='N. Ben Cohen',
     author_email='breathevalue@icloud.com',
+    entry_points={
+        "console_scripts": ["notebookscripter=NotebookScripter.NotebookCli:main"],
+    },
     install_requires=(
         "ipython",
         "nbformat"
     ),
+    extras_require={
+        "checkpoints": ("cloudpickle",),
+    },
     tests_require=(
         "nose",
         "coverage",
         "snapshottest",
-        "matplotlib"
+        "matplotlib",
+        "cloudpickle"
     ),
     description='Expose ipython jupyter notebooks as callable functions.  More info here https://github.com/breathe/NotebookScripter',
     long_description='Expose ipython jupyter notebooks as callable functions.  More info here https://github.com/breathe/NotebookScripter',
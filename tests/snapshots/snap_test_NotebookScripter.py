@@ -7,11 +7,11 @@ from snapshottest import Snapshot
 
 snapshots = Snapshot()
 
-snapshots['TestNotebookExecution::test_magics_are_unregistered 1'] = 'matplotlib'
+snapshots['TestExecutePyFileAsNotebook::test_magics_are_unregistered 1'] = 'matplotlib'
 
-snapshots['TestNotebookExecution::test_run_notebook 1'] = 'Hello default world'
+snapshots['TestExecutePyFileAsNotebook::test_run_notebook 1'] = 'Hello default world'
 
-snapshots['TestNotebookExecution::test_run_notebook_in_jupyter 1'] = {
+snapshots['TestExecutePyFileAsNotebook::test_run_notebook_in_jupyter 1'] = {
     '__doc__': None,
     '__loader__': None,
     '__name__': 'loaded_notebook_from_subprocess',
@@ -21,7 +21,7 @@ snapshots['TestNotebookExecution::test_run_notebook_in_jupyter 1'] = {
     'parameterized_name': 'default world'
 }
 
-snapshots['TestNotebookExecution::test_run_notebook_in_jupyter_with_hooks 1'] = {
+snapshots['TestExecutePyFileAsNotebook::test_run_notebook_in_jupyter_with_hooks 1'] = {
     '__doc__': None,
     '__loader__': None,
     '__name__': 'loaded_notebook_from_subprocess',
@@ -32,7 +32,7 @@ snapshots['TestNotebookExecution::test_run_notebook_in_jupyter_with_hooks 1'] =
     'parameterized_name': 'external world'
 }
 
-snapshots['TestNotebookExecution::test_run_notebook_in_jupyter_with_hooks 2'] = {
+snapshots['TestExecutePyFileAsNotebook::test_run_notebook_in_jupyter_with_hooks 2'] = {
     '__doc__': None,
     '__loader__': None,
     '__name__': 'loaded_notebook_from_subprocess',
@@ -43,7 +43,7 @@ snapshots['TestNotebookExecution::test_run_notebook_in_jupyter_with_hooks 2'] =
     'parameterized_name': 'external world2'
 }
 
-snapshots['TestNotebookExecution::test_run_notebook_in_process 1'] = {
+snapshots['TestExecutePyFileAsNotebook::test_run_notebook_in_process 1'] = {
     '__doc__': None,
     '__loader__': None,
     '__name__': 'loaded_notebook_from_subprocess',
@@ -53,7 +53,7 @@ snapshots['TestNotebookExecution::test_run_notebook_in_process 1'] = {
     'parameterized_name': 'default world'
 }
 
-snapshots['TestNotebookExecution::test_run_notebook_in_process_with_hooks 1'] = {
+snapshots['TestExecutePyFileAsNotebook::test_run_notebook_in_process_with_hooks 1'] = {
     '__doc__': None,
     '__loader__': None,
     '__name__': 'loaded_notebook_from_subprocess',
@@ -64,7 +64,7 @@ snapshots['TestNotebookExecution::test_run_notebook_in_process_with_hooks 1'] =
     'parameterized_name': 'external world'
 }
 
-snapshots['TestNotebookExecution::test_run_notebook_in_process_with_hooks 2'] = {
+snapshots['TestExecutePyFileAsNotebook::test_run_notebook_in_process_with_hooks 2'] = {
     '__doc__': None,
     '__loader__': None,
     '__name__': 'loaded_notebook_from_subprocess',
@@ -75,21 +75,26 @@ snapshots['TestNotebookExecution::test_run_notebook_in_process_with_hooks 2'] =
     'parameterized_name': 'external world2'
 }
 
-snapshots['TestNotebookExecution::test_run_notebook_with_hooks1 1'] = 'Hello external world'
+snapshots['TestExecutePyFileAsNotebook::test_run_notebook_with_hooks1 1'] = 'Hello external world'
 
-snapshots['TestNotebookExecution::test_run_notebook_with_hooks2 1'] = 'Salut external world2'
+snapshots['TestExecutePyFileAsNotebook::test_run_notebook_with_hooks2 1'] = 'Salut external world2'
 
-snapshots['TestWorkerExecution::test_worker 1'] = {
+snapshots['TestJupyterFileTransport::test_run_notebook_in_jupyter_with_file_transport 1'] = {
+    '__doc__': None,
+    '__loader__': None,
+    '__name__': 'loaded_notebook_from_subprocess',
+    '__package__': None,
+    '__spec__': None,
     'french_mode': None,
     'greeting_string': 'Hello {0}',
     'parameterized_name': 'external world'
 }
 
-snapshots['TestExecutePyFileAsNotebook::test_magics_are_unregistered 1'] = 'matplotlib'
+snapshots['TestNotebookExecution::test_magics_are_unregistered 1'] = 'matplotlib'
 
-snapshots['TestExecutePyFileAsNotebook::test_run_notebook 1'] = 'Hello default world'
+snapshots['TestNotebookExecution::test_run_notebook 1'] = 'Hello default world'
 
-snapshots['TestExecutePyFileAsNotebook::test_run_notebook_in_jupyter 1'] = {
+snapshots['TestNotebookExecution::test_run_notebook_in_jupyter 1'] = {
     '__doc__': None,
     '__loader__': None,
     '__name__': 'loaded_notebook_from_subprocess',
@@ -99,7 +104,7 @@ snapshots['TestExecutePyFileAsNotebook::test_run_notebook_in_jupyter 1'] = {
     'parameterized_name': 'default world'
 }
 
-snapshots['TestExecutePyFileAsNotebook::test_run_notebook_in_jupyter_with_hooks 1'] = {
+snapshots['TestNotebookExecution::test_run_notebook_in_jupyter_with_hooks 1'] = {
     '__doc__': None,
     '__loader__': None,
     '__name__': 'loaded_notebook_from_subprocess',
@@ -110,7 +115,7 @@ snapshots['TestExecutePyFileAsNotebook::test_run_notebook_in_jupyter_with_hooks
     'parameterized_name': 'external world'
 }
 
-snapshots['TestExecutePyFileAsNotebook::test_run_notebook_in_jupyter_with_hooks 2'] = {
+snapshots['TestNotebookExecution::test_run_notebook_in_jupyter_with_hooks 2'] = {
     '__doc__': None,
     '__loader__': None,
     '__name__': 'loaded_notebook_from_subprocess',
@@ -121,7 +126,7 @@ snapshots['TestExecutePyFileAsNotebook::test_run_notebook_in_jupyter_with_hooks
     'parameterized_name': 'external world2'
 }
 
-snapshots['TestExecutePyFileAsNotebook::test_run_notebook_in_process 1'] = {
+snapshots['TestNotebookExecution::test_run_notebook_in_process 1'] = {
     '__doc__': None,
     '__loader__': None,
     '__name__': 'loaded_notebook_from_subprocess',
@@ -131,7 +136,7 @@ snapshots['TestExecutePyFileAsNotebook::test_run_notebook_in_process 1'] = {
     'parameterized_name': 'default world'
 }
 
-snapshots['TestExecutePyFileAsNotebook::test_run_notebook_in_process_with_hooks 1'] = {
+snapshots['TestNotebookExecution::test_run_notebook_in_process_with_hooks 1'] = {
     '__doc__': None,
     '__loader__': None,
     '__name__': 'loaded_notebook_from_subprocess',
@@ -142,7 +147,7 @@ snapshots['TestExecutePyFileAsNotebook::test_run_notebook_in_process_with_hooks
     'parameterized_name': 'external world'
 }
 
-snapshots['TestExecutePyFileAsNotebook::test_run_notebook_in_process_with_hooks 2'] = {
+snapshots['TestNotebookExecution::test_run_notebook_in_process_with_hooks 2'] = {
     '__doc__': None,
     '__loader__': None,
     '__name__': 'loaded_notebook_from_subprocess',
@@ -153,10 +158,60 @@ snapshots['TestExecutePyFileAsNotebook::test_run_notebook_in_process_with_hooks
     'parameterized_name': 'external world2'
 }
 
-snapshots['TestExecutePyFileAsNotebook::test_run_notebook_with_hooks1 1'] = 'Hello external world'
+snapshots['TestNotebookExecution::test_run_notebook_with_hooks1 1'] = 'Hello external world'
 
-snapshots['TestExecutePyFileAsNotebook::test_run_notebook_with_hooks2 1'] = 'Salut external world2'
+snapshots['TestNotebookExecution::test_run_notebook_with_hooks2 1'] = 'Salut external world2'
+
+snapshots['TestNotebookKernelPool::test_run_notebook_in_kernel_pool 1'] = {
+    '__doc__': None,
+    '__loader__': None,
+    '__name__': 'loaded_notebook_from_subprocess',
+    '__package__': None,
+    '__spec__': None,
+    'french_mode': None,
+    'greeting_string': 'Hello {0}',
+    'parameterized_name': 'external world'
+}
+
+snapshots['TestNotebookProcessPool::test_run_notebook_in_pool 1'] = {
+    '__doc__': None,
+    '__loader__': None,
+    '__name__': 'loaded_notebook_from_subprocess',
+    '__package__': None,
+    '__spec__': None,
+    'french_mode': None,
+    'greeting_string': 'Hello {0}',
+    'parameterized_name': 'external world'
+}
+
+snapshots['TestNotebookProcessPool::test_run_notebook_in_pool 2'] = {
+    '__doc__': None,
+    '__loader__': None,
+    '__name__': 'loaded_notebook_from_subprocess',
+    '__package__': None,
+    '__spec__': None,
+    'french_mode': True,
+    'greeting_string': 'Salut {0}',
+    'parameterized_name': 'external world2'
+}
 
 snapshots['TestRecursiveNotebookExecution::test_run 1'] = 'Case 1 Expecting a string'
 
 snapshots['TestRecursiveNotebookExecution::test_run 2'] = 'Case 2 Expecting a string'
+
+snapshots['TestSharedMemoryTransport::test_run_notebook_in_process_with_shared_memory 1'] = {
+    '__doc__': None,
+    '__loader__': None,
+    '__name__': 'loaded_notebook_from_subprocess',
+    '__package__': None,
+    '__spec__': None,
+    'french_mode': None,
+    'greeting_string': 'Hello {0}',
+    'parameterized_name': 'external world'
+}
+
+snapshots['TestWorkerExecution::test_worker 1'] = {
+    'french_mode': None,
+    'greeting_string': 'Hello {0}',
+    'parameterized_name': 'external world'
+}
@@ -1,8 +1,19 @@
+import asyncio
+import importlib
+import importlib.util
+import json
 import os
+import pickle
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
 import snapshottest
 
 import NotebookScripter
 from NotebookScripter._main import worker
+from NotebookScripter.NotebookCodeCache import cache_path_for
 
 from unittest.mock import patch
 
@@ -13,6 +24,9 @@ def filterKeys(aDict, filtered):
 
 # pylint: disable=E1101
 
+# checkpoints of notebooks defining functions need cloudpickle
+HAS_CLOUDPICKLE = importlib.util.find_spec("cloudpickle") is not None
+
 
 class TestNotebookExecution(snapshottest.TestCase):
     def setUp(self):
@@ -157,3 +171,1353 @@ class TestException(snapshottest.TestCase):
     def test_run_in_subprocess_with_exception(self):
         run_in_process = NotebookScripter.run_notebook_in_process(self.notebook_file)
         self.assertRaises(NotebookScripter.NotebookScripterWrappedException, run_in_process)
+
+
+class TestCodeCache(snapshottest.TestCase):
+    """Test the on-disk cache of compiled notebook code"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.notebook_file = os.path.join(self.directory, "Cached.py")
+        with open(self.notebook_file, "w") as f:
+            f.write("value = 'first'\n")
+
+        # the cache honors PYTHONDONTWRITEBYTECODE like the regular bytecode cache does
+        dont_write_bytecode = patch.object(sys, "dont_write_bytecode", False)
+        dont_write_bytecode.start()
+        self.addCleanup(dont_write_bytecode.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_cache_entry_is_written(self):
+        mod = NotebookScripter.run_notebook(self.notebook_file)
+        self.assertEqual(mod.value, "first")
+        self.assertTrue(os.path.isfile(cache_path_for(self.notebook_file)))
+
+    def test_changed_notebook_is_recompiled(self):
+        NotebookScripter.run_notebook(self.notebook_file)
+        with open(self.notebook_file, "w") as f:
+            f.write("value = 'second, and longer'\n")
+        mod = NotebookScripter.run_notebook(self.notebook_file)
+        self.assertEqual(mod.value, "second, and longer")
+
+    def test_cache_can_be_disabled(self):
+        with patch('NotebookScripter._main.__notebookscripter_injected__', [[{}, {}]]):
+            NotebookScripter.set_notebook_option(with_code_cache=False)
+            mod = NotebookScripter.run_notebook(self.notebook_file)
+        self.assertEqual(mod.value, "first")
+        self.assertFalse(os.path.exists(cache_path_for(self.notebook_file)))
+
+
+class TestNotebookImporter(snapshottest.TestCase):
+    """Test importing notebooks via the sys.meta_path finder"""
+
+    def setUp(self):
+        self.finder = NotebookScripter.install_notebook_importer()
+
+    def tearDown(self):
+        NotebookScripter.uninstall_notebook_importer(self.finder)
+        sys.modules.pop("tests.Samples", None)
+        sys.modules["tests"].__dict__.pop("Samples", None)
+
+    def test_import_notebook(self):
+        from tests import Samples
+        self.assertEqual(Samples.hello(), "Hello default world")
+        self.assertTrue(Samples.__file__.endswith("Samples.ipynb"))
+
+    def test_uninstall(self):
+        NotebookScripter.uninstall_notebook_importer(self.finder)
+        with self.assertRaises(ImportError):
+            importlib.import_module("tests.Samples")
+
+
+class TestNotebookProcessPool(snapshottest.TestCase):
+    """Test running notebooks on warm pool workers"""
+
+    def setUp(self):
+        self.notebook_file = os.path.join(os.path.dirname(__file__), "./Samples.ipynb")
+        self.directory = tempfile.mkdtemp()
+        self.pid_notebook_file = os.path.join(self.directory, "Pid.py")
+        with open(self.pid_notebook_file, "w") as f:
+            f.write("import os, sys\npid = os.getpid()\npreloaded = 'colorsys' in sys.modules\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_run_notebook_in_pool(self):
+        return_values = ["parameterized_name", "french_mode", "greeting_string"]
+        with NotebookScripter.NotebookProcessPool(processes=1) as pool:
+            mod = pool.run_notebook_in_process(self.notebook_file, parameterized_name="external world")(*return_values)
+            self.assertMatchSnapshot(filterKeys(mod.__dict__, ["__file__"]))
+
+            mod = pool.run_notebook_in_process(self.notebook_file, parameterized_name="external world2", french_mode=True)(*return_values)
+            self.assertMatchSnapshot(filterKeys(mod.__dict__, ["__file__"]))
+
+    def test_workers_are_reused_and_recycled(self):
+        with NotebookScripter.NotebookProcessPool(processes=1, max_tasks_per_child=2, preload_modules=["colorsys"]) as pool:
+            mods = [pool.run_notebook_in_process(self.pid_notebook_file)("pid", "preloaded") for _ in range(3)]
+
+        self.assertEqual(mods[0].pid, mods[1].pid)
+        self.assertNotEqual(mods[1].pid, mods[2].pid)
+        self.assertTrue(all(mod.preloaded for mod in mods))
+
+    def test_exception_in_pool(self):
+        exception_notebook = os.path.join(os.path.dirname(__file__), "./TestException.pynotebook")
+        with NotebookScripter.NotebookProcessPool(processes=1) as pool:
+            self.assertRaises(NotebookScripter.NotebookScripterWrappedException, pool.run_notebook_in_process(exception_notebook))
+            mod = pool.run_notebook_in_process(self.pid_notebook_file)("pid")
+            self.assertTrue(mod.pid)
+
+    def test_holding_every_worker_raises(self):
+        with NotebookScripter.NotebookProcessPool(processes=1) as pool:
+            run = pool.run_notebook_in_process(self.pid_notebook_file)
+            self.assertRaises(RuntimeError, pool.run_notebook_in_process, self.pid_notebook_file)
+            first_pid = run("pid").pid
+            self.assertEqual(pool.run_notebook_in_process(self.pid_notebook_file)("pid").pid, first_pid)
+
+
+class TestRunNotebookMap(snapshottest.TestCase):
+    """Test parameter sweeps via run_notebook_map"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.notebook_file = os.path.join(self.directory, "Square.py")
+        with open(self.notebook_file, "w") as f:
+            f.write("from NotebookScripter import receive_parameter\nx = receive_parameter(x=0)\nassert x != 3\nsquare = x * x\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_ordered_map(self):
+        parameter_sets = ({"x": x} for x in range(6))
+        results = list(NotebookScripter.run_notebook_map(self.notebook_file, parameter_sets, return_values=["square"], max_workers=2, chunksize=2, ordered=True))
+
+        self.assertEqual([result.index for result in results], list(range(6)))
+        self.assertEqual([result.module.square for result in results if result.module], [0, 1, 4, 16, 25])
+        self.assertIsInstance(results[3].exception, NotebookScripter.NotebookScripterWrappedException)
+        self.assertEqual(results[3].parameters, {"x": 3})
+
+    def test_unordered_map_with_pool(self):
+        with NotebookScripter.NotebookProcessPool(processes=2) as pool:
+            results = list(NotebookScripter.run_notebook_map(self.notebook_file, [{"x": x} for x in range(4)], return_values=["square"], pool=pool))
+        self.assertEqual(sorted(result.index for result in results), list(range(4)))
+        self.assertEqual({result.index: result.module.square for result in results if result.module}, {0: 0, 1: 1, 2: 4})
+
+    def test_map_inherits_parameters_of_enclosing_run(self):
+        sweep_file = os.path.join(self.directory, "Sweep.py")
+        with open(sweep_file, "w") as f:
+            f.write("from NotebookScripter import receive_parameter, run_notebook_map\nsquare_notebook = receive_parameter(square_notebook=None)\n"
+                    "squares = [result.module.square for result in run_notebook_map(square_notebook, [{}], return_values=['square'], max_workers=1)]\n")
+        mod = NotebookScripter.prepare_notebook(sweep_file)(square_notebook=self.notebook_file, x=5)
+        self.assertEqual(mod.squares, [25])
+
+
+class TestNotebookFutures(snapshottest.TestCase):
+    """Test the concurrent.futures and asyncio interfaces"""
+
+    def setUp(self):
+        self.notebook_file = os.path.join(os.path.dirname(__file__), "./Samples.ipynb")
+        self.directory = tempfile.mkdtemp()
+        self.slow_notebook_file = os.path.join(self.directory, "Slow.py")
+        with open(self.slow_notebook_file, "w") as f:
+            f.write("import time\ntime.sleep(600)\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_process_future(self):
+        future = NotebookScripter.run_notebook_in_process_future(self.notebook_file, parameterized_name="external world")("parameterized_name")
+        mod = future.result(timeout=300)
+        self.assertTrue(future.done())
+        self.assertEqual(mod.parameterized_name, "external world")
+
+    def test_unreadable_result_fails_only_its_future(self):
+        unreadable_notebook_file = os.path.join(self.directory, "Unreadable.py")
+        with open(unreadable_notebook_file, "w") as f:
+            # pickles fine in the subprocess -- unpickling it raises in the calling process
+            f.write("class Unreadable(object):\n    def __reduce__(self):\n        return (int, ('not a number',))\nvalue = Unreadable()\n")
+        failing = NotebookScripter.run_notebook_in_process_future(unreadable_notebook_file)("value")
+        with self.assertRaises(ValueError):
+            failing.result(timeout=300)
+
+        future = NotebookScripter.run_notebook_in_process_future(self.notebook_file, parameterized_name="after")("parameterized_name")
+        self.assertEqual(future.result(timeout=300).parameterized_name, "after")
+
+    def test_process_future_cancel(self):
+        future = NotebookScripter.run_notebook_in_process_future(self.slow_notebook_file)()
+        self.assertFalse(future.done())
+        self.assertTrue(future.cancel())
+        self.assertTrue(future.cancelled())
+
+    def test_process_async_gather(self):
+        async def run_both():
+            return await asyncio.gather(
+                NotebookScripter.run_notebook_in_process_async(self.notebook_file, parameterized_name="a")("parameterized_name"),
+                NotebookScripter.run_notebook_in_process_async(self.notebook_file, parameterized_name="b")("parameterized_name"))
+
+        mods = asyncio.run(run_both())
+        self.assertEqual([mod.parameterized_name for mod in mods], ["a", "b"])
+
+    def test_process_async_timeout(self):
+        async def run_slow():
+            return await asyncio.wait_for(NotebookScripter.run_notebook_in_process_async(self.slow_notebook_file)(), timeout=1)
+
+        self.assertRaises(asyncio.TimeoutError, asyncio.run, run_slow())
+
+    def test_jupyter_async(self):
+        mod = asyncio.run(NotebookScripter.run_notebook_in_jupyter_async(self.notebook_file, parameterized_name="external world")("parameterized_name"))
+        self.assertEqual(mod.parameterized_name, "external world")
+
+    def test_jupyter_future(self):
+        future = NotebookScripter.run_notebook_in_jupyter_future(self.notebook_file, french_mode=True)("french_mode")
+        self.assertEqual(future.result(timeout=300).french_mode, True)
+
+
+class TestNotebookKernelPool(snapshottest.TestCase):
+    """Test running notebooks on warm jupyter kernels"""
+
+    def setUp(self):
+        self.notebook_file = os.path.join(os.path.dirname(__file__), "./Samples.ipynb")
+        self.directory = tempfile.mkdtemp()
+        self.pid_notebook_file = os.path.join(self.directory, "KernelPid.py")
+        with open(self.pid_notebook_file, "w") as f:
+            f.write("# %%\nimport os\nhad_marker = 'marker' in globals()\nmarker = True\npid = os.getpid()\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_run_notebook_in_kernel_pool(self):
+        return_values = ["parameterized_name", "french_mode", "greeting_string"]
+        with NotebookScripter.NotebookKernelPool() as pool:
+            mod = pool.run_notebook_in_jupyter(self.notebook_file, parameterized_name="external world")(*return_values)
+            self.assertMatchSnapshot(filterKeys(mod.__dict__, ["__file__"]))
+
+    def test_kernels_are_reset_and_restarted(self):
+        with NotebookScripter.NotebookKernelPool(kernels=1, max_uses_per_kernel=2) as pool:
+            mods = [pool.run_notebook_in_jupyter(self.pid_notebook_file)("pid", "had_marker") for _ in range(3)]
+
+        self.assertEqual(mods[0].pid, mods[1].pid)
+        self.assertNotEqual(mods[1].pid, mods[2].pid)
+        self.assertFalse(any(mod.had_marker for mod in mods))
+
+
+class TestJupyterFileTransport(snapshottest.TestCase):
+    """Test passing parameters and return values to jupyter kernels via sidecar files"""
+
+    def setUp(self):
+        self.notebook_file = os.path.join(os.path.dirname(__file__), "./Samples.ipynb")
+        self.directory = tempfile.mkdtemp()
+        self.array_notebook_file = os.path.join(self.directory, "Arrays.py")
+        with open(self.array_notebook_file, "w") as f:
+            f.write("# %%\nimport numpy\nfrom NotebookScripter import receive_parameter\nvalues = receive_parameter(values=None)\ndoubled = values * 2\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_run_notebook_in_jupyter_with_file_transport(self):
+        return_values = ["parameterized_name", "french_mode", "greeting_string"]
+        with patch('NotebookScripter._main.__notebookscripter_injected__', [[{}, {}]]):
+            NotebookScripter.set_notebook_option(with_jupyter_transport="file")
+            mod = NotebookScripter.run_notebook_in_jupyter(self.notebook_file, parameterized_name="external world")(*return_values)
+        self.assertMatchSnapshot(filterKeys(mod.__dict__, ["__file__"]))
+
+    def test_arrays_round_trip(self):
+        import numpy
+        values = numpy.arange(100000, dtype=numpy.float64)
+        with patch('NotebookScripter._main.__notebookscripter_injected__', [[{}, {}]]):
+            NotebookScripter.set_notebook_option(with_jupyter_transport="file")
+            mod = NotebookScripter.run_notebook_in_jupyter(self.array_notebook_file, values=values)("doubled")
+        self.assertTrue(numpy.array_equal(mod.doubled, values * 2))
+
+    def test_sidecar_file_buffers_are_out_of_band(self):
+        import numpy
+        from NotebookScripter.NotebookTransport import dump_to_file, load_from_file
+        values = {"array": numpy.arange(1000, dtype=numpy.int64), "name": "sidecar"}
+        path = os.path.join(self.directory, "values.pickle")
+        dump_to_file(values, path)
+        loaded = load_from_file(path)
+        self.assertEqual(loaded["name"], "sidecar")
+        self.assertTrue(numpy.array_equal(loaded["array"], values["array"]))
+        self.assertEqual(loaded["array"].ctypes.data % 64, 0)
+
+    def test_unknown_transport(self):
+        with patch('NotebookScripter._main.__notebookscripter_injected__', [[{}, {}]]):
+            NotebookScripter.set_notebook_option(with_jupyter_transport="carrier_pigeon")
+            with self.assertRaises(ValueError):
+                NotebookScripter.run_notebook_in_jupyter(self.notebook_file)()
+
+
+class TestSharedMemoryTransport(snapshottest.TestCase):
+    """Test passing parameters and return values to subprocesses via shared memory"""
+
+    def setUp(self):
+        self.notebook_file = os.path.join(os.path.dirname(__file__), "./Samples.ipynb")
+        self.directory = tempfile.mkdtemp()
+        self.array_notebook_file = os.path.join(self.directory, "Arrays.py")
+        with open(self.array_notebook_file, "w") as f:
+            f.write("# %%\nfrom NotebookScripter import receive_parameter\nvalues = receive_parameter(values=None)\ndoubled = values * 2\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_run_notebook_in_process_with_shared_memory(self):
+        return_values = ["parameterized_name", "french_mode", "greeting_string"]
+        with patch('NotebookScripter._main.__notebookscripter_injected__', [[{}, {}]]):
+            NotebookScripter.set_notebook_option(with_process_transport="shared_memory")
+            mod = NotebookScripter.run_notebook_in_process(self.notebook_file, parameterized_name="external world")(*return_values)
+        self.assertMatchSnapshot(filterKeys(mod.__dict__, ["__file__"]))
+
+    def test_arrays_round_trip(self):
+        import numpy
+        values = numpy.arange(100000, dtype=numpy.float64)
+        with patch('NotebookScripter._main.__notebookscripter_injected__', [[{}, {}]]):
+            NotebookScripter.set_notebook_option(with_process_transport="shared_memory")
+            mod = NotebookScripter.run_notebook_in_process(self.array_notebook_file, values=values)("doubled")
+            with NotebookScripter.NotebookProcessPool(processes=1) as pool:
+                pool_mod = pool.run_notebook_in_process(self.array_notebook_file, values=values)("doubled")
+        self.assertTrue(numpy.array_equal(mod.doubled, values * 2))
+        self.assertTrue(numpy.array_equal(pool_mod.doubled, values * 2))
+
+    def test_segment_is_unlinked_when_received(self):
+        import pickle
+        import numpy
+        from multiprocessing import shared_memory
+        from NotebookScripter.NotebookTransport import to_shared_memory
+        values = {"array": numpy.arange(1000, dtype=numpy.int64), "name": "shared"}
+        payload = to_shared_memory(values)
+        received = pickle.loads(pickle.dumps(payload))
+        self.assertEqual(received["name"], "shared")
+        self.assertTrue(numpy.array_equal(received["array"], values["array"]))
+        with self.assertRaises(FileNotFoundError):
+            shared_memory.SharedMemory(name=payload.segment_name)
+
+    def test_values_without_buffers_are_unchanged(self):
+        from NotebookScripter.NotebookTransport import to_shared_memory
+        values = {"name": "shared"}
+        self.assertIs(to_shared_memory(values), values)
+
+
+class CountingReduce(object):
+    reductions = 0
+
+    def __reduce__(self):
+        CountingReduce.reductions += 1
+        return (CountingReduce, ())
+
+
+class TestReturnValueSerialization(snapshottest.TestCase):
+    """Test single pass, size limited serialization of return values"""
+
+    def setUp(self):
+        self.notebook_file = os.path.join(os.path.dirname(__file__), "./Samples.ipynb")
+        self.namespace = {"small": "x", "large": "x" * 10000, "also_large": "y" * 10000}
+
+    def serialize(self, names, **options):
+        from NotebookScripter._main import serialize_return_values
+        with patch('NotebookScripter._main.__notebookscripter_injected__', [[{}, {}]]):
+            NotebookScripter.set_notebook_option(**options)
+            return pickle.loads(pickle.dumps(serialize_return_values(self.namespace, names)))
+
+    def test_values_are_pickled_once(self):
+        from NotebookScripter._main import serialize_return_values
+        CountingReduce.reductions = 0
+        serialized = serialize_return_values({"counted": CountingReduce()}, ["counted"])
+        pickle.loads(pickle.dumps(serialized))
+        self.assertEqual(CountingReduce.reductions, 1)
+
+    def test_sizes_are_reported(self):
+        self.assertNotIn("__notebookscripter_return_sizes__", self.serialize(["small"]))
+        result = self.serialize(["small", "large", "missing"], with_return_sizes=True)
+        self.assertEqual(result["large"], self.namespace["large"])
+        self.assertEqual(set(result["__notebookscripter_return_sizes__"]), {"small", "large"})
+        self.assertGreater(result["__notebookscripter_return_sizes__"]["large"], 10000)
+
+    def test_per_value_limit(self):
+        with self.assertRaises(ValueError):
+            self.serialize(["small", "large"], with_max_return_value_bytes=1000)
+
+        result = self.serialize(["small", "large"], with_max_return_value_bytes=1000, with_oversized_return_values="repr", with_return_sizes=True)
+        self.assertEqual(result["small"], "x")
+        self.assertTrue(result["large"].endswith("..."))
+        self.assertLess(result["__notebookscripter_return_sizes__"]["large"], 1100)
+
+    def test_total_limit(self):
+        with self.assertRaises(ValueError):
+            self.serialize(["large", "also_large"], with_max_return_bytes=15000)
+
+        result = self.serialize(["large", "also_large"], with_max_return_bytes=15000, with_oversized_return_values="repr")
+        self.assertEqual(result["large"], self.namespace["large"])
+        self.assertTrue(result["also_large"].endswith("..."))
+
+    def test_limit_in_subprocess(self):
+        with patch('NotebookScripter._main.__notebookscripter_injected__', [[{}, {}]]):
+            NotebookScripter.set_notebook_option(with_max_return_value_bytes=10)
+            with self.assertRaises(NotebookScripter.NotebookScripterWrappedException):
+                NotebookScripter.run_notebook_in_process(self.notebook_file)("greeting_string")
+
+
+class TestCheckpoints(snapshottest.TestCase):
+    """Test resuming notebook execution from cell checkpoints"""
+
+    def setUp(self):
+        import nbformat
+        self.directory = tempfile.mkdtemp()
+        self.notebook_file = os.path.join(self.directory, "Checkpointed.ipynb")
+        self.checkpoint_directory = os.path.join(self.directory, "checkpoints")
+        self.log_file = os.path.join(self.directory, "log")
+        self.notebook = nbformat.v4.new_notebook()
+        self.notebook.cells = [
+            nbformat.v4.new_code_cell("from NotebookScripter import receive_parameter\nlog = receive_parameter(log=None)\nopen(log, 'a').write('0')\nbase = receive_parameter(base=1)"),
+            nbformat.v4.new_code_cell("open(log, 'a').write('1')\ndef scale(x):\n    return x * base\nvalue = scale(10)"),
+            nbformat.v4.new_code_cell("open(log, 'a').write('2')\nresult = value + 1"),
+        ]
+        self.write_notebook()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_notebook(self):
+        import nbformat
+        nbformat.write(self.notebook, self.notebook_file)
+
+    def run_and_read_log(self, base, **options):
+        if os.path.exists(self.log_file):
+            os.unlink(self.log_file)
+        with patch('NotebookScripter._main.__notebookscripter_injected__', [[{}, {}]]):
+            NotebookScripter.set_notebook_option(with_checkpoints=self.checkpoint_directory, **options)
+            mod = NotebookScripter.run_notebook(self.notebook_file, log=self.log_file, base=base)
+        log = open(self.log_file).read() if os.path.exists(self.log_file) else ""
+        return mod, log
+
+    @unittest.skipUnless(HAS_CLOUDPICKLE, "checkpointing functions requires cloudpickle")
+    def test_resume_from_unchanged_cells(self):
+        mod, log = self.run_and_read_log(1)
+        self.assertEqual((mod.result, log), (11, "012"))
+
+        mod, log = self.run_and_read_log(1)
+        self.assertEqual((mod.result, log), (11, ""))
+        # functions restored from a checkpoint see the module namespace
+        self.assertIs(mod.scale.__globals__, mod.__dict__)
+
+        self.notebook.cells[2].source = "open(log, 'a').write('2')\nresult = value + 2"
+        self.write_notebook()
+        mod, log = self.run_and_read_log(1)
+        self.assertEqual((mod.result, log), (12, "2"))
+
+    def test_changed_parameter_reruns_cells(self):
+        self.run_and_read_log(1)
+        mod, log = self.run_and_read_log(2)
+        self.assertEqual((mod.result, log), (21, "012"))
+
+    def test_budget_removes_snapshots(self):
+        self.run_and_read_log(1, with_checkpoint_budget=0)
+        self.assertFalse([name for name in os.listdir(self.checkpoint_directory) if name.endswith(".snapshot")])
+        mod, log = self.run_and_read_log(1, with_checkpoint_budget=0)
+        self.assertEqual((mod.result, log), (11, "012"))
+
+    def test_keys_are_stable_across_processes(self):
+        notebook_file = os.path.join(self.directory, "Tagged.py")
+        with open(notebook_file, "w") as f:
+            f.write("# %%\nfrom NotebookScripter import receive_parameter\nlog = receive_parameter(log=None)\ntags = receive_parameter(tags=None)\n"
+                    "# %%\nopen(log, 'a').write('1')\ncount = len(tags)\n")
+        script = ("import NotebookScripter\nNotebookScripter.set_notebook_option(with_checkpoints={0!r})\n"
+                  "NotebookScripter.run_notebook({1!r}, log={2!r}, tags=frozenset('tag%d' % i for i in range(20)))\n").format(
+                      self.checkpoint_directory, notebook_file, self.log_file)
+        for hash_seed in ("1", "2"):
+            # set and frozenset ordering depends on the hash seed of the process
+            subprocess.run([sys.executable, "-c", script], check=True, env=dict(os.environ, PYTHONHASHSEED=hash_seed))
+        self.assertEqual(open(self.log_file).read(), "1")
+
+    @unittest.skipUnless(HAS_CLOUDPICKLE, "checkpointing functions requires cloudpickle")
+    def test_budget_counts_manifests(self):
+        def checkpoint_bytes():
+            return sum(os.path.getsize(os.path.join(self.checkpoint_directory, name)) for name in os.listdir(self.checkpoint_directory))
+
+        self.run_and_read_log(1)
+        budget = 2 * checkpoint_bytes()
+        for edit in range(10):
+            # every edit of the first cell starts a new chain of manifests and snapshots
+            self.notebook.cells[0].source += "\n# edit {0}".format(edit)
+            self.write_notebook()
+            self.run_and_read_log(1, with_checkpoint_budget=budget)
+            self.assertLessEqual(checkpoint_bytes(), budget)
+
+        mod, log = self.run_and_read_log(1, with_checkpoint_budget=budget)
+        self.assertEqual((mod.result, log), (11, ""))
+
+
+class TestDeadCellElimination(snapshottest.TestCase):
+    """Test skipping cells which don't contribute to the requested values"""
+
+    def setUp(self):
+        import nbformat
+        self.directory = tempfile.mkdtemp()
+        self.notebook_file = os.path.join(self.directory, "Dataflow.ipynb")
+        self.log_file = os.path.join(self.directory, "log")
+        notebook = nbformat.v4.new_notebook()
+        notebook.cells = [
+            nbformat.v4.new_code_cell("from NotebookScripter import receive_parameter\nn = receive_parameter(n=3)\nlog = receive_parameter(log=None)"),
+            nbformat.v4.new_code_cell("data = list(range(n))\nopen(log, 'a').write('data ')"),
+            nbformat.v4.new_code_cell("diagnostics = [x * 2 for x in data]\nopen(log, 'a').write('diagnostics ')"),
+            nbformat.v4.new_code_cell("result = sum(data)\nopen(log, 'a').write('result ')"),
+        ]
+        nbformat.write(notebook, self.notebook_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_plan_cells(self):
+        from NotebookScripter.NotebookDataflow import plan_cells
+        sources = [
+            "import numpy as np\nn = 3",
+            "data = np.arange(n)",
+            "import matplotlib.pyplot as plt\nplt.plot(data)",
+            "def bump():\n    global counter\n    counter += 1\ncounter = 0",
+            "bump()",
+            "get_ipython().run_line_magic('matplotlib', 'inline')",
+            "print(data)",
+        ]
+        # plt.plot may mutate data -- unlike the print builtin
+        self.assertEqual([plan.run for plan in plan_cells(sources, ["data", "counter"])], [True, True, True, True, True, True, False])
+
+    def test_plan_cells_with_library_mutators(self):
+        from NotebookScripter.NotebookDataflow import plan_cells
+        sources = [
+            "import os, sys, random\ndata = [1, 2, 3]\nclass Config: pass\ncfg = Config()",
+            "random.seed(1); random.shuffle(data); setattr(cfg, 'flag', 1)",
+            "sys.path.insert(0, 'lib')",
+            "os.environ['MODE'] = 'fast'",
+            "unused = 1",
+            "first = data[0]; flag = getattr(cfg, 'flag', None)",
+            "import helpers\nhelped = helpers.run()",
+        ]
+        self.assertEqual([plan.run for plan in plan_cells(sources, ["first", "flag"])], [True, True, False, False, False, True, False])
+        self.assertEqual([plan.run for plan in plan_cells(sources, ["helped"])], [True, False, True, True, False, False, True])
+
+    def test_run_notebook_with_library_mutators(self):
+        notebook_file = os.path.join(self.directory, "Mutators.py")
+        with open(notebook_file, "w") as f:
+            f.write("# %%\nimport random\ndata = [1, 2, 3]\nclass Config: pass\ncfg = Config()\n"
+                    "# %%\nrandom.seed(1); random.shuffle(data); setattr(cfg, 'flag', 1)\n"
+                    "# %%\nfirst = data[0]; flag = getattr(cfg, 'flag', None)\n")
+        full = NotebookScripter.run_notebook(notebook_file)
+        with patch('NotebookScripter._main.__notebookscripter_injected__', [[{}, {}]]):
+            NotebookScripter.set_notebook_option(with_dead_cell_elimination=["first", "flag"])
+            mod = NotebookScripter.run_notebook(notebook_file)
+        self.assertEqual((mod.first, mod.flag), (full.first, full.flag))
+        self.assertEqual(mod.flag, 1)
+
+    def test_plan_cells_with_function_reads(self):
+        from NotebookScripter.NotebookDataflow import plan_cells
+        sources = [
+            "def scaled(x): return x * factor",
+            "factor = 10",
+            "def twice(x): return scaled(x) + offset",
+            "offset = 1",
+            "unused = 2",
+            "result = twice(2)",
+        ]
+        self.assertEqual([plan.run for plan in plan_cells(sources, ["result"])], [True, True, True, True, False, True])
+
+    def test_run_notebook_with_function_reads(self):
+        notebook_file = os.path.join(self.directory, "Globals.py")
+        with open(notebook_file, "w") as f:
+            f.write("# %%\ndef scaled(x): return x*factor\n# %%\nfactor = 10\n# %%\nresult = scaled(2)\n")
+        with patch('NotebookScripter._main.__notebookscripter_injected__', [[{}, {}]]):
+            NotebookScripter.set_notebook_option(with_dead_cell_elimination=["result"])
+            mod = NotebookScripter.run_notebook(notebook_file)
+        self.assertEqual(mod.result, 20)
+
+    def test_run_notebook_with_names(self):
+        with patch('NotebookScripter._main.__notebookscripter_injected__', [[{}, {}]]):
+            NotebookScripter.set_notebook_option(with_dead_cell_elimination=["result"])
+            mod = NotebookScripter.run_notebook(self.notebook_file, n=4, log=self.log_file)
+        self.assertEqual(mod.result, 6)
+        self.assertFalse(hasattr(mod, "diagnostics"))
+        self.assertEqual(open(self.log_file).read(), "data result ")
+
+    def test_run_notebook_in_process_with_requested_names(self):
+        with patch('NotebookScripter._main.__notebookscripter_injected__', [[{}, {}]]):
+            NotebookScripter.set_notebook_option(with_dead_cell_elimination=True)
+            mod = NotebookScripter.run_notebook_in_process(self.notebook_file, log=self.log_file)("data")
+        self.assertEqual(mod.data, [0, 1, 2])
+        self.assertEqual(open(self.log_file).read(), "data ")
+
+    def test_dry_run(self):
+        plans = NotebookScripter.plan_dead_cell_elimination(self.notebook_file, ["diagnostics"])
+        self.assertEqual([plan.run for plan in plans], [True, True, True, False])
+
+
+class TestProfiler(snapshottest.TestCase):
+    """Test per cell profiles of notebook runs"""
+
+    def setUp(self):
+        import nbformat
+        self.directory = tempfile.mkdtemp()
+        self.notebook_file = os.path.join(self.directory, "Profiled.ipynb")
+        self.py_file = os.path.join(self.directory, "Profiled.py")
+        notebook = nbformat.v4.new_notebook()
+        notebook.cells = [
+            nbformat.v4.new_code_cell("def build(n):\n    return list(range(n))"),
+            nbformat.v4.new_markdown_cell("# not executed"),
+            nbformat.v4.new_code_cell("data = build(100000)"),
+        ]
+        nbformat.write(notebook, self.notebook_file)
+        with open(self.py_file, "w") as f:
+            f.write("x = 1\n# %%\ny = x + 1\n# %% [markdown]\n# text\n# %%\n\nz = y + 1\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def run_profiled(self, run, with_profile=True):
+        with patch('NotebookScripter._main.__notebookscripter_injected__', [[{}, {}]]):
+            NotebookScripter.set_notebook_option(with_profile=with_profile)
+            return run()
+
+    def test_run_notebook(self):
+        mod = self.run_profiled(lambda: NotebookScripter.run_notebook(self.notebook_file))
+        profile = mod.__notebookscripter_profile__
+        self.assertEqual([(cell.index, cell.first_line) for cell in profile], [(0, "def build(n):"), (1, "data = build(100000)")])
+        self.assertGreater(profile[1].peak_memory, 100000 * 8)
+        self.assertTrue(all(cell.wall_time >= 0 and cell.cpu_time >= 0 for cell in profile))
+        self.assertEqual(profile[1].functions, ())
+
+    def test_py_file_cells(self):
+        mod = self.run_profiled(lambda: NotebookScripter.run_notebook(self.py_file))
+        self.assertEqual(mod.z, 3)
+        self.assertEqual([cell.first_line for cell in mod.__notebookscripter_profile__], ["x = 1", "y = x + 1", "z = y + 1"])
+
+    def test_cprofile(self):
+        mod = self.run_profiled(lambda: NotebookScripter.run_notebook(self.notebook_file), with_profile="cprofile")
+        self.assertIn("build", [function.function for function in mod.__notebookscripter_profile__[1].functions])
+        report = NotebookScripter.format_profile_report(mod)
+        self.assertIn("data = build(100000)", report)
+
+    def test_not_profiled_by_default(self):
+        mod = NotebookScripter.run_notebook(self.notebook_file)
+        self.assertFalse(hasattr(mod, "__notebookscripter_profile__"))
+
+    def test_run_notebook_in_process(self):
+        mod = self.run_profiled(lambda: NotebookScripter.run_notebook_in_process(self.notebook_file)("data"))
+        self.assertEqual(len(mod.data), 100000)
+        self.assertEqual(len(mod.__notebookscripter_profile__), 2)
+
+    def test_overlapping_profilers_share_tracing(self):
+        import tracemalloc
+        from NotebookScripter.NotebookProfiler import CellProfiler
+        first, second = CellProfiler(), CellProfiler()
+        first.start()
+        second.start()
+        first.stop()
+        self.assertTrue(tracemalloc.is_tracing())
+        second.run_cell(0, "data = list(range(100000))", compile("data = list(range(100000))", "<cell>", "exec"), {})
+        second.stop()
+        self.assertFalse(tracemalloc.is_tracing())
+        self.assertGreater(second.profiles[0].peak_memory, 100000 * 8)
+
+    def test_threaded_runs(self):
+        results = self.run_profiled(lambda: list(NotebookScripter.run_notebooks_threaded(self.notebook_file, [{}] * 4, max_workers=4)))
+        for result in results:
+            self.assertIsNone(result.exception)
+            self.assertGreater(result.module.__notebookscripter_profile__[1].peak_memory, 100000 * 8)
+
+    def test_run_notebook_in_jupyter(self):
+        mod = self.run_profiled(lambda: NotebookScripter.run_notebook_in_jupyter(self.notebook_file)("data"))
+        self.assertEqual(len(mod.data), 100000)
+        self.assertEqual([cell.first_line for cell in mod.__notebookscripter_profile__], ["def build(n):", "data = build(100000)"])
+
+
+class TestIpynbReader(snapshottest.TestCase):
+    """Test reading .ipynb files without decoding stored outputs"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_matches_nbformat(self):
+        import nbformat
+        from NotebookScripter.NotebookIpynbReader import read_lean_notebook
+        path = os.path.join(os.path.dirname(__file__), "./Samples.ipynb")
+        notebook = nbformat.read(path, 4)
+        lean_notebook = read_lean_notebook(path)
+        self.assertEqual(lean_notebook.metadata, notebook.metadata)
+        self.assertEqual([(cell.cell_type, cell.source, cell.metadata) for cell in lean_notebook.cells],
+                         [(cell.cell_type, cell.source, cell.metadata) for cell in notebook.cells])
+
+    def test_skips_outputs(self):
+        import json
+        from NotebookScripter.NotebookIpynbReader import reads_lean_notebook
+        tricky_output = {"output_type": "stream", "name": "stdout", "text": ["\\", "\"]}", "{\\\"[", "x" * 100000]}
+        notebook = {
+            "cells": [{"cell_type": "code", "execution_count": 1, "metadata": {"tags": ["a"]}, "outputs": [tricky_output], "source": ["x = '}'\n", "y = \"\\\\\""]}],
+            "metadata": {"orig_nbformat": 3}, "nbformat": 4, "nbformat_minor": 2,
+        }
+        lean_notebook = reads_lean_notebook(json.dumps(notebook, indent=1).encode("utf-8"))
+        self.assertEqual(lean_notebook.metadata, {})
+        self.assertEqual([(cell.cell_type, cell.source, cell.metadata) for cell in lean_notebook.cells],
+                         [("code", "x = '}'\ny = \"\\\\\"", {"tags": ["a"]})])
+
+    def test_optional_validation(self):
+        import json
+        import nbformat
+        path = os.path.join(self.directory, "Invalid.ipynb")
+        # code cells without outputs don't match the notebook schema
+        with open(path, "w") as f:
+            json.dump({"cells": [{"cell_type": "code", "metadata": {}, "source": "x = 1"}], "metadata": {}, "nbformat": 4, "nbformat_minor": 2}, f)
+
+        self.assertEqual(NotebookScripter.run_notebook(path).x, 1)
+        with patch('NotebookScripter._main.__notebookscripter_injected__', [[{}, {}]]):
+            NotebookScripter.set_notebook_option(with_notebook_validation=True, with_code_cache=False)
+            with self.assertRaises(nbformat.ValidationError):
+                NotebookScripter.run_notebook(path)
+
+
+class TestPyFileReader(snapshottest.TestCase):
+    """Test splitting .py notebooks into cells"""
+
+    LEGACY_NOTEBOOK = "# -*- coding: utf-8 -*-\n# <nbformat>3.0</nbformat>\n\n# <headingcell level=2>\n\n# Title\n\n# <codecell>\n\nx = 1\n# <markdowncell>\n\n# some *text*\n\n# <codecell>\n\ny = x + 1\n"
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_split_cells(self):
+        from NotebookScripter.NotebookPyFileReader import split_pyfile_cells
+        self.assertEqual(split_pyfile_cells("a = 1\n# %%\n\nb = 2\n#%% [markdown]\n# hi\n# %% [raw]\n# raw\n# %%\n"),
+                         [("code", "a = 1", 0), ("code", "b = 2", 3), ("markdown", "hi", 5), ("raw", "raw", 7)])
+
+    def test_split_legacy_cells(self):
+        from NotebookScripter.NotebookPyFileReader import split_pyfile_cells
+        self.assertEqual(split_pyfile_cells(self.LEGACY_NOTEBOOK),
+                         [("markdown", "## Title", 5), ("code", "x = 1", 9), ("markdown", "some *text*", 12), ("code", "y = x + 1", 16)])
+
+    def test_run_legacy_notebook(self):
+        path = os.path.join(self.directory, "Legacy.py")
+        with open(path, "w") as f:
+            f.write(self.LEGACY_NOTEBOOK)
+        self.assertEqual(NotebookScripter.run_notebook(path).y, 2)
+
+    def test_traceback_line_numbers(self):
+        import traceback
+        path = os.path.join(self.directory, "Failing.py")
+        with open(path, "w") as f:
+            f.write("# %%\nx = 1\n\n# %% [markdown]\n# text\n\n# %%\n\ny = 2\nraise ValueError(x)\n")
+        try:
+            NotebookScripter.run_notebook(path)
+        except ValueError as e:
+            frame = traceback.extract_tb(e.__traceback__)[-1]
+        self.assertEqual((frame.filename, frame.lineno), (path, 10))
+
+
+class TestThreadedExecution(snapshottest.TestCase):
+    """Test concurrent in-process runs on several threads"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.notebook_file = os.path.join(self.directory, "Threaded.py")
+        with open(self.notebook_file, "w") as f:
+            f.write("# %%\nfrom NotebookScripter import receive_parameter\nx = receive_parameter(x=None)\nbarrier = receive_parameter(barrier=None)\n"
+                    "# %%\nbarrier.wait(timeout=30)\nget_ipython().user_ns['seen'] = x\n"
+                    "# %%\nif x == 'fail':\n    raise ValueError(x)\nreceived_again = receive_parameter(x=None)\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_concurrent_runs_are_isolated(self):
+        import threading
+        from NotebookScripter._main import _get_shell
+        shell_user_ns = _get_shell().user_ns
+        barrier = threading.Barrier(4)
+        parameter_sets = [{"x": i, "barrier": barrier} for i in range(4)]
+
+        results = list(NotebookScripter.run_notebooks_threaded(self.notebook_file, parameter_sets, max_workers=4, ordered=True))
+        self.assertEqual([result.index for result in results], [0, 1, 2, 3])
+        self.assertEqual([(result.module.seen, result.module.received_again) for result in results], [(i, i) for i in range(4)])
+        self.assertIs(_get_shell().user_ns, shell_user_ns)
+
+    def test_failing_run_is_reported(self):
+        import threading
+        parameter_sets = [{"x": "fail", "barrier": threading.Barrier(1)}, {"x": "ok", "barrier": threading.Barrier(1)}]
+        results = sorted(NotebookScripter.run_notebooks_threaded(self.notebook_file, parameter_sets, max_workers=2))
+        self.assertIsInstance(results[0].exception, ValueError)
+        self.assertEqual(results[1].module.received_again, "ok")
+
+    def test_nested_frames_merge_parameters(self):
+        from NotebookScripter._main import _ParameterFrame
+        frame = None
+        for depth in range(100):
+            frame = _ParameterFrame(frame, {"depth": depth})
+        self.assertEqual(frame.parameters["depth"], 99)
+
+
+class TestNotebookPipeline(snapshottest.TestCase):
+    """Test DAGs of notebook runs"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.log_file = os.path.join(self.directory, "runs.log")
+        self.notebook_file = os.path.join(self.directory, "Node.py")
+        with open(self.notebook_file, "w") as f:
+            f.write("# %%\nfrom NotebookScripter import receive_parameter\n"
+                    "name = receive_parameter(name=None)\nlog_file = receive_parameter(log_file=None)\n"
+                    "left = receive_parameter(left=0)\nright = receive_parameter(right=0)\nincrement = receive_parameter(increment=1)\n"
+                    "# %%\nif increment == 'fail':\n    raise ValueError(name)\n"
+                    "with open(log_file, 'a') as log:\n    log.write(name + '\\n')\n"
+                    "value = left + right + increment\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _runs(self):
+        with open(self.log_file) as log:
+            runs = sorted(log.read().split())
+        os.remove(self.log_file)
+        return runs
+
+    def _diamond(self, b_increment=1):
+        pipeline = NotebookScripter.NotebookPipeline()
+        pipeline.add_node("a", self.notebook_file, {"name": "a", "log_file": self.log_file})
+        pipeline.add_node("b", self.notebook_file, {"name": "b", "log_file": self.log_file, "increment": b_increment}, inputs={"left": ("a", "value")})
+        pipeline.add_node("c", self.notebook_file, {"name": "c", "log_file": self.log_file, "increment": 10}, inputs={"left": "a.value"})
+        pipeline.add_node("d", self.notebook_file, {"name": "d", "log_file": self.log_file}, inputs={"left": "b.value", "right": "c.value"}, return_values=["value"])
+        return pipeline
+
+    def test_values_flow_along_edges_and_unchanged_nodes_are_skipped(self):
+        pipeline = self._diamond()
+        with NotebookScripter.NotebookProcessPool(processes=2) as pool:
+            modules = pipeline.run(pool=pool)
+            self.assertEqual(modules["d"].value, 14)
+            self.assertEqual(self._runs(), ["a", "b", "c", "d"])
+
+            self.assertEqual(pipeline.run(pool=pool)["d"].value, 14)
+            self.assertFalse(os.path.exists(self.log_file))
+
+            pipeline._nodes["b"] = pipeline._nodes["b"]._replace(parameters=dict(pipeline._nodes["b"].parameters, increment=5))
+            self.assertEqual(pipeline.run(pool=pool)["d"].value, 18)
+            self.assertEqual(self._runs(), ["b", "d"])
+
+    def test_enclosing_parameters_are_part_of_fingerprints(self):
+        pipeline = self._diamond()
+        with NotebookScripter.NotebookProcessPool(processes=2) as pool:
+            with patch('NotebookScripter._main.__notebookscripter_injected__', [[{}, {}]]):
+                self.assertEqual(pipeline.run(pool=pool)["d"].value, 14)
+            self.assertEqual(self._runs(), ["a", "b", "c", "d"])
+
+            # parameters of enclosing frames reach the nodes which don't set them
+            with patch('NotebookScripter._main.__notebookscripter_injected__', [[{"right": 100}, {}]]):
+                self.assertEqual(pipeline.run(pool=pool)["d"].value, 414)
+            self.assertEqual(self._runs(), ["a", "b", "c", "d"])
+
+            with patch('NotebookScripter._main.__notebookscripter_injected__', [[{"right": 100}, {}]]):
+                NotebookScripter.set_notebook_option(with_dead_cell_elimination=True)
+                self.assertEqual(pipeline.run(pool=pool)["d"].value, 414)
+            self.assertEqual(self._runs(), ["a", "b", "c", "d"])
+
+    def test_failing_node_stops_downstream_nodes(self):
+        pipeline = self._diamond(b_increment="fail")
+        with self.assertRaises(NotebookScripter.NotebookPipelineError) as context:
+            pipeline.run(processes=2)
+        self.assertEqual(context.exception.node, "b")
+        self.assertNotIn("d", self._runs())
+
+    def test_missing_upstream_value_fails_downstream_node(self):
+        pipeline = self._diamond()
+        pipeline.add_node("e", self.notebook_file, {"name": "e", "log_file": self.log_file}, inputs={"left": "a.undefined"})
+        with self.assertRaises(NotebookScripter.NotebookPipelineError) as context:
+            pipeline.run(processes=2)
+        self.assertEqual(context.exception.node, "e")
+        self.assertIsInstance(context.exception.__cause__, AttributeError)
+        self.assertNotIn("e", self._runs())
+
+    def test_invalid_graphs_are_rejected(self):
+        pipeline = NotebookScripter.NotebookPipeline()
+        pipeline.add_node("a", self.notebook_file, inputs={"left": "b.value"})
+        pipeline.add_node("b", self.notebook_file, inputs={"left": "a.value"})
+        with self.assertRaises(ValueError):
+            pipeline.run()
+        with self.assertRaises(ValueError):
+            pipeline.add_node("a", self.notebook_file)
+        pipeline.add_node("c", self.notebook_file, inputs={"left": "missing.value"})
+        with self.assertRaises(ValueError):
+            pipeline.run()
+
+
+class TestResultCache(snapshottest.TestCase):
+    """Test reusing the values returned by earlier subprocess runs"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.notebook_file = os.path.join(self.directory, "Cached.py")
+        self.cache_directory = os.path.join(self.directory, "results")
+        self.log_file = os.path.join(self.directory, "log")
+        self.write_notebook("value = base * 10")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_notebook(self, line):
+        with open(self.notebook_file, "w") as f:
+            f.write("from NotebookScripter import receive_parameter\nlog = receive_parameter(log=None)\nopen(log, 'a').write('x')\n"
+                    "base = receive_parameter(base=1)\n" + line + "\n")
+
+    def run_and_read_log(self, base, *return_values, pool=None, **options):
+        if os.path.exists(self.log_file):
+            os.unlink(self.log_file)
+        runner = pool or NotebookScripter
+        with patch('NotebookScripter._main.__notebookscripter_injected__', [[{}, {}]]):
+            NotebookScripter.set_notebook_option(with_result_cache=self.cache_directory, **options)
+            mod = runner.run_notebook_in_process(self.notebook_file, log=self.log_file, base=base)(*return_values)
+        log = open(self.log_file).read() if os.path.exists(self.log_file) else ""
+        return mod, log
+
+    def test_unchanged_runs_are_read_from_cache(self):
+        mod, log = self.run_and_read_log(1, "value")
+        self.assertEqual((mod.value, log), (10, "x"))
+
+        mod, log = self.run_and_read_log(1, "value")
+        self.assertEqual((mod.value, log), (10, ""))
+
+        # a different parameter, different requested names and a changed notebook all miss the cache
+        mod, log = self.run_and_read_log(2, "value")
+        self.assertEqual((mod.value, log), (20, "x"))
+        mod, log = self.run_and_read_log(1, "value", "base")
+        self.assertEqual((mod.value, mod.base, log), (10, 1, "x"))
+        self.write_notebook("value = base * 100")
+        mod, log = self.run_and_read_log(1, "value")
+        self.assertEqual((mod.value, log), (100, "x"))
+
+    def test_extra_keys_and_budget(self):
+        with NotebookScripter.NotebookProcessPool(processes=1) as pool:
+            self.run_and_read_log(1, "value", pool=pool, with_result_cache_keys=[1])
+            mod, log = self.run_and_read_log(1, "value", pool=pool, with_result_cache_keys=[1])
+            self.assertEqual((mod.value, log), (10, ""))
+            mod, log = self.run_and_read_log(1, "value", pool=pool, with_result_cache_keys=[2])
+            self.assertEqual((mod.value, log), (10, "x"))
+
+            self.run_and_read_log(3, "value", pool=pool, with_result_cache_budget=0)
+            entries = [name for _, _, names in os.walk(self.cache_directory) for name in names if name.endswith(".result")]
+            self.assertEqual(entries, [])
+
+    def test_stable_hash_ignores_ordering(self):
+        import numpy
+        from NotebookScripter.NotebookResultCache import stable_hash
+        self.assertEqual(stable_hash({"a": 1, "b": {2, 3}}), stable_hash({"b": {3, 2}, "a": 1}))
+        self.assertNotEqual(stable_hash({"a": 1}), stable_hash({"a": 1.0}))
+        self.assertNotEqual(stable_hash(numpy.arange(4)), stable_hash(numpy.arange(4).reshape(2, 2)))
+
+
+class TestStartMethod(snapshottest.TestCase):
+    """Test starting notebook subprocesses with the forkserver"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.notebook_file = os.path.join(self.directory, "Forked.py")
+        with open(self.notebook_file, "w") as f:
+            f.write("import sys\nfrom NotebookScripter import receive_parameter\nvalue = receive_parameter(value=0) + 1\n"
+                    "preloaded = 'wave' in sys.modules\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    @unittest.skipIf(os.name == "nt", "the forkserver requires POSIX")
+    def test_forkserver_runs(self):
+        with patch('NotebookScripter._main.__notebookscripter_injected__', [[{}, {}]]):
+            NotebookScripter.set_notebook_option(with_start_method="forkserver", with_forkserver_preload=["wave"])
+            mod = NotebookScripter.run_notebook_in_process(self.notebook_file, value=1)("value", "preloaded")
+            self.assertEqual((mod.value, mod.preloaded), (2, True))
+            with NotebookScripter.NotebookProcessPool(processes=1) as pool:
+                self.assertEqual(pool.run_notebook_in_process(self.notebook_file, value=2)("value").value, 3)
+
+    def test_unknown_start_method(self):
+        with patch('NotebookScripter._main.__notebookscripter_injected__', [[{}, {}]]):
+            NotebookScripter.set_notebook_option(with_start_method="fork")
+            with self.assertRaises(ValueError):
+                NotebookScripter.run_notebook_in_process(self.notebook_file)
+
+
+class TestTimeoutsAndLimits(snapshottest.TestCase):
+    """Test timeouts and resource limits of subprocess and kernel runs"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.notebook_file = os.path.join(self.directory, "Limited.py")
+        with open(self.notebook_file, "w") as f:
+            f.write("# %%\nimport time\nfrom NotebookScripter import receive_parameter\nmode = receive_parameter(mode='done')\n"
+                    "# %%\nif mode == 'sleep':\n    time.sleep(60)\nelif mode == 'spin':\n    while True:\n        pass\n"
+                    "elif mode == 'allocate':\n    block = bytearray(1 << 33)\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def run_in_process(self, mode, runner=NotebookScripter, **options):
+        with patch('NotebookScripter._main.__notebookscripter_injected__', [[{}, {}]]):
+            NotebookScripter.set_notebook_option(**options)
+            return runner.run_notebook_in_process(self.notebook_file, mode=mode)("mode")
+
+    def assertWrapped(self, exception_type, mode, **options):
+        with self.assertRaises(NotebookScripter.NotebookScripterWrappedException) as context:
+            self.run_in_process(mode, **options)
+        self.assertIsInstance(context.exception.exception, exception_type)
+
+    def test_run_timeout_terminates_subprocess(self):
+        import time
+        started = time.monotonic()
+        with self.assertRaises(NotebookScripter.NotebookScripterTimeoutError):
+            self.run_in_process("sleep", with_timeout=3)
+        self.assertLess(time.monotonic() - started, 30)
+
+    def test_run_timeout_replaces_pool_worker(self):
+        with NotebookScripter.NotebookProcessPool(processes=1) as pool:
+            with self.assertRaises(NotebookScripter.NotebookScripterTimeoutError):
+                self.run_in_process("sleep", runner=pool, with_timeout=3)
+            self.assertEqual(self.run_in_process("done", runner=pool).mode, "done")
+
+    @unittest.skipIf(os.name == "nt", "cell timeouts and resource limits require POSIX")
+    def test_cell_timeout_and_resource_limits(self):
+        self.assertWrapped(NotebookScripter.NotebookScripterTimeoutError, "sleep", with_cell_timeout=1)
+        self.assertWrapped(NotebookScripter.NotebookScripterTimeoutError, "spin", with_cpu_time_limit=1)
+        self.assertWrapped(MemoryError, "allocate", with_memory_limit=1 << 32)
+        self.assertEqual(self.run_in_process("done", with_cell_timeout=30, with_cpu_time_limit=30).mode, "done")
+
+    def test_future_timeout(self):
+        with patch('NotebookScripter._main.__notebookscripter_injected__', [[{}, {}]]):
+            NotebookScripter.set_notebook_option(with_timeout=3)
+            future = NotebookScripter.run_notebook_in_process_future(self.notebook_file, mode="sleep")("mode")
+        with self.assertRaises(NotebookScripter.NotebookScripterTimeoutError):
+            future.result(timeout=30)
+
+    def test_kernel_timeouts(self):
+        with patch('NotebookScripter._main.__notebookscripter_injected__', [[{}, {}]]):
+            NotebookScripter.set_notebook_option(with_timeout=5)
+            with self.assertRaises(NotebookScripter.NotebookScripterTimeoutError):
+                NotebookScripter.run_notebook_in_jupyter(self.notebook_file, mode="sleep")("mode")
+
+            NotebookScripter.set_notebook_option(with_timeout=None, with_cell_timeout=2)
+            with NotebookScripter.NotebookKernelPool(kernels=1) as pool:
+                with self.assertRaises(NotebookScripter.NotebookScripterTimeoutError):
+                    pool.run_notebook_in_jupyter(self.notebook_file, mode="sleep")("mode")
+                self.assertEqual(pool.run_notebook_in_jupyter(self.notebook_file, mode="done")("mode").mode, "done")
+
+
+class TestProgressEvents(snapshottest.TestCase):
+    """Test the with_events stream of cell, output and progress events"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.notebook_file = os.path.join(self.directory, "Chatty.py")
+        with open(self.notebook_file, "w") as f:
+            f.write("# %%\nfrom NotebookScripter import receive_parameter, report_progress\nsteps = receive_parameter(steps=2)\n"
+                    "# %%\nfor step in range(steps):\n    print('step', step)\n    report_progress(step=step)\n"
+                    "# %%\nif steps < 0:\n    raise ValueError('negative')\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def run_with_events(self, run, steps=2):
+        events = []
+        with patch('NotebookScripter._main.__notebookscripter_injected__', [[{}, {}]]):
+            NotebookScripter.set_notebook_option(with_events=events.append)
+            run(self.notebook_file, steps=steps)
+        return events
+
+    def summary(self, events):
+        return [(event.kind, event.cell, event.data if event.kind in ("stdout", "progress") else None) for event in events]
+
+    def expected(self, with_output):
+        expected = [("cell_started", 0, None), ("cell_finished", 0, None), ("cell_started", 1, None)]
+        for step in range(2):
+            if with_output:
+                expected.append(("stdout", 1, "step {0}\n".format(step)))
+            expected.append(("progress", 1, {"step": step}))
+        expected += [("cell_finished", 1, None), ("cell_started", 2, None), ("cell_finished", 2, None)]
+        return expected
+
+    def test_in_process_run_events(self):
+        events = self.run_with_events(NotebookScripter.run_notebook)
+        self.assertEqual(self.summary(events), self.expected(with_output=False))
+        self.assertTrue(all(event.path_to_notebook == self.notebook_file for event in events))
+        self.assertGreaterEqual(events[1].data["elapsed"], 0)
+
+    def test_subprocess_and_pool_events(self):
+        expected = self.expected(with_output=True) + [("run_finished", None, None)]
+        events = self.run_with_events(lambda path, **hooks: NotebookScripter.run_notebook_in_process(path, **hooks)())
+        self.assertEqual(self.summary(events), expected)
+
+        with NotebookScripter.NotebookProcessPool(processes=1) as pool:
+            for _ in range(2):
+                events = self.run_with_events(lambda path, **hooks: pool.run_notebook_in_process(path, **hooks)())
+                self.assertEqual(self.summary(events), expected)
+
+    def test_failing_cell_is_reported(self):
+        events = []
+        with patch('NotebookScripter._main.__notebookscripter_injected__', [[{}, {}]]):
+            NotebookScripter.set_notebook_option(with_events=events.append)
+            with self.assertRaises(NotebookScripter.NotebookScripterWrappedException):
+                NotebookScripter.run_notebook_in_process(self.notebook_file, steps=-1)()
+        self.assertEqual([event.kind for event in events[-2:]], ["cell_finished", "run_finished"])
+        self.assertEqual(events[-2].data["error"], "ValueError: negative")
+
+    def test_chatty_notebook_events_are_bounded(self):
+        from NotebookScripter.NotebookEvents import EVENT_BUFFER_SIZE
+        events = []
+
+        def _slow_consumer(event):
+            import time
+            events.append(event)
+            if len(events) == 1:
+                # let the subprocess fill the event queue
+                time.sleep(3)
+
+        with patch('NotebookScripter._main.__notebookscripter_injected__', [[{}, {}]]):
+            NotebookScripter.set_notebook_option(with_events=_slow_consumer)
+            NotebookScripter.run_notebook_in_process(self.notebook_file, steps=20000)()
+        self.assertEqual(events[-1].kind, "run_finished")
+        self.assertGreater(sum(event.dropped for event in events), 0)
+        self.assertLess(len(events), 60000)
+        self.assertGreater(len(events), EVENT_BUFFER_SIZE)
+
+    def test_raising_callback_fails_only_its_future(self):
+        def _raising_consumer(event):
+            raise KeyError(event.kind)
+
+        with patch('NotebookScripter._main.__notebookscripter_injected__', [[{}, {}]]):
+            NotebookScripter.set_notebook_option(with_events=_raising_consumer)
+            failing = NotebookScripter.run_notebook_in_process_future(self.notebook_file)("steps")
+            with self.assertRaises(KeyError):
+                failing.result(timeout=300)
+
+        future = NotebookScripter.run_notebook_in_process_future(self.notebook_file, steps=3)("steps")
+        self.assertEqual(future.result(timeout=300).steps, 3)
+
+    def test_kernel_events(self):
+        events = self.run_with_events(lambda path, **hooks: NotebookScripter.run_notebook_in_jupyter(path, **hooks)())
+        self.assertEqual(self.summary(events), self.expected(with_output=True) + [("run_finished", None, None)])
+
+
+class TestJupyterOutputs(snapshottest.TestCase):
+    """Test lean kernel outputs and binary output sidecars"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.notebook_file = os.path.join(self.directory, "Outputs.py")
+        self.output_notebook = os.path.join(self.directory, "Executed.ipynb")
+        with open(self.notebook_file, "w") as f:
+            f.write("# %%\nimport base64\nfrom IPython.display import display\n"
+                    "display({'image/png': base64.b64encode(bytes(4096)).decode(), 'text/plain': 'image'}, raw=True)\n"
+                    "display({'text/html': '<b>large</b>' * 1000, 'text/plain': 'html'}, raw=True)\n"
+                    "print('x' * 20000)\n"
+                    "# %%\nvalue = 42\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def run_and_read_outputs(self, **options):
+        import nbformat
+        with patch('NotebookScripter._main.__notebookscripter_injected__', [[{}, {}]]):
+            NotebookScripter.set_notebook_option(**options)
+            module = NotebookScripter.run_notebook_in_jupyter(self.notebook_file)("value", save_output_notebook=self.output_notebook)
+        self.assertEqual(module.value, 42)
+        return nbformat.read(self.output_notebook, as_version=4)["cells"][1]["outputs"]
+
+    def test_lean_outputs_keep_stream_tails(self):
+        from NotebookScripter.NotebookOutputs import LEAN_STREAM_CHARS
+        outputs = self.run_and_read_outputs(with_jupyter_outputs="lean")
+        self.assertEqual([output["output_type"] for output in outputs], ["stream"])
+        self.assertEqual(len(outputs[0]["text"]), LEAN_STREAM_CHARS)
+
+        outputs = self.run_and_read_outputs()
+        self.assertEqual([output["output_type"] for output in outputs], ["display_data", "display_data", "stream"])
+
+    def test_binary_outputs_are_written_to_sidecars(self):
+        outputs = self.run_and_read_outputs(with_output_sidecars=True)
+        image_output = outputs[0]
+        self.assertNotIn("image/png", image_output["data"])
+        filename = image_output["metadata"]["filenames"]["image/png"]
+        self.assertIn(filename, image_output["data"]["text/html"])
+        with open(os.path.join(self.directory, filename), "rb") as f:
+            self.assertEqual(f.read(), bytes(4096))
+
+        outputs = self.run_and_read_outputs(with_output_sidecars=1 << 20)
+        self.assertIn("image/png", outputs[0]["data"])
+
+    def test_unknown_outputs_mode(self):
+        with patch('NotebookScripter._main.__notebookscripter_injected__', [[{}, {}]]):
+            NotebookScripter.set_notebook_option(with_jupyter_outputs="none")
+            with self.assertRaises(ValueError):
+                NotebookScripter.run_notebook_in_jupyter(self.notebook_file)()
+
+
+class TestIncrementalOutputNotebook(snapshottest.TestCase):
+    """Test that saved output notebooks are written while the kernel runs"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.notebook_file = os.path.join(self.directory, "Report.py")
+        self.output_notebook = os.path.join(self.directory, "Report.ipynb")
+        with open(self.notebook_file, "w") as f:
+            f.write("# %%\nfrom NotebookScripter import receive_parameter\noutput_path = receive_parameter(output_path=None)\n"
+                    "fail = receive_parameter(fail=False)\nprint('first cell')\n"
+                    "# %%\nimport json, os, time\nfor _ in range(100):\n    if os.path.exists(output_path):\n        break\n    time.sleep(0.1)\n"
+                    "with open(output_path) as f:\n    partial = json.load(f)\n"
+                    "seen = [''.join(output.get('text', '')) for cell in partial['cells'] for output in cell.get('outputs', [])]\n"
+                    "# %%\nif fail:\n    raise ValueError('failed')\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def run_report(self, *return_values, **hooks):
+        with patch('NotebookScripter._main.__notebookscripter_injected__', [[{}, {}]]):
+            NotebookScripter.set_notebook_option(with_output_notebook_interval=0)
+            return NotebookScripter.run_notebook_in_jupyter(self.notebook_file, output_path=self.output_notebook, **hooks)(*return_values, save_output_notebook=self.output_notebook)
+
+    def test_output_notebook_is_written_as_cells_complete(self):
+        import nbformat
+        module = self.run_report("seen")
+        self.assertEqual(module.seen, ["first cell\n"])
+        nbformat.validate(nbformat.read(self.output_notebook, as_version=4))
+        self.assertEqual(sorted(os.listdir(self.directory)), ["Report.ipynb", "Report.py"])
+
+    def test_failed_run_leaves_partial_output_notebook(self):
+        import nbformat
+        with self.assertRaises(Exception):
+            self.run_report(fail=True)
+        cells = nbformat.read(self.output_notebook, as_version=4)["cells"]
+        self.assertEqual([[output["output_type"] for output in cell.get("outputs", [])] for cell in cells], [[], ["stream"], [], ["error"], []])
+
+    def test_finishing_listeners_keeps_run_errors(self):
+        import nbformat
+        import types
+        from NotebookScripter._main import _finishing_listeners
+        from NotebookScripter.NotebookOutputs import IncrementalNotebookWriter
+
+        finished = []
+        failing = types.SimpleNamespace(finish=lambda: finished.append("failing") or 1 / 0)
+        recording = types.SimpleNamespace(finish=lambda: finished.append("recording"))
+        with self.assertRaises(KeyError):
+            with _finishing_listeners([failing, recording]):
+                raise KeyError("run failed")
+        self.assertEqual(finished, ["failing", "recording"])
+
+        # the directory of the output notebook doesn't exist -- the final partial write fails
+        notebook = nbformat.v4.new_notebook(cells=[nbformat.v4.new_code_cell("x = 1")])
+        writer = IncrementalNotebookWriter(os.path.join(self.directory, "missing", "Report.ipynb"), notebook, 60)
+        client = types.SimpleNamespace(on_cell_executed=None)
+        writer.attach(client)
+        for _ in range(2):
+            client.on_cell_executed(cell=notebook.cells[0], cell_index=0, execute_reply=None)
+        with _finishing_listeners([writer, recording]):
+            pass
+        self.assertEqual(finished, ["failing", "recording", "recording"])
+
+
+class TestCommandLine(snapshottest.TestCase):
+    """Test the notebookscripter command line"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.notebook_file = os.path.join(self.directory, "Double.py")
+        self.results_file = os.path.join(self.directory, "results.jsonl")
+        with open(self.notebook_file, "w") as f:
+            f.write("# %%\nfrom NotebookScripter import receive_parameter\nn = receive_parameter(n=1)\nprint('running', n)\nresult = n * 2\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def run_cli(self, *arguments):
+        from NotebookScripter.NotebookCli import main
+        status = main([self.notebook_file, "-r", "result", "-o", self.results_file] + list(arguments))
+        with open(self.results_file) as f:
+            return status, [json.loads(line) for line in f]
+
+    def test_parameters_from_jsonl_file(self):
+        parameters_file = os.path.join(self.directory, "runs.jsonl")
+        with open(parameters_file, "w") as f:
+            f.write('{"n": 1}\n{"n": 2}\n\n{"n": 3}\n')
+        status, records = self.run_cli("--parameters-file", parameters_file, "-w", "2", "--ordered")
+        self.assertEqual(status, 0)
+        self.assertEqual([record["values"] for record in records], [{"result": 2}, {"result": 4}, {"result": 6}])
+        self.assertEqual([record["index"] for record in records], [0, 1, 2])
+
+    def test_parameters_from_csv_file_in_process(self):
+        parameters_file = os.path.join(self.directory, "runs.csv")
+        with open(parameters_file, "w") as f:
+            f.write("n,label\n5,five\n6,six\n")
+        status, records = self.run_cli("--parameters-file", parameters_file, "-m", "inprocess", "--ordered")
+        self.assertEqual(status, 0)
+        self.assertEqual([record["parameters"] for record in records], [{"n": 5, "label": "five"}, {"n": 6, "label": "six"}])
+        self.assertEqual([record["values"] for record in records], [{"result": 10}, {"result": 12}])
+
+    def test_failed_run_sets_exit_status(self):
+        status, records = self.run_cli("-p", "n=\"x\"", "-m", "inprocess")
+        self.assertEqual(status, 0)
+        self.assertEqual(records[0]["values"], {"result": "xx"})
+        status, records = self.run_cli("-p", "n=null", "-m", "inprocess")
+        self.assertEqual(status, 1)
+        self.assertEqual(records[0]["values"], {})
+        self.assertIn("TypeError", records[0]["error"])
+
+
+class TestPreparedNotebook(snapshottest.TestCase):
+    """Test notebooks prepared once for many in-process runs"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.notebook_file = os.path.join(self.directory, "Utility.py")
+        self.write_notebook("x * 2")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_notebook(self, expression):
+        with open(self.notebook_file, "w") as f:
+            f.write("# %%\nfrom NotebookScripter import receive_parameter\nx = receive_parameter(x=1)\n# %%\ny = " + expression + "\n")
+
+    def test_prepared_notebook_matches_run_notebook(self):
+        prepared = NotebookScripter.prepare_notebook(self.notebook_file)
+        for x in range(3):
+            self.assertEqual(prepared(x=x).y, NotebookScripter.run_notebook(self.notebook_file, x=x).y)
+        self.assertEqual(prepared().y, 2)
+        self.assertIsNot(prepared(x=1), prepared(x=1))
+
+    def test_options_apply_to_each_run(self):
+        with self.assertRaises(ValueError):
+            NotebookScripter.prepare_notebook(self.notebook_file, with_unknown_option=True)
+        profiled = NotebookScripter.prepare_notebook(self.notebook_file, with_profile=True)
+        self.assertEqual(len(profiled(x=2).__notebookscripter_profile__), 2)
+        self.assertFalse(hasattr(NotebookScripter.run_notebook(self.notebook_file), "__notebookscripter_profile__"))
+
+    def test_file_changes_are_picked_up_on_demand(self):
+        prepared = NotebookScripter.prepare_notebook(self.notebook_file)
+        checked = NotebookScripter.prepare_notebook(self.notebook_file, check_for_changes=True)
+        self.assertFalse(prepared.refresh())
+        self.write_notebook("x * 30")
+        self.assertEqual(prepared(x=1).y, 2)
+        self.assertEqual(checked(x=1).y, 30)
+        self.assertTrue(prepared.refresh())
+        self.assertEqual(prepared(x=1).y, 30)
+
+
+class TestImportTime(snapshottest.TestCase):
+    """Test that importing NotebookScripter stays cheap"""
+
+    # generous -- importing IPython and nbformat eagerly costs well over a second
+    IMPORT_TIME_BUDGET_MICROSECONDS = 300000
+
+    def setUp(self):
+        self.repository_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    def test_import_does_not_load_heavy_dependencies(self):
+        code = "import sys, NotebookScripter; print(','.join(m for m in ('IPython', 'traitlets', 'nbformat', 'asyncio') if m in sys.modules))"
+        output = subprocess.check_output([sys.executable, "-c", code], cwd=self.repository_root)
+        self.assertEqual(output.strip(), b"")
+
+    def test_import_time_budget(self):
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import NotebookScripter"], cwd=self.repository_root, stderr=subprocess.PIPE, check=True)
+        lines = [line for line in result.stderr.decode().splitlines() if line.rstrip().endswith("| NotebookScripter")]
+        cumulative_microseconds = int(lines[-1].split("|")[1])
+        self.assertLess(cumulative_microseconds, self.IMPORT_TIME_BUDGET_MICROSECONDS)